@@ -13,9 +13,11 @@ from iter8_analytics.api.analytics.types import *
 # from iter8_analytics.api.analytics.metrics import *
 # from iter8_analytics.api.analytics.utils import *
 from iter8_analytics.api.analytics.detailedmetric import *
+from iter8_analytics.api.analytics.tracing import get_trace_logger, Lazy
 # from iter8_analytics.api.analytics.detailedcriterion import *
 
 logger = logging.getLogger('iter8_analytics')
+trace = get_trace_logger()
 
 class DetailedCriterion():
     """Base class for a detailed criterion.
@@ -61,6 +63,18 @@ class DetailedCriterion():
         b = rm.belief
         if b.status == StatusEnum.uninitialized_belief:
             return None
+        gap = (1.0 - AdvancedParameters.posterior_probability_for_credible_intervals)*100.0
+        cilp = gap / 2.0
+        ciup = (gap/2.0) + AdvancedParameters.posterior_probability_for_credible_intervals*100.0
+        if isinstance(b, ParametricBelief):
+            # compute credible interval using the quantile function of the posterior
+            ci = Interval(
+                lower = b.quantile(cilp / 100.0),
+                upper = b.quantile(ciup / 100.0)) # quantiles of the sample are never negative
+            # if samples for this metric are all constant, return None
+            if ci.lower == ci.upper:
+                return None
+            return RatioStatistics(credible_interval = ci, ** self.detailed_version.experiment.get_ratio_metric_comparisons(self.metric_id, self.detailed_version.id))
         # if samples for this metric are all nans, return None
         ms = b.sample_posterior()
         if np.any(np.isnan(ms)):
@@ -69,52 +83,46 @@ class DetailedCriterion():
         if np.min(ms) == np.max(ms):
             return None
         # compute credible interval based on sample
-        gap = (1.0 - AdvancedParameters.posterior_probability_for_credible_intervals)*100.0
-        cilp = gap / 2.0
-        ciup = (gap/2.0) + AdvancedParameters.posterior_probability_for_credible_intervals*100.0
         ci = Interval(
             lower = max(0.0, np.percentile(ms, cilp)), 
             upper = max(0.0, np.percentile(ms, ciup))) # don't allow negative values
-        # else, get samples of this metric for baseline, and all other candidates
-        # compute the relevant statistics and return ratio metrics
-        # tbd
-        return RatioStatistics(credible_interval = ci)
+        # comparisons with baseline and all other candidates are computed by the experiment for all versions at once
+        return RatioStatistics(credible_interval = ci, ** self.detailed_version.experiment.get_ratio_metric_comparisons(self.metric_id, self.detailed_version.id))
     
     def get_criterion_mask_lts(self): 
         ms = self.detailed_metric.metric_spec
         if not self.spec.threshold:
-            logger.debug(f"No threshold for {ms.id} for {self.detailed_version.id}")
-            logger.debug("Returning ones")
-            return np.ones((Belief.sample_size, )).astype(np.float)
+            trace.debug("No threshold for %s for %s", ms.id, self.detailed_version.id)
+            trace.debug("Returning ones")
+            return np.ones((self.detailed_version.experiment.sample_size, )).astype(np.float)
         else:
-            logger.debug("LTS amplification factor should reveal") 
+            trace.debug("LTS amplification factor should reveal")
             if self.threshold_assessment is None: 
-                return np.zeros((Belief.sample_size, )).astype(np.float)
+                return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float)
 
             if self.is_counter: 
                 p = self.threshold_assessment.probability_of_satisfying_threshold
                 if p is None:
-                    return np.zeros((Belief.sample_size, )).astype(np.float)
-                return np.random.binomial(1, p, (Belief.sample_size, )).astype(np.float)
+                    return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float)
+                return self.detailed_version.rng.binomial(1, p, (self.detailed_version.experiment.sample_size, )).astype(np.float)
             else: 
                 amplification_coefficient = self.detailed_version.experiment.eip.traffic_control.amplification
-                logger.debug("LTS amplification factor")
-                logger.debug(amplification_coefficient)
+                trace.debug("LTS amplification factor: %s", amplification_coefficient)
                 return 1/(1 + np.exp(-1 * amplification_coefficient * (1 - (self.detailed_metric.belief.sample_posterior()/self.spec.threshold.value))))
 
     def get_criterion_mask(self):
         ms = self.detailed_metric.metric_spec
         if not self.spec.threshold:
-            logger.debug(f"No threshold for {ms.id} for {self.detailed_version.id}")
-            logger.debug("Returning ones")
-            return np.ones((Belief.sample_size, )).astype(np.float)
+            trace.debug("No threshold for %s for %s", ms.id, self.detailed_version.id)
+            trace.debug("Returning ones")
+            return np.ones((self.detailed_version.experiment.sample_size, )).astype(np.float)
         else:
             if self.threshold_assessment is None:
-                return np.zeros((Belief.sample_size, )).astype(np.float)
+                return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float)
             p = self.threshold_assessment.probability_of_satisfying_threshold
             if p is None:
-                return np.zeros((Belief.sample_size, )).astype(np.float)
-            return np.random.binomial(1, p, (Belief.sample_size, )).astype(np.float)
+                return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float)
+            return self.detailed_version.rng.binomial(1, p, (self.detailed_version.experiment.sample_size, )).astype(np.float)
 
 
 
@@ -123,33 +131,33 @@ class DetailedCriterion():
             #         if self.detailed_metric.aggregated_metric.value <= self.spec.threshold.value:
             #             logger.debug(f"Counter metric {ms.id} within threshold for {self.detailed_version.id}")
             #             logger.debug("Returning ones")
-            #             return np.ones((Belief.sample_size, )).astype(np.float)
+            #             return np.ones((self.detailed_version.experiment.sample_size, )).astype(np.float)
             #         else:
             #             logger.debug(f"Counter metric {ms.id} violating threshold for {self.detailed_version.id}")
             #             logger.debug("Returning zeros")
-            #             return np.zeros((Belief.sample_size, )).astype(np.float)
+            #             return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float)
             #     else: # ms.preferred_direction == DirectionEnum.higher:
             #         if self.detailed_metric.aggregated_metric.value >= self.spec.threshold.value:
             #             logger.debug(f"Counter metric {ms.id} within threshold for {self.detailed_version.id}")
             #             logger.debug("Returning ones")                        
-            #             return np.ones((Belief.sample_size, )).astype(np.float)
+            #             return np.ones((self.detailed_version.experiment.sample_size, )).astype(np.float)
             #         else:
             #             logger.debug(f"Counter metric {ms.id} violating threshold for {self.detailed_version.id}")
             #             logger.debug("Returning zeros")
-            #             return np.zeros((Belief.sample_size, )).astype(np.float)
+            #             return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float)
             # else: # self.is_counter == False. Ratio metric.
             #     rm = self.detailed_version.metrics["ratio_metrics"][self.metric_id]
             #     b = rm.belief
             #     if b.status == StatusEnum.uninitialized_belief:
             #         logger.debug(f"Uninitialized belief for metric {ms.id} for {self.detailed_version.id}")
             #         logger.debug("Returning zeros")                  
-            #         return np.zeros((Belief.sample_size, )).astype(np.float) # nothing is known about this version
+            #         return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float) # nothing is known about this version
             #     # if samples for this metric are all nans, return None
             #     sample = b.sample_posterior()
             #     if np.any(np.isnan(sample)):
             #         logger.debug(f"Nan values in  metric sample {ms.id} for {self.detailed_version.id}")
             #         logger.debug("Returning zeros")                  
-            #         return np.zeros((Belief.sample_size, )).astype(np.float) # can't use nan values
+            #         return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float) # can't use nan values
             #     else:
             #         logger.debug(f"Returning posterior indicators for metric {ms.id} for {self.detailed_version.id}")
             #         if self.spec.threshold.threshold_type == ThresholdEnum.absolute:
@@ -163,13 +171,13 @@ class DetailedCriterion():
             #                 # baseline is always assumed to satisfy relative thresholds
             #                 logger.debug(f"Relative thresholds for metric {ms.id} for baseline version {self.detailed_version.id}")
             #                 logger.debug("Returning ones as criteria mask")
-            #                 return np.ones((Belief.sample_size, )).astype(np.float)
+            #                 return np.ones((self.detailed_version.experiment.sample_size, )).astype(np.float)
 
             #             baseline_belief = baseline.metrics["ratio_metrics"][self.metric_id].belief
             #             if baseline_belief.status == StatusEnum.uninitialized_belief:
             #                 logger.debug(f"Uninitialized baseline belief for metric {ms.id} for {self.detailed_version.id}")
             #                 logger.debug("Returning zeros as criteria mask")
-            #                 return np.zeros((Belief.sample_size, )).astype(np.float) # nothing is known about this version
+            #                 return np.zeros((self.detailed_version.experiment.sample_size, )).astype(np.float) # nothing is known about this version
 
             #             baseline_sample = baseline_belief.sample_posterior() # go to the baseline and get its sample for this ratio metric
             #             if ms.preferred_direction == DirectionEnum.lower:
@@ -226,6 +234,12 @@ class DetailedCriterion():
             else:
                 return np.sum((lhs_sample >= rhs).astype(np.float))/np.size(lhs_sample)
 
+        def compute_exact_probability_of_satisfying_threshold(belief, threshold, preferred_direction):
+            if preferred_direction == DirectionEnum.lower:
+                return belief.probability_at_most(threshold)
+            else:
+                return belief.probability_at_least(threshold)
+
         def bad_belief(belief):
             if belief.status == StatusEnum.uninitialized_belief:
                 return True
@@ -235,8 +249,10 @@ class DetailedCriterion():
             return False
 
         ms = self.detailed_metric.metric_spec
+        # set when the probability of satisfying threshold is estimated from posterior samples
+        self.sampled_probability = False
         if not self.spec.threshold:
-            logger.debug(f"No threshold for {ms.id} for {self.detailed_version.id}")
+            trace.debug("No threshold for %s for %s", ms.id, self.detailed_version.id)
             self.threshold_assessment = None
             return None
         else: # there is a threshold specified
@@ -256,8 +272,14 @@ class DetailedCriterion():
                     return self.threshold_assessment
                 else: # ratio metric. got breach. trying to get post
                     b = self.detailed_metric.belief
-                    if bad_belief(b):
-                        logger.debug(f"Uninitialized belief of belief with nans for metric {ms.id} for {self.detailed_version.id}")
+                    if isinstance(b, ParametricBelief): # closed form posterior
+                        self.threshold_assessment = ThresholdAssessment(
+                            threshold_breached = breach, 
+                            probability_of_satisfying_threshold = compute_exact_probability_of_satisfying_threshold(b, self.spec.threshold.value, ms.preferred_direction)
+                        )
+                        return self.threshold_assessment
+                    elif bad_belief(b):
+                        trace.debug("Uninitialized belief of belief with nans for metric %s for %s", ms.id, self.detailed_version.id)
                         self.threshold_assessment = ThresholdAssessment(
                             threshold_breached = breach, 
                             probability_of_satisfying_threshold = None
@@ -265,7 +287,8 @@ class DetailedCriterion():
                         return self.threshold_assessment
                     else: # posterior sampling is possible. Good sample
                         # if samples for this metric are all nans, return None
-                        logger.debug(f"Returning posterior indicators for metric {ms.id} for {self.detailed_version.id}")
+                        trace.debug("Returning posterior indicators for metric %s for %s", ms.id, self.detailed_version.id)
+                        self.sampled_probability = True
                         self.threshold_assessment = ThresholdAssessment(
                             threshold_breached = breach, 
                             probability_of_satisfying_threshold = compute_probability_of_satisfying_threshold(b.sample_posterior(), self.spec.threshold.value, ms.preferred_direction)
@@ -293,11 +316,12 @@ class DetailedCriterion():
                             )
                             return self.threshold_assessment
                         else: # baseline sample also looks good
-                            logger.debug(f"Comparing candidate {self.detailed_version.id} with baseline {baseline.id} for metric {self.metric_id} with relative threshold of {self.spec.threshold.value}")
-                            logger.debug(f"Candidate's posterior: {b.sample_posterior()}")
-                            logger.debug(f"Baseline's posterior: {bdm.belief.sample_posterior()}")
+                            trace.debug("Comparing candidate %s with baseline %s for metric %s with relative threshold of %s", self.detailed_version.id, baseline.id, self.metric_id, self.spec.threshold.value)
+                            trace.debug("Candidate's posterior: %s", Lazy(b.sample_posterior))
+                            trace.debug("Baseline's posterior: %s", Lazy(bdm.belief.sample_posterior))
                             post = compute_probability_of_satisfying_threshold(b.sample_posterior(), bdm.belief.sample_posterior() * self.spec.threshold.value, ms.preferred_direction)
-                            logger.debug(f"post looks good: {post}")
+                            trace.debug("post looks good: %s", post)
+                            self.sampled_probability = True
                             self.threshold_assessment = ThresholdAssessment(
                                 threshold_breached = breach,
                                 probability_of_satisfying_threshold = post
@@ -2,61 +2,286 @@
 Module containing detailed metric classes with related update methods
 """
 # core python dependencies
+import hashlib
 import logging
 
 # external module dependencies
 import numpy as np
+from scipy import stats
+from scipy.stats import qmc
 from fastapi import HTTPException
 
 # iter8 dependencies
 from iter8_analytics.api.analytics.types import *
+from iter8_analytics.api.analytics.tracing import get_trace_logger
 
 logger = logging.getLogger('iter8_analytics')
+trace = get_trace_logger()
+
+DEFAULT_SAMPLE_SIZE = 10000
 
 class Belief():
     """Base class for belief probability distributions.
     """
-    sample_size = 10000 # hardcoded for now. super ugly!
-
-    def __init__(self, status: StatusEnum):
+    def __init__(self, status: StatusEnum, sample_size = DEFAULT_SAMPLE_SIZE):
         self.status = status
+        self.sample_size = sample_size # size of the sample drawn by compute_initial_sample
         self.sample = None
+        self.minimum = None # lower bound applied to the sample so far
 
-    def sample_posterior(self, mini = 0.0):
+    def sample_posterior(self, mini = 0.0, rng = None):
         if self.sample is None:
-            self.compute_initial_sample()
-        if mini is not None:
-            self.sample = np.maximum(self.sample, mini)
+            self.compute_initial_sample(rng or np.random.default_rng())
+        if mini is not None and (self.minimum is None or mini > self.minimum):
+            # clipping is idempotent, so it is applied in place and only when the bound increases
+            np.maximum(self.sample, mini, out = self.sample)
+            self.minimum = mini
         return self.sample
 
-class GaussianBelief(Belief):
-    def __init__(self, mean: float, variance: float):
+class ParametricBelief(Belief):
+    """Base class for beliefs whose posterior distribution has closed forms. Closed forms are those of the posterior sample, i.e., of the distribution clipped below at mini.
+    """
+    def __init__(self):
         super().__init__(StatusEnum.all_ok)
+
+    def probability_at_most(self, value, mini = 0.0):
+        """Probability that the posterior sample is at most value"""
+        if mini is not None and value < mini:
+            return 0.0
+        return float(self.distribution.cdf(value))
+
+    def probability_at_least(self, value, mini = 0.0):
+        """Probability that the posterior sample is at least value"""
+        if mini is not None and value <= mini:
+            return 1.0
+        return float(self.distribution.sf(value))
+
+    def quantile(self, q, mini = 0.0):
+        """Quantile of the posterior sample"""
+        value = float(self.distribution.ppf(q))
+        return value if mini is None else max(value, mini)
+
+class GaussianBelief(ParametricBelief):
+    def __init__(self, mean: float, variance: float):
+        super().__init__()
         self.mean = mean
         self.variance = variance
         self.stddev = np.sqrt(variance)
+        self.distribution = stats.norm(loc = self.mean, scale = self.stddev)
 
-    def compute_initial_sample(self):
-        self.sample = np.random.normal(loc = self.mean, scale = self.stddev, size = self.sample_size)
+    def get_parameters(self):
+        return (self.mean, self.variance)
 
-class BetaBelief(Belief):
+    def draw(self, rng, size):
+        return rng.normal(loc = self.mean, scale = self.stddev, size = size)
+
+    def compute_initial_sample(self, rng):
+        self.sample = self.draw(rng, self.sample_size)
+
+class BetaBelief(ParametricBelief):
     def __init__(self, alpha = 0.1, beta = 0.1):
-        super().__init__(StatusEnum.all_ok)
+        super().__init__()
         self.alpha = alpha
         self.beta = beta
+        self.distribution = stats.beta(a = self.alpha, b = self.beta)
 
-    def compute_initial_sample(self):
-        self.sample = np.random.beta(a = self.alpha, b = self.beta, size = self.sample_size)
+    def get_parameters(self):
+        return (self.alpha, self.beta)
 
+    def draw(self, rng, size):
+        return rng.beta(a = self.alpha, b = self.beta, size = size)
 
-class ConstantBelief(Belief):
+    def compute_initial_sample(self, rng):
+        self.sample = self.draw(rng, self.sample_size)
+
+
+class ConstantBelief(ParametricBelief):
     def __init__(self, value):
-        super().__init__(StatusEnum.all_ok)
+        super().__init__()
         self.value = value
 
-    def compute_initial_sample(self):
+    def compute_initial_sample(self, rng):
         self.sample = np.full((self.sample_size, ), np.float(self.value))
 
+    def clipped_value(self, mini):
+        return float(self.value) if mini is None else max(float(self.value), mini)
+
+    def probability_at_most(self, value, mini = 0.0):
+        return float(self.clipped_value(mini) <= value)
+
+    def probability_at_least(self, value, mini = 0.0):
+        return float(self.clipped_value(mini) >= value)
+
+    def quantile(self, q, mini = 0.0):
+        return self.clipped_value(mini)
+
+def get_random_beliefs(beliefs):
+    """Get the Gaussian and beta beliefs in a grid of beliefs, in the order in which sample_beliefs draws their samples.
+
+    Args:
+        beliefs (Sequence[Sequence[Belief]]): beliefs indexed by metric and version
+
+    Returns:
+        gaussian, beta (List[Tuple[int, int, Belief]]): metric index, version index and belief for each Gaussian and beta belief
+    """
+    gaussian, beta = [], []
+    for m, row in enumerate(beliefs):
+        for v, belief in enumerate(row):
+            if belief.status != StatusEnum.all_ok:
+                continue
+            if isinstance(belief, GaussianBelief):
+                gaussian.append((m, v, belief))
+            elif isinstance(belief, BetaBelief):
+                beta.append((m, v, belief))
+    return gaussian, beta
+
+def create_qmc_engine(beliefs, rng = None):
+    """Create a scrambled Sobol sequence with one dimension for each Gaussian and beta belief in a grid of beliefs, for use with sample_beliefs.
+
+    Args:
+        beliefs (Sequence[Sequence[Belief]]): beliefs indexed by metric and version
+        rng (np.random.Generator): random number generator used for scrambling
+
+    Returns:
+        engine (qmc.Sobol): Sobol engine, or None if there are no such beliefs
+    """
+    gaussian, beta = get_random_beliefs(beliefs)
+    if not gaussian and not beta:
+        return None
+    return qmc.Sobol(len(gaussian) + len(beta), scramble = True, seed = rng or np.random.default_rng())
+
+def get_qmc_sample_size(sample_size):
+    """Round a sample size up to a power of 2. The balance properties of Sobol points, which make quasi monte carlo estimates accurate, hold only for such sample sizes.
+
+    Args:
+        sample_size (int): requested sample size
+
+    Returns:
+        sample_size (int): smallest power of 2 which is at least the requested sample size
+    """
+    return 1 << max(sample_size - 1, 0).bit_length()
+
+def get_sample_seed_sequence(key):
+    """Get the seed sequence of the random stream used for a cached sample
+
+    Args:
+        key (tuple): sample cache key, as created by sample_beliefs
+
+    Returns:
+        seed_sequence (np.random.SeedSequence): seed sequence derived from the seed and all other components of the key
+    """
+    metric_id, version_id, belief_type, parameters, previous_size, sample_size, mini, seed = key
+    # ids are hashed so that the stream of a (metric, version) slot does not depend on the python hash seed
+    id_words = [int.from_bytes(hashlib.sha256(str(slot_id).encode()).digest()[:8], "little") for slot_id in (metric_id, version_id)]
+    words = np.array(parameters + (mini, ), dtype = np.float64).view(np.uint32).tolist()
+    return np.random.SeedSequence([seed, int(belief_type == BetaBelief.__name__), previous_size, sample_size] + id_words + words)
+
+def get_indices(group):
+    """Get metric and version indices of beliefs in a group, for indexing a (metrics, versions, samples) array"""
+    return tuple(np.array([entry[i] for entry in group], dtype = int) for i in (0, 1))
+
+def draw_samples(target, gaussian, beta, rng):
+    """Draw samples of Gaussian and beta beliefs with one batched call per belief type.
+
+    Args:
+        target (np.ndarray): array of shape (metrics, versions, samples) into which samples are drawn
+        gaussian, beta (List[Tuple[int, int, Belief]]): metric index, version index and belief for each Gaussian and beta belief
+        rng (np.random.Generator): random number generator
+    """
+    size = target.shape[2]
+    if gaussian:
+        target[get_indices(gaussian)] = rng.normal(
+            loc = np.array([b.mean for _, _, b in gaussian])[:, None],
+            scale = np.array([b.stddev for _, _, b in gaussian])[:, None],
+            size = (len(gaussian), size))
+    if beta:
+        target[get_indices(beta)] = rng.beta(
+            a = np.array([b.alpha for _, _, b in beta])[:, None],
+            b = np.array([b.beta for _, _, b in beta])[:, None],
+            size = (len(beta), size))
+
+def sample_beliefs(beliefs, sample_size = DEFAULT_SAMPLE_SIZE, mini = 0.0, previous_samples = None, rng = None, qmc_engine = None, cache = None, seed = None, executor = None, partition_rngs = None, ids = None):
+    """Draw posterior samples for a grid of beliefs using one batched call per belief type. Samples are drawn into a single contiguous array, and the sample of each belief becomes a view into this array.
+
+    Args:
+        beliefs (Sequence[Sequence[Belief]]): beliefs indexed by metric and version
+        sample_size (int): number of samples to draw per belief
+        mini (float): lower bound applied to all samples, as in Belief.sample_posterior
+        previous_samples (np.ndarray): samples previously drawn for the same beliefs by this function; new samples are appended to these
+        rng (np.random.Generator): random number generator; defaults to a freshly seeded generator
+        qmc_engine (qmc.Sobol): if present, samples are quasi random points from this engine transformed by inverse CDFs of beliefs; see create_qmc_engine. The first sample_size drawn from an engine should be a power of 2; see get_qmc_sample_size
+        cache (SampleCache): if present, samples of Gaussian and beta beliefs are looked up in and added to this cache. Not used along with qmc_engine
+        seed (int): random seed of the experiment, which is part of cache keys. If present, each cached sample is drawn from its own stream derived from its key, so that cached and fresh samples are identical
+        executor (concurrent.futures.Executor): if present along with partition_rngs, samples are partitioned along the sample axis, and partitions are drawn in parallel
+        partition_rngs (Sequence[np.random.Generator]): one independent random number generator per partition; results depend only on these generators, and not on scheduling
+        ids (Tuple[Sequence[str], Sequence[str]]): metric ids and version ids of the rows and columns of beliefs, which are part of cache keys; defaults to row and column indices. Samples of distinct (metric, version) slots are never shared, even if their beliefs are identical
+
+    Returns:
+        samples (np.ndarray): array of shape (metrics, versions, previous sample size + sample_size). Entries of beliefs whose status is not all_ok are nan.
+    """
+    rng = rng or np.random.default_rng()
+    num_versions = len(beliefs[0]) if len(beliefs) > 0 else 0
+    metric_ids, version_ids = ids or (range(len(beliefs)), range(num_versions))
+    previous_size = previous_samples.shape[2] if previous_samples is not None else 0
+    samples = np.full((len(beliefs), num_versions, previous_size + sample_size), np.nan)
+    if previous_size > 0:
+        samples[:, :, :previous_size] = previous_samples
+    new_samples = samples[:, :, previous_size:]
+
+    gaussian, beta = get_random_beliefs(beliefs)
+    constant = [(m, v, belief) for m, row in enumerate(beliefs) for v, belief in enumerate(row)
+        if belief.status == StatusEnum.all_ok and isinstance(belief, ConstantBelief)]
+
+    keys = {} # (metric index, version index) -> cache key, for samples to be cached
+    if qmc_engine is not None and (gaussian or beta):
+        # one dimension of the Sobol sequence per belief; gaussian beliefs come first
+        uniforms = qmc_engine.random(sample_size).T
+        if gaussian:
+            new_samples[get_indices(gaussian)] = stats.norm.ppf(uniforms[:len(gaussian)],
+                loc = np.array([b.mean for _, _, b in gaussian])[:, None],
+                scale = np.array([b.stddev for _, _, b in gaussian])[:, None])
+        if beta:
+            new_samples[get_indices(beta)] = stats.beta.ppf(uniforms[len(gaussian):],
+                a = np.array([b.alpha for _, _, b in beta])[:, None],
+                b = np.array([b.beta for _, _, b in beta])[:, None])
+    else:
+        drawn_gaussian, drawn_beta = gaussian, beta
+        if cache is not None:
+            # beliefs whose samples are cached are not sampled again
+            drawn_gaussian, drawn_beta = [], []
+            for group, drawn in [(gaussian, drawn_gaussian), (beta, drawn_beta)]:
+                for m, v, b in group:
+                    key = (metric_ids[m], version_ids[v], type(b).__name__, b.get_parameters(), previous_size, sample_size, mini, seed)
+                    sample = cache.get(key)
+                    if sample is None:
+                        keys[(m, v)] = key
+                        drawn.append((m, v, b))
+                    else:
+                        new_samples[m, v] = sample
+            if seed is not None:
+                # each sample has its own stream, so that cached and fresh samples are identical
+                for m, v, b in drawn_gaussian + drawn_beta:
+                    new_samples[m, v] = b.draw(np.random.default_rng(get_sample_seed_sequence(keys[(m, v)])), sample_size)
+                drawn_gaussian, drawn_beta = [], []
+        if executor is not None and partition_rngs is not None and len(partition_rngs) > 1:
+            # numpy generators release the GIL, so partitions are drawn concurrently
+            bounds = np.linspace(0, sample_size, len(partition_rngs) + 1).astype(int)
+            list(executor.map(lambda i: draw_samples(new_samples[:, :, bounds[i]:bounds[i + 1]], drawn_gaussian, drawn_beta, partition_rngs[i]), range(len(partition_rngs))))
+        else:
+            draw_samples(new_samples, drawn_gaussian, drawn_beta, rng)
+    if constant:
+        new_samples[get_indices(constant)] = np.array([float(b.value) for _, _, b in constant])[:, None]
+
+    if mini is not None:
+        np.maximum(new_samples, mini, out = new_samples)
+    for (m, v), key in keys.items():
+        cache.put(key, new_samples[m, v])
+    for m, v, belief in gaussian + beta + constant:
+        belief.sample = samples[m, v]
+        belief.sample_size = samples.shape[2]
+        belief.minimum = mini
+    return samples
+
 class DetailedMetric():
     """Base class for a detailed metric.
 
@@ -101,14 +326,14 @@ class DetailedRatioMetric(DetailedMetric):
     def update_belief(self):
         ratio_max_mins = self.detailed_version.experiment.ratio_max_mins
 
-        logger.debug(f"Updating belief for {self.metric_id} for version {self.detailed_version.id}")
+        trace.debug("Updating belief for %s for version %s", self.metric_id, self.detailed_version.id)
 
         if self.aggregated_metric.value is not None:
-            logger.debug(f"Metric value: {self.aggregated_metric.value}")
+            trace.debug("Metric value: %s", self.aggregated_metric.value)
 
             denominator_id = self.metric_spec.denominator
             denominator_value = self.detailed_version.metrics["counter_metrics"][denominator_id].aggregated_metric.value
-            logger.debug(f"Denominator_id: {denominator_id} Denominator value: {denominator_value}")
+            trace.debug("Denominator_id: %s Denominator value: %s", denominator_id, denominator_value)
             # numerator_id = self.metric_spec.numerator
             # numerator_value = self.detailed_version.metrics["counter_metrics"][numerator_id].aggregated_metric.value
 
@@ -119,19 +344,19 @@ class DetailedRatioMetric(DetailedMetric):
                     numerator_value = min(self.aggregated_metric.value, 1.0) * denominator_value
                     diff = denominator_value - numerator_value
                     self.belief = BetaBelief(alpha = 0.1 + numerator_value, beta = 0.1 + diff)
-                    logger.debug(f"Beta belief: {self.belief}")
+                    trace.debug("Beta belief: %s", self.belief)
                     return
                 else:  # Gaussian or constant or undefined
                     mm = ratio_max_mins[self.metric_id]
-                    logger.debug(f"Ratio max mins: {mm}")
+                    trace.debug("Ratio max mins: %s", mm)
                     if mm.maximum is not None and mm.minimum is not None:
                         width = mm.maximum - mm.minimum
                         if width > 0: # gaussian
                             self.belief = GaussianBelief(mean= self.aggregated_metric.value, variance=width*AdvancedParameters.variance_boost_factor / (1 + denominator_value))
-                            logger.debug(f"Gaussian belief: {self.belief}")
+                            trace.debug("Gaussian belief: %s", self.belief)
                             return
                         else: # use constant belief.
                             self.belief = ConstantBelief(value= mm.maximum)
-                            logger.debug(f"Constant belief: {self.belief}")
+                            trace.debug("Constant belief: %s", self.belief)
                             return
                     # else undefined belief
@@ -16,8 +16,10 @@ from iter8_analytics.api.analytics.detailedmetric import *
 from iter8_analytics.api.analytics.detailedcriterion import *
 
 from iter8_analytics.constants import ITER8_REQUEST_COUNT
+from iter8_analytics.api.analytics.tracing import get_trace_logger
 
 logger = logging.getLogger('iter8_analytics')
+trace = get_trace_logger()
 
 class DetailedVersion():
     """Base class for a version.
@@ -45,6 +47,7 @@ class DetailedVersion():
         self.is_baseline = is_baseline
         self.experiment = experiment # link back to parent experiment
         self.pseudo_reward = pseudo_reward
+        self.rng = np.random.default_rng() # random number generator for criteria masks; experiment assigns an independent stream
 
         self.metrics = {
             "counter_metrics": {
@@ -85,7 +88,7 @@ class DetailedVersion():
             new_counter_metrics (Dict[iter8id, CounterDataPoint]): dictionary mapping from metric id to CounterDataPoint
         """
         for metric_id in new_counter_metrics:
-            logger.debug(f"Aggregated counter metric before. Version: {self.id} Metric: {metric_id} Aggregated Counter Metric: {self.metrics['counter_metrics'][metric_id].aggregated_metric}")
+            trace.debug("Aggregated counter metric before. Version: %s Metric: %s Aggregated Counter Metric: %s", self.id, metric_id, self.metrics['counter_metrics'][metric_id].aggregated_metric)
 
             old_val = self.metrics['counter_metrics'][metric_id].aggregated_metric.value
             new_val = new_counter_metrics[metric_id].value
@@ -95,7 +98,7 @@ class DetailedVersion():
                     
                 self.metrics["counter_metrics"][metric_id].set_aggregated_metric(AggregatedCounterDataPoint(** new_counter_metrics[metric_id].dict()))
 
-            logger.debug(f"Aggregated counter metric after. Version: {self.id} Metric: {metric_id} Aggregated Counter Metric: {self.metrics['counter_metrics'][metric_id].aggregated_metric}")
+            trace.debug("Aggregated counter metric after. Version: %s Metric: %s Aggregated Counter Metric: %s", self.id, metric_id, self.metrics['counter_metrics'][metric_id].aggregated_metric)
         
     def aggregate_ratio_metrics(self, new_ratio_metrics: Dict[iter8id, RatioDataPoint]):
         """combine aggregated ratio metrics from last state for this version with new ratio metrics. Aggregated results stored in self.aggregated_ratio_metrics
@@ -104,10 +107,10 @@ class DetailedVersion():
             new_ratio_metrics (Dict[iter8id, RatioDataPoint]): dictionary mapping from metric id to RatioDataPoint
         """
         for metric_id in new_ratio_metrics:
-            logger.debug(f"Aggregated ratio metric before. Version: {self.id} Metric: {metric_id} Aggregated Ratio Metric: {self.metrics['ratio_metrics'][metric_id].aggregated_metric}")
+            trace.debug("Aggregated ratio metric before. Version: %s Metric: %s Aggregated Ratio Metric: %s", self.id, metric_id, self.metrics['ratio_metrics'][metric_id].aggregated_metric)
 
             if new_ratio_metrics[metric_id].value is not None:
-                logger.debug(f"New Ratio metric. Version: {self.id} Metric: {metric_id} New Ratio Metric: {new_ratio_metrics[metric_id]}")
+                trace.debug("New Ratio metric. Version: %s Metric: %s New Ratio Metric: %s", self.id, metric_id, new_ratio_metrics[metric_id])
 
                 # prefer all_ok to zeroed_ratio
                 if new_ratio_metrics[metric_id].status == StatusEnum.zeroed_ratio:
@@ -119,24 +122,17 @@ class DetailedVersion():
                     ** new_ratio_metrics[metric_id].dict()
                 ))
 
-            logger.debug(f"Aggregated ratio metric after. Version: {self.id} Metric: {metric_id} Aggregated Ratio Metric: {self.metrics['ratio_metrics'][metric_id].aggregated_metric}")
+            trace.debug("Aggregated ratio metric after. Version: %s Metric: %s Aggregated Ratio Metric: %s", self.id, metric_id, self.metrics['ratio_metrics'][metric_id].aggregated_metric)
 
 
     def update_beliefs(self):
         """Update beliefs for ratio metrics. If belief update is not possible due to insufficient data, then the relevant status codes are populated here
         """
         for rm in self.metrics["ratio_metrics"].values():
-            logger.debug(f"Version: {self.id} Metric: {rm.metric_id}")
-            logger.debug(f"detailed metric: {rm.aggregated_metric}")
+            trace.debug("Version: %s Metric: %s", self.id, rm.metric_id)
+            trace.debug("detailed metric: %s", rm.aggregated_metric)
             rm.update_belief()
-            logger.debug(f"Updated belief: {vars(rm.belief)}")
-
-    def create_ratio_metric_samples(self):
-        """Create ratio metric samples used for assessment and traffic routing
-        """
-        for rm in self.metrics["ratio_metrics"].values():
-            if rm.belief.status == StatusEnum.all_ok:
-                rm.belief.sample_posterior()
+            trace.debug("Updated belief: %s", vars(rm.belief))
 
     def get_reward_sample(self):
         self.reward_metric_id = None
@@ -146,31 +142,29 @@ class DetailedVersion():
                 break
 
         if not self.reward_metric_id: # return pseudo-reward
-            return np.full((Belief.sample_size, ), np.float(self.pseudo_reward))
+            return np.full((self.experiment.sample_size, ), np.float(self.pseudo_reward))
         else: # try and return a real reward
             rm = self.metrics["ratio_metrics"][self.reward_metric_id]
             if rm.belief.status == StatusEnum.all_ok:
                 return rm.belief.sample_posterior()
             else: 
-                return np.full((Belief.sample_size, ), np.nan)
+                return np.full((self.experiment.sample_size, ), np.nan)
 
     def get_criteria_mask_lts(self):
-        product_cm = np.ones((Belief.sample_size, ))
-        logger.debug(f"Creating lts criteria mask for version: {self.id}")
+        product_cm = np.ones((self.experiment.sample_size, ))
+        trace.debug("Creating lts criteria mask for version: %s", self.id)
         for criterion in self.experiment.eip.criteria:
             cm = self.detailed_criteria[criterion.id].get_criterion_mask_lts()
-            logger.debug(f"LTS Criteria with metric {criterion.metric_id}")
-            logger.debug(cm)
+            trace.debug("LTS Criteria with metric %s: %s", criterion.metric_id, cm)
             product_cm *= cm
         return product_cm
 
     def get_criteria_mask(self):
-        product_cm = np.ones((Belief.sample_size, ))
-        logger.debug(f"Creating criteria mask for version: {self.id}")
+        product_cm = np.ones((self.experiment.sample_size, ))
+        trace.debug("Creating criteria mask for version: %s", self.id)
         for criterion in self.experiment.eip.criteria:
             cm = self.detailed_criteria[criterion.id].get_criterion_mask()
-            logger.debug(f"Criteria with metric {criterion.metric_id}")
-            logger.debug(cm)
+            trace.debug("Criteria with metric %s: %s", criterion.metric_id, cm)
             product_cm *= cm
         return product_cm
             
@@ -3,18 +3,26 @@ Module containing classes to run an iteration of an iter8 eperiment, and return
 """
 # core python dependencies
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 
 # external module dependencies
 import numpy as np
 import pandas as pd
 from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
 
 # iter8 dependencies
 from iter8_analytics.api.analytics.types import *
 from iter8_analytics.api.analytics.metrics import *
 from iter8_analytics.api.analytics.utils import *
 from iter8_analytics.constants import ITER8_REQUEST_COUNT
+import iter8_analytics.constants as constants
+from iter8_analytics.config import env_config
+from iter8_analytics.api.analytics.detailedmetric import sample_beliefs, create_qmc_engine, get_qmc_sample_size
+from iter8_analytics.api.analytics.samplecache import get_sample_cache
+from iter8_analytics.api.analytics.tracing import get_trace_logger, start_trace, end_trace, propagate_trace, Lazy
 import iter8_analytics.api.analytics.detailedversion
 
 # type aliases
@@ -23,6 +31,28 @@ DetailedBaselineVersion = iter8_analytics.api.analytics.detailedversion.Detailed
 DetailedCandidateVersion = iter8_analytics.api.analytics.detailedversion.DetailedCandidateVersion
 
 logger = logging.getLogger('iter8_analytics')
+trace = get_trace_logger()
+
+# smallest number of samples drawn by a thread in parallel sampling
+MIN_SAMPLES_PER_PARTITION = 2000
+
+_sampling_executor = None
+_sampling_executor_lock = threading.Lock()
+
+def get_sampling_executor():
+    """Return the process-wide thread pool for posterior sampling and criteria masks. The pool is sized by the sampling_threads field of the config file.
+
+    Returns:
+        executor (ThreadPoolExecutor): thread pool, or None if sampling is serial
+    """
+    global _sampling_executor
+    if env_config[constants.SAMPLING_THREADS] <= 1:
+        return None
+    if _sampling_executor is None:
+        with _sampling_executor_lock:
+            if _sampling_executor is None:
+                _sampling_executor = ThreadPoolExecutor(max_workers = env_config[constants.SAMPLING_THREADS], thread_name_prefix = 'iter8-sampling')
+    return _sampling_executor
 
 class Experiment():
     """The experiment class which provides necessary methods for running a single iteration of an iter8 experiment
@@ -35,11 +65,15 @@ class Experiment():
             eip (ExperimentIterationParameters): Experiment iteration parameters
 
         Raises:
-            HTTPException: Ratio metrics contain metric ids other than counter metric ids in their numerator or denominator. Unknown metric id is found in criteria. Metric marked as reward is not a ratio metric. There is at most one reward metric.
+            HTTPException: Ratio metrics contain metric ids other than counter metric ids in their numerator or denominator. Unknown metric id is found in criteria. Metric marked as reward is not a ratio metric. There is at most one reward metric. Query template of a metric is invalid.
         """
 
         self.eip = eip
 
+        # all random numbers in this iteration are drawn from streams derived from a single seed sequence
+        self.seed_sequence = get_seed_sequence(self.eip.random_seed, self.eip.iteration_number)
+        self.rng = np.random.default_rng(self.seed_sequence)
+
         # Initialized traffic split dictionary
         self.traffic_split = {}
 
@@ -100,6 +134,10 @@ class Experiment():
                 if ms.preferred_direction is None:                    
                     raise HTTPException(status_code = 422, detail = f"Criterion uses {c.metric_id} with a threshold, but the metric does not have a preferred direction set.")
 
+        # raise exception if you find an invalid query template; compiled templates are cached for querying
+        version_label_keys = tuple((self.eip.candidates or [self.eip.baseline])[0].version_labels.keys())
+        for cms in self.counter_metric_specs.values():
+            compile_query_template(cms.query_template, version_label_keys)
 
         # Initialize detailed versions. Pseudo reward for baseline = 1.0; pseudo reward for 
         # candidate is 2.0 + its index in the candidates list (i.e., the first candidate has
@@ -112,13 +150,29 @@ class Experiment():
         }
         self.detailed_baseline_version = DetailedBaselineVersion(self.eip.baseline, self)
         self.detailed_versions[self.eip.baseline.id] = self.detailed_baseline_version
-
-        # Initialize exp3 weights init 1 for all self.detailed_versions
-        self.exp3_weights = {}
-        for key in self.detailed_versions.keys():
-            self.exp3_weights[key] = 1
-
-        logger.debug(f"Exp3 weights: {self.exp3_weights}") 
+        # criteria masks of each version are drawn from an independent stream, so versions can be processed in parallel
+        for detailed_version, rng in zip(self.detailed_versions.values(), self.spawn_rngs(len(self.detailed_versions))):
+            detailed_version.rng = rng
+
+        # exp3 weights are kept in log space, and are initially equal for all versions
+        self.exp3_log_weights = {key: 0.0 for key in self.detailed_versions}
+        last_state = self.eip.last_state
+        if last_state and last_state.exp3_log_weights:
+            self.exp3_log_weights.update({key: value for key, value in last_state.exp3_log_weights.items() if key in self.exp3_log_weights})
+        elif last_state and last_state.traffic_split_recommendation and TrafficSplitStrategy.exp3 in last_state.traffic_split_recommendation:
+            # older last states only carry the exp3 split rounded to percentages; a zero percentage stands for less than half a percent
+            for key, value in last_state.traffic_split_recommendation[TrafficSplitStrategy.exp3].items():
+                if key in self.exp3_log_weights:
+                    self.exp3_log_weights[key] = math.log(max(value, 0.5))
+
+
+        # only the selected strategy is computed, unless all strategies are requested
+        if self.eip.traffic_control.all_strategies:
+            self.traffic_split_strategies = list(TrafficSplitStrategy)
+        else:
+            self.traffic_split_strategies = [self.eip.traffic_control.strategy]
+        # LTS masks and utilities are needed only by LTS strategies
+        self.lts = TrafficSplitStrategy.top_1_lts in self.traffic_split_strategies or TrafficSplitStrategy.top_2_lts in self.traffic_split_strategies
 
 
         # check if there is a reward metric, and what its preferred direction is
@@ -132,27 +186,74 @@ class Experiment():
                 break
 
 
+    def spawn_rngs(self, n):
+        """Get independent random number generators, e.g., for sampling in parallel
+
+        Args:
+            n (int): number of generators
+
+        Returns:
+            generators (List[np.random.Generator]): generators seeded from child streams of this experiment's seed sequence
+        """
+        return [np.random.default_rng(s) for s in self.seed_sequence.spawn(n)]
+
     def populate_metric_values(self):
         """
         Populate metric values in detailed versions. Also populate aggregated_counter_metrics and ratio_max_mins attributes.
         """
-        self.new_counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]] = get_counter_metrics(
-            self.counter_metric_specs, 
-            [version.spec for version in self.detailed_versions.values()],
-            self.eip.start_time
+        self.collect_metric_values(*self.submit_metric_queries())
+
+    def submit_metric_queries(self):
+        """Submit the metric queries of this iteration to the query executor.
+
+        Returns:
+            a tuple (Tuple[Dict[iter8id, Future], Dict[iter8id, Future]]): futures for counter metric queries and ratio metric queries
+        """
+        versions = [version.spec for version in self.detailed_versions.values()]
+        # all queries in this iteration share a single latency budget, which starts once they leave the queue of the query executor
+        deadline = get_metrics_backend().create_query_deadline()
+
+        # counter and ratio queries are sent to prometheus together; ratio results are collected after counters are aggregated
+        # ratio metrics which can be derived from counter metrics are not queried at all
+        counter_metric_futures = submit_counter_metric_queries(
+            self.counter_metric_specs,
+            versions,
+            self.eip.start_time,
+            deadline
         )
- 
+        ratio_metric_futures = submit_ratio_metric_queries(
+            get_server_side_ratio_metric_specs(self.ratio_metric_specs, self.counter_metric_specs),
+            self.counter_metric_specs,
+            versions,
+            self.eip.start_time,
+            deadline
+        )
+        return counter_metric_futures, ratio_metric_futures
+
+    def collect_metric_values(self, counter_metric_futures, ratio_metric_futures):
+        """Wait for metric queries submitted by submit_metric_queries(), and populate metric values in detailed versions. Also populate aggregated_counter_metrics and ratio_max_mins attributes.
+
+        Args:
+            counter_metric_futures (Dict[iter8id, Future]): futures for counter metric queries
+            ratio_metric_futures (Dict[iter8id, Future]): futures for ratio metric queries
+        """
+        versions = [version.spec for version in self.detailed_versions.values()]
+        self.new_counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]] = collect_counter_metrics(
+            counter_metric_futures,
+            versions
+        )
+
         for detailed_version in self.detailed_versions.values():
             detailed_version.aggregate_counter_metrics(self.new_counter_metrics[detailed_version.id])
 
         self.aggregated_counter_metrics = self.get_aggregated_counter_metrics()
 
-        self.new_ratio_metrics: Dict[iter8id,  Dict[iter8id, RatioDataPoint]] = get_ratio_metrics(
-            self.ratio_metric_specs, 
-            self.counter_metric_specs, 
+        self.new_ratio_metrics: Dict[iter8id,  Dict[iter8id, RatioDataPoint]] = collect_ratio_metrics(
+            self.ratio_metric_specs,
+            ratio_metric_futures,
             self.aggregated_counter_metrics,
-            [version.spec for version in self.detailed_versions.values()],
-            self.eip.start_time
+            versions,
+            self.new_counter_metrics
         )
 
         # This is in the shape of a Dict[str, RatioMaxMin], where the keys are ratio metric ids
@@ -172,86 +273,245 @@ class Experiment():
             it8ar (Iter8AssessmentAndRecommendation): Iter8 assessment and recommendation
         """  
 
-        self.populate_metric_values()
+        # debug traces of this iteration are emitted only if it is selected for tracing
+        token = start_trace(self.eip.service_name)
+        try:
+            self.populate_metric_values()
+            return self.assess()
+        finally:
+            end_trace(token)
 
-        # empty data frame to hold reward samples and criteria_masks
-        self.rewards = pd.DataFrame()
-        self.criteria_mask = pd.DataFrame()
+    async def run_async(self) -> Iter8AssessmentAndRecommendation:
+        """Perform a single iteration of the experiment and return assessment and recommendation, without blocking the event loop. Waiting on metric queries holds no thread, and the CPU-bound stages of the iteration run in the thread pool.
+        
+        Returns:
+            it8ar (Iter8AssessmentAndRecommendation): Iter8 assessment and recommendation
+        """  
+
+        token = start_trace(self.eip.service_name)
+        try:
+            metric_query_futures = self.submit_metric_queries()
+            await wait_for_queries(*metric_query_futures)
 
-        # create masks for logistic formulation
-        self.criteria_mask_lts = pd.DataFrame()
+            def collect_and_assess():
+                self.collect_metric_values(*metric_query_futures)
+                return self.assess()
 
+            return await run_in_threadpool(propagate_trace(collect_and_assess))
+        finally:
+            end_trace(token)
+
+    def assess(self) -> Iter8AssessmentAndRecommendation:
+        """Create assessment and recommendation from the metric values of this iteration. This includes all CPU-bound stages of the iteration.
+
+        Returns:
+            it8ar (Iter8AssessmentAndRecommendation): Iter8 assessment and recommendation
+        """
         for detailed_version in self.detailed_versions.values():
             # baseline beliefs and all other version are needed for posterior samples
-            logger.debug(f"Updating beliefs for {detailed_version.id}")
+            trace.debug("Updating beliefs for %s", detailed_version.id)
             detailed_version.update_beliefs()
 
-        for detailed_version in self.detailed_versions.values():
-            # posterior samples for ratio metrics are needed to create reward and criterion masks
-            detailed_version.create_ratio_metric_samples()
+        # in adaptive sampling mode, the sample is doubled until the estimation error is small enough
+        tc = self.eip.traffic_control
+        self.sample_size = 0
+        self.ratio_metric_samples = None
+        self.qmc_engine = None
+        chunk_size = tc.sample_size
+        if tc.sampling_method == SamplingMethodEnum.quasi_monte_carlo:
+            # doubling keeps the sample size a power of 2, unless max_sample_size is reached
+            chunk_size = get_qmc_sample_size(chunk_size)
+        while True:
+            self.create_samples(chunk_size)
+            self.standard_error = self.get_standard_error()
+            trace.debug("Sample size: %s Standard error: %s", self.sample_size, self.standard_error)
+            if not tc.adaptive_sampling or self.standard_error <= tc.target_standard_error or self.sample_size >= tc.max_sample_size:
+                break
+            chunk_size = min(self.sample_size, tc.max_sample_size - self.sample_size)
+
+        # self.add_baseline_bias()
+        self.create_traffic_recommendations()
+        return self.assemble_assessment_and_recommendations()
+
+    def create_samples(self, chunk_size):
+        """Draw chunk_size further posterior samples, and recompute criteria assessments, utility samples and winner assessment from all samples drawn so far.
+
+        Args:
+            chunk_size (int): number of samples to be added
+        """
+        # posterior samples for ratio metrics are needed to create reward and criterion masks
+        self.create_ratio_metric_samples(chunk_size)
+        # comparisons between versions are needed to create ratio statistics in criteria assessments
+        self.create_ratio_metric_comparisons()
+
+        def create_masks(detailed_version):
             # this step involves creating detailed criteria, along with reward and criterion masks
             detailed_version.create_criteria_assessments()
             # reward and criteria masks are used to compute utility samples
-            self.rewards[detailed_version.id] = detailed_version.get_reward_sample()            
-            self.criteria_mask[detailed_version.id] = detailed_version.get_criteria_mask()
-            self.criteria_mask_lts[detailed_version.id] = detailed_version.get_criteria_mask_lts()
+            return detailed_version.get_reward_sample(), detailed_version.get_criteria_mask(), detailed_version.get_criteria_mask_lts() if self.lts else None
+
+        # versions are independent of each other; results are merged in the order of versions
+        executor = get_sampling_executor()
+        masks = list((executor.map if executor else map)(propagate_trace(create_masks), self.detailed_versions.values()))
+
+        # reward samples and criteria masks are (samples x versions) arrays whose columns follow self.version_ids
+        rewards, criteria_masks, criteria_masks_lts = zip(*masks)
+        self.rewards = np.stack(rewards, axis = 1)
+        self.criteria_mask = np.stack(criteria_masks, axis = 1)
+        self.criteria_mask_lts = np.stack(criteria_masks_lts, axis = 1) if self.lts else None
 
         # utility samples are needed for winner assessment and traffic recommendations
-        logger.debug("Reward sample")
-        logger.debug(self.rewards.head())
+        trace.debug("Reward sample: %s", self.rewards[:5])
 
-        logger.debug("Criteria mask")
-        logger.debug(self.criteria_mask.head())
+        trace.debug("Criteria mask: %s", self.criteria_mask[:5])
 
-        logger.debug("Criteria mask LTS")
-        logger.debug(self.criteria_mask_lts.head())
+        if self.lts:
+            trace.debug("Criteria mask LTS: %s", self.criteria_mask_lts[:5])
 
         self.create_utility_samples()
 
-        logger.debug("Utility sample")
-        logger.debug(self.utilities.head())
+        trace.debug("Utility sample: %s", self.utilities[:5])
 
         self.create_winner_assessments()
-        # self.add_baseline_bias()
-        self.create_traffic_recommendations()
-        return self.assemble_assessment_and_recommendations()
 
-    def create_utility_samples(self):
-        if self.preferred_reward_direction == DirectionEnum.higher:
-            self.effective_rewards = self.rewards
+    def create_ratio_metric_samples(self, chunk_size):
+        """Draw chunk_size further posterior samples of all ratio metrics for all versions in a few batched calls. Samples are stored in self.ratio_metric_samples, an array of shape (ratio metrics, versions, sample size) whose axes follow self.ratio_metric_ids and self.version_ids. The sample of each belief is a view into this array.
+
+        Args:
+            chunk_size (int): number of samples to be added
+        """
+        self.ratio_metric_ids = list(self.ratio_metric_specs)
+        self.version_ids = list(self.detailed_versions)
+        beliefs = [
+            [self.detailed_versions[version_id].metrics["ratio_metrics"][metric_id].belief for version_id in self.version_ids]
+            for metric_id in self.ratio_metric_ids
+        ]
+        # in quasi monte carlo mode, further chunks of samples continue the same Sobol sequence
+        # otherwise, samples of beliefs which are unchanged since an earlier iteration are reused
+        cache = None
+        if self.eip.traffic_control.sampling_method == SamplingMethodEnum.quasi_monte_carlo:
+            if self.qmc_engine is None:
+                self.qmc_engine = create_qmc_engine(beliefs, self.rng)
         else:
-            max_rewards = self.rewards.max(axis = 1, skipna = False)
-            self.effective_rewards = pd.DataFrame()
-            for col in self.rewards.columns:
-                self.effective_rewards[col] = max_rewards - self.rewards[col]
+            cache = get_sample_cache()
+        # in parallel mode, the chunk is partitioned among threads, each of which draws from an independent stream
+        executor = get_sampling_executor()
+        partition_rngs = None
+        if executor is not None:
+            partitions = min(env_config[constants.SAMPLING_THREADS], chunk_size // MIN_SAMPLES_PER_PARTITION)
+            if partitions > 1:
+                partition_rngs = self.spawn_rngs(partitions)
+        self.ratio_metric_samples = sample_beliefs(beliefs, chunk_size, previous_samples = self.ratio_metric_samples, rng = self.rng, qmc_engine = self.qmc_engine, cache = cache, seed = self.eip.random_seed, executor = executor, partition_rngs = partition_rngs, ids = (self.ratio_metric_ids, self.version_ids))
+        if cache is not None:
+            trace.debug("Sample cache: %s", Lazy(cache.stats))
+        self.sample_size += chunk_size
+
+    def create_ratio_metric_comparisons(self):
+        """Compare versions with respect to each ratio metric, in a single pass over self.ratio_metric_samples. Results are stored in self.probability_of_being_best (ratio metrics x versions), self.probability_of_beating_baseline (ratio metrics x versions), and self.improvement_over_baseline (2 x ratio metrics x versions) which holds endpoints of credible intervals for percentage improvement over baseline. Undefined entries are nan.
+        """
+        samples = self.ratio_metric_samples
+        num_metrics, num_versions, sample_size = samples.shape
+        self.probability_of_being_best = np.full((num_metrics, num_versions), np.nan)
+        self.probability_of_beating_baseline = np.full((num_metrics, num_versions), np.nan)
+        self.improvement_over_baseline = np.full((2, num_metrics, num_versions), np.nan)
+        if num_metrics == 0 or sample_size == 0:
+            return
+
+        # samples are oriented so that higher is better; metrics without a preferred direction are not ranked
+        direction = np.array([{
+            DirectionEnum.higher: 1.0,
+            DirectionEnum.lower: -1.0
+        }.get(self.ratio_metric_specs[metric_id].preferred_direction, np.nan) for metric_id in self.ratio_metric_ids])
+        valid = ~np.isnan(samples[:, :, 0])
+        ranked = (~np.isnan(direction))[:, None] & valid
+        oriented = np.where(ranked[:, :, None], samples * np.nan_to_num(direction)[:, None, None], -np.inf)
+
+        # the best version in each sample, counted for all metrics with a single bincount
+        best = np.argmax(oriented, axis = 1) + (np.arange(num_metrics) * num_versions)[:, None]
+        best_counts = np.bincount(best.ravel(), minlength = num_metrics * num_versions).reshape(num_metrics, num_versions)
+        self.probability_of_being_best[ranked] = (best_counts / sample_size)[ranked]
+
+        baseline_index = self.version_ids.index(self.detailed_baseline_version.id)
+        compared = valid & valid[:, baseline_index:baseline_index + 1]
+        compared[:, baseline_index] = False
+        beats = (oriented > oriented[:, baseline_index:baseline_index + 1]).mean(axis = 2)
+        self.probability_of_beating_baseline[compared & ranked] = beats[compared & ranked]
+
+        gap = (1.0 - AdvancedParameters.posterior_probability_for_credible_intervals)*100.0
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            baseline_samples = samples[:, baseline_index:baseline_index + 1]
+            improvement = (samples - baseline_samples) / baseline_samples * 100.0
+            improvement *= np.where(direction == -1.0, -1.0, 1.0)[:, None, None]
+            interval = np.percentile(improvement, [gap / 2.0, 100.0 - gap / 2.0], axis = 2)
+            # percentage improvement is unbounded if the baseline has real posterior mass near zero, e.g., error rates with few errors
+            baseline_lower, baseline_median = np.percentile(baseline_samples[:, 0], [gap / 2.0, 50.0], axis = 1)
+            bounded_baseline = baseline_lower >= AdvancedParameters.min_baseline_lower_bound_ratio * baseline_median
+        compared &= np.isfinite(interval).all(axis = 0) & (bounded_baseline & (baseline_median > 0))[:, None]
+        self.improvement_over_baseline[:, compared] = interval[:, compared]
+
+    def get_ratio_metric_comparisons(self, metric_id, version_id):
+        """Get comparisons of a version with other versions with respect to a ratio metric
 
-        self.effective_rewards = self.effective_rewards.fillna(0)
+        Args:
+            metric_id (str): ratio metric id
+            version_id (str): version id
 
-        logger.debug("Effective rewards")
-        logger.debug(self.effective_rewards.head())
+        Returns:
+            comparisons (dict): keyword arguments for RatioStatistics
+        """
+        m = self.ratio_metric_ids.index(metric_id)
+        v = self.version_ids.index(version_id)
+        def to_float(x):
+            return None if np.isnan(x) else float(x)
+        return {
+            "improvement_over_baseline": None if np.isnan(self.improvement_over_baseline[0, m, v]) else Interval(
+                lower = float(self.improvement_over_baseline[0, m, v]),
+                upper = float(self.improvement_over_baseline[1, m, v])),
+            "probability_of_beating_baseline": to_float(self.probability_of_beating_baseline[m, v]),
+            "probability_of_being_best_version": to_float(self.probability_of_being_best[m, v])
+        }
 
-        logger.debug("Criteria mask")
-        logger.debug(self.criteria_mask.head())
+    def get_standard_error(self):
+        """Get the largest Monte Carlo standard error among win probabilities and probabilities of satisfying thresholds estimated from posterior samples
 
-        logger.debug("Criteria mask LTS")
-        logger.debug(self.criteria_mask_lts.head())
+        Returns:
+            standard_error (float): the largest standard error
+        """
+        standard_errors = list(self.win_probability_standard_errors)
+        for version in self.detailed_versions.values():
+            for dc in version.detailed_criteria.values():
+                if dc.sampled_probability:
+                    p = dc.threshold_assessment.probability_of_satisfying_threshold
+                    standard_errors.append(math.sqrt(p * (1.0 - p) / self.sample_size))
+        return float(max(standard_errors, default = 0.0))
 
+    def create_utility_samples(self):
+        if self.preferred_reward_direction == DirectionEnum.higher:
+            self.effective_rewards = self.rewards.copy()
+        else:
+            # a nan reward in any version makes effective rewards of all versions nan in that sample
+            self.effective_rewards = np.max(self.rewards, axis = 1, keepdims = True) - self.rewards
 
-        # multiple effective rewards with criteria masks
-        self.utilities = self.effective_rewards * self.criteria_mask
-        self.utilities_lts = self.effective_rewards * self.criteria_mask_lts
+        self.effective_rewards[np.isnan(self.effective_rewards)] = 0.0
 
-        logger.debug("Created utility samples")
-        logger.debug(self.utilities.head())
+        trace.debug("Effective rewards: %s", self.effective_rewards[:5])
 
-        logger.debug("Created utility samples LTS")
-        logger.debug(self.utilities_lts.head())
+        trace.debug("Criteria mask: %s", self.criteria_mask[:5])
+
+        # multiple effective rewards with criteria masks
+        self.utilities_lts = None
+        if self.lts:
+            trace.debug("Criteria mask LTS: %s", self.criteria_mask_lts[:5])
+            self.utilities_lts = self.effective_rewards * self.criteria_mask_lts
+            trace.debug("Created utility samples LTS: %s", self.utilities_lts[:5])
+        self.utilities = np.multiply(self.effective_rewards, self.criteria_mask, out = self.effective_rewards)
+
+        trace.debug("Created utility samples: %s", self.utilities[:5])
 
     def add_baseline_bias(self):
         # bias term to ensure baseline is picked when all versions have zero utilities
-        self.utilities[self.detailed_baseline_version.id] += 1.0e-10
-        logger.debug("Added baseline bias")
-        logger.debug(self.utilities.head())
+        self.utilities[:, self.version_ids.index(self.detailed_baseline_version.id)] += 1.0e-10
+        trace.debug("Added baseline bias: %s", self.utilities[:5])
 
     def get_aggregated_counter_metrics(self):
         """Get aggregated counter metrics for this detailed version
@@ -309,199 +569,180 @@ class Experiment():
         """Create winner assessment. If winner cannot be created due to insufficient data, then the relevant status codes are populated
         """
         # get the fraction of the time a particular version emerged as the winner
-        rank_df = self.utilities.rank(axis = 1, method = 'min', ascending = False)
-        low_rank = rank_df <= 1
-        self.win_probababilities = low_rank.sum() / low_rank.sum().sum()
+        # ranks are computed once, and reused by the top-k traffic recommendations
+        ranks = get_min_ranks(self.utilities)
+        self.rank_counts = get_rank_counts(ranks)
+        wins = self.rank_counts[0]
+        self.win_probababilities = pd.Series(wins / wins.sum(), index = self.version_ids)
+        # standard errors are estimated from the share of the win attributed to each version in each sample
+        low_rank = ranks == 0
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            win_shares = low_rank / low_rank.sum(axis = 1, keepdims = True)
+        self.win_probability_standard_errors = np.nanstd(win_shares, axis = 0) / math.sqrt(self.sample_size)
 
     def create_traffic_recommendations(self):
-        """Create traffic recommendations for individual algorithms
+        """Create traffic recommendations for the selected algorithm, or for all algorithms if requested
         """
-        self.traffic_split_recommendation = {
-            x: {} for x in [TrafficSplitStrategy.progressive, TrafficSplitStrategy.top_2, TrafficSplitStrategy.uniform, TrafficSplitStrategy.top_1_lts, TrafficSplitStrategy.top_2_lts, TrafficSplitStrategy.exp3]
-        }
+        traffic_split = {}
 
-        for i in [1, 2, len(self.detailed_versions)]:
-            self.create_top_k_recommendation(i, self.utilities)
+        for i, strategy in [(1, TrafficSplitStrategy.progressive), (2, TrafficSplitStrategy.top_2), (len(self.detailed_versions), TrafficSplitStrategy.uniform)]:
+            if strategy in self.traffic_split_strategies:
+                self.create_top_k_recommendation(i, self.rank_counts)
+                traffic_split[strategy] = self.traffic_split[i]
         
-        self.create_exp3_recommendation()
-        ## Logistic traffic split 
-        for idx, val in enumerate(["top_1_lts","top_2_lts"]):
-            self.create_top_k_recommendation(val, self.utilities_lts, idx+1)
+        if TrafficSplitStrategy.exp3 in self.traffic_split_strategies:
+            self.create_exp3_recommendation()
+            traffic_split[TrafficSplitStrategy.exp3] = self.traffic_split["exp3"]
 
-        
+        ## Logistic traffic split 
+        if self.lts:
+            rank_counts_lts = get_rank_counts(get_min_ranks(self.utilities_lts))
+            for idx, strategy in enumerate([TrafficSplitStrategy.top_1_lts, TrafficSplitStrategy.top_2_lts]):
+                if strategy in self.traffic_split_strategies:
+                    self.create_top_k_recommendation(strategy.value, rank_counts_lts, idx+1)
+                    traffic_split[strategy] = self.traffic_split[strategy.value]
 
         self.traffic_split_recommendation = {
-            TrafficSplitStrategy.progressive: self.traffic_split[1],
-            TrafficSplitStrategy.top_2: self.traffic_split[2],
-            TrafficSplitStrategy.uniform: self.traffic_split[len(self.detailed_versions)],
-            TrafficSplitStrategy.top_1_lts: self.traffic_split["top_1_lts"],
-            TrafficSplitStrategy.top_2_lts: self.traffic_split["top_2_lts"],
-            TrafficSplitStrategy.exp3: self.traffic_split["exp3"]
+            x: traffic_split[x] for x in TrafficSplitStrategy if x in traffic_split
         }
 
         self.apply_max_increment()
 
     def create_exp3_recommendation(self):
-        # init weights = [1.0] * numActions # REQ COUNT FROM self.new_counter_metrics,  REWARD = self.new_ratio_metrics VALUES FROM PREVIOUS ITERATION
-        # CALCULATE EFFECTIVE REWARD  self.eip.criteria HAS THE CONSTRAINTS
-        self.traffic_split["exp3"] = {}
-        logger.debug(f"Exp3 split")
-
-        def distr(weights, gamma=0.0):
-            distr = {}
-            theSum = 100 # actually 100 now ## float(sum(weights))
-            for version, w in weights.items():
-                distr[version] = (1.0 - gamma) * (w / theSum) + (gamma / len(weights))
-            return distr
-        if self.eip.last_state and self.eip.last_state.traffic_split_recommendation:
-            old_split = self.eip.last_state.traffic_split_recommendation
-            # get exp3 split, which are actually the weights
-            self.exp3_weights = old_split[TrafficSplitStrategy.exp3]
-
-        logger.debug(f"Weights now:{self.exp3_weights}, with len:{len(self.exp3_weights)}")
+        """Create traffic split using the exp3 algorithm. Weights are kept in log space, so that they neither overflow nor collapse over long experiments. The reward of a version is the latest value of the reward metric, or its pseudo reward if there is no reward metric. Rewards of versions which violate the threshold of any other criterion are zeroed.
+        """
+        trace.debug("Exp3 split")
+        version_ids = list(self.detailed_versions)
+        num_versions = len(version_ids)
+        log_weights = np.array([self.exp3_log_weights[version_id] for version_id in version_ids])
 
         gamma = self.eip.traffic_control.gamma
-        logger.debug(f"Gamma for exp3: {gamma}")
+        trace.debug("Gamma for exp3: %s", gamma)
 
-        probabilityDistribution = distr(self.exp3_weights, gamma)
-        logger.debug(f"probability dist: {probabilityDistribution}")
-        #theReward = reward(choice, t) # RATIO METRICS 
-        logger.debug(f"counter metrics: {self.new_counter_metrics}")
-        logger.debug(f"ratio metrics: {self.new_ratio_metrics}")
-        
-
-
-        for choice in probabilityDistribution:
-            logger.debug(f"req count {self.new_counter_metrics[choice][ITER8_REQUEST_COUNT].value}")
-            if self.new_counter_metrics[choice][ITER8_REQUEST_COUNT].value > 0:
-                theReward = self.new_ratio_metrics[choice][self.reward_metric_id].value
-
-                ### check constraint below: if constraint is not satisfied, decrease reward
-                for cri in self.eip.criteria:
-                    if not (cri.is_reward) and cri.threshold != None:
-                        if self.ratio_metric_specs[cri.metric_id].preferred_direction == DirectionEnum.lower and self.new_ratio_metrics[choice][cri.metric_id].value >= cri.threshold.value:
-                            theReward = 0
-                        elif self.ratio_metric_specs[cri.metric_id].preferred_direction == DirectionEnum.higher and self.new_ratio_metrics[choice][cri.metric_id].value <= cri.threshold.value:
-                            theReward = 0
-                logger.debug(f"Choice: {choice}, Reward {theReward} ")
-                estimatedReward = 1.0 * theReward / probabilityDistribution[choice]
-                # gamma = 0.01
-                self.exp3_weights[choice] *= math.exp(estimatedReward * gamma / len(self.exp3_weights)) # important that we use estimated reward here!
-                # constrained exp3 self.eip.criteria
-        logger.debug(f"Criteria: {self.eip.criteria}")
-
-        # a = {k: v / total for total in (sum(a.itervalues(), 0.0),) for k, v in a.iteritems()}
-        logger.debug(f"Weights now: {self.exp3_weights}")
-
-        total = sum(self.exp3_weights.values())
-        logger.debug(f"Total weights: {total}")
-        fractional_split_dict = {k: v / total for k, v in self.exp3_weights.items()}
-        # fractional_split = weights/sum(self.exp3_weights.values()) 
-
-        logger.debug(f"Fractional split dict: {fractional_split_dict}")
+        def to_float(x):
+            return np.nan if x is None else float(x)
 
-        fractional_split = pd.Series(fractional_split_dict)
+        # exp3 distribution mixes normalized weights with a uniform distribution
+        weights = np.exp(log_weights - np.max(log_weights))
+        probabilities = (1.0 - gamma) * weights / weights.sum() + gamma / num_versions
+        trace.debug("Probability distribution: %s", probabilities)
 
-        logger.debug(f"Fractional split: {fractional_split}") 
-
-        uniform_split = np.full(fractional_split.shape, 1.0 / len(self.detailed_versions))
-
-        logger.debug(f"Uniform split: {uniform_split}")
+        request_counts = np.array([to_float(self.new_counter_metrics[version_id][ITER8_REQUEST_COUNT].value) for version_id in version_ids])
+        if self.reward_metric_id is None:
+            rewards = np.array([self.detailed_versions[version_id].pseudo_reward for version_id in version_ids], dtype = float)
+        else:
+            rewards = np.array([to_float(self.new_ratio_metrics[version_id][self.reward_metric_id].value) for version_id in version_ids])
+
+        # (versions x criteria) matrix of threshold violations; versions violating any threshold get zero reward
+        criteria = [cri for cri in self.eip.criteria if not cri.is_reward and cri.threshold is not None and cri.metric_id in self.ratio_metric_specs]
+        if criteria:
+            values = np.array([[to_float(self.new_ratio_metrics[version_id][cri.metric_id].value) for cri in criteria] for version_id in version_ids])
+            thresholds = np.array([cri.threshold.value for cri in criteria])
+            lower_is_better = np.array([self.ratio_metric_specs[cri.metric_id].preferred_direction == DirectionEnum.lower for cri in criteria])
+            violations = np.where(lower_is_better, values >= thresholds, values <= thresholds)
+            trace.debug("Violations: %s", violations)
+            rewards[violations.any(axis = 1)] = 0.0
+        rewards[np.isnan(rewards)] = 0.0
+        trace.debug("Rewards: %s", rewards)
+
+        # weights of versions which received requests are updated with importance weighted rewards
+        served = request_counts > 0
+        log_weights[served] += gamma * rewards[served] / probabilities[served] / num_versions
+        # weights are relative, so log weights are shifted to keep the largest at zero
+        log_weights -= np.max(log_weights)
+        self.exp3_log_weights = dict(zip(version_ids, log_weights.tolist()))
+        trace.debug("Log weights now: %s", self.exp3_log_weights)
+
+        weights = np.exp(log_weights)
+        fractional_split = weights / weights.sum()
+        trace.debug("Fractional split: %s", fractional_split)
+
+        uniform_split = np.full(fractional_split.shape, 1.0 / num_versions)
 
         # exploration traffic fraction
         etf = AdvancedParameters.exploration_traffic_percentage / 100.0 
         mix_split = (uniform_split * etf) + (fractional_split * (1 - etf))
 
-        logger.debug(f"Mix split: {mix_split}")
+        trace.debug("Mix split: %s", mix_split)
 
         # round the mix split so that it sums up to 100
-        integral_split_gen = gen_round(mix_split * 100, 100)
-        for key in probabilityDistribution: # version
-            self.traffic_split["exp3"][key] = next(integral_split_gen)
- 
-
-
+        integral_split = round_weights(mix_split * 100, 100, self.rng).tolist()
+        self.traffic_split["exp3"] = dict(zip(version_ids, integral_split))
 
-    def create_top_k_recommendation(self, k, utilities, lts_index = -1):
+    def create_top_k_recommendation(self, k, rank_counts, lts_index = -1):
         """
-        Create traffic split using the top-k PBR algorithm and top-k LTS algorithm
+        Create traffic split using the top-k PBR algorithm and top-k LTS algorithm. rank_counts[r, v] is the number of samples in which version v has rank r.
         """
         self.traffic_split[k] = {}
 
-        logger.debug(f"Top k split with k = {k}")
+        trace.debug("Top k split with k = %s", k)
 
-        logger.debug("Utilities")
-        logger.debug(utilities.head())
+        trace.debug("Rank counts: %s", rank_counts)
 
         # get the fractional split
-        rank_df = utilities.rank(axis = 1, method = 'min', ascending = False)
-
-        logger.debug("Rank")
-        logger.debug(rank_df.head())
-
         # if lts_index != -1 then top-lts is employed 
         if lts_index == -1:
-            low_rank = rank_df <= k
+            counts = rank_counts[:k].sum(axis = 0)
         else:    
-            low_rank = rank_df <= lts_index
+            counts = rank_counts[:lts_index].sum(axis = 0)
 
-        logger.debug("Low rank")
-        logger.debug(low_rank.head())
+        fractional_split = counts / counts.sum()
 
-        fractional_split = low_rank.sum() / low_rank.sum().sum()
-
-        logger.debug(f"Fractional split: {fractional_split}")
+        trace.debug("Fractional split: %s", fractional_split)
         # logger.debug(f"Fractional split type: {type(fractional_split)}")
 
         uniform_split = np.full(fractional_split.shape, 1.0 / len(self.detailed_versions))
 
-        logger.debug(f"Uniform split: {uniform_split}")
+        trace.debug("Uniform split: %s", uniform_split)
 
         # exploration traffic fraction
         etf = AdvancedParameters.exploration_traffic_percentage / 100.0 
         mix_split = (uniform_split * etf) + (fractional_split * (1 - etf))
 
-        logger.debug(f"Mix split: {mix_split}")
+        trace.debug("Mix split: %s", mix_split)
 
         # round the mix split so that it sums up to 100
-        integral_split_gen = gen_round(mix_split * 100, 100)
-        for key in utilities:
-            self.traffic_split[k][key] = next(integral_split_gen)
+        integral_split = round_weights(mix_split * 100, 100, self.rng).tolist()
+        self.traffic_split[k] = dict(zip(self.version_ids, integral_split))
         
     def apply_max_increment(self):
         """Create the final traffic recommendations
         """
         # apply max_increment based traffic capping
 
-        # find the old split or initialize it to 100% baseline for all algos
+        # find the old split or initialize it to 100% baseline for algos absent from the last state
+        last_split = {}
         if self.eip.last_state and self.eip.last_state.traffic_split_recommendation:
-            old_split = self.eip.last_state.traffic_split_recommendation
-        else:
-            old_split = {
-                x: {
-                    y: 0 for y in self.detailed_versions
-                } for x in [TrafficSplitStrategy.progressive, TrafficSplitStrategy.top_2, TrafficSplitStrategy.uniform, TrafficSplitStrategy.top_1_lts, TrafficSplitStrategy.top_2_lts, TrafficSplitStrategy.exp3]
-            }
-            for x in old_split:
-                old_split[x][self.detailed_baseline_version.id] = 100
-
-        logger.debug("Current split before")
-        logger.debug(self.traffic_split_recommendation)
-
-                
-        for x in self.traffic_split_recommendation: # for each strategy
-            for y in self.detailed_candidate_versions: # for each candidate
-                increase = self.traffic_split_recommendation[x][y] - old_split[x][y]
-                excess = max(0, increase - self.eip.traffic_control.max_increment)
-                # cap increase and add it to baseline
-                self.traffic_split_recommendation[x][y] -= excess
-                self.traffic_split_recommendation[x][self.detailed_baseline_version.id] += excess
-
-        logger.debug("Old split")
-        logger.debug(old_split)
-
-        logger.debug("Current split after")
-        logger.debug(self.traffic_split_recommendation)
+            last_split = self.eip.last_state.traffic_split_recommendation
+        baseline_split = {
+            y: 0 for y in self.detailed_versions
+        }
+        baseline_split[self.detailed_baseline_version.id] = 100
+        old_split = {
+            x: last_split.get(x, baseline_split) for x in self.traffic_split_recommendation
+        }
+
+        trace.debug("Current split before: %s", self.traffic_split_recommendation)
+
+        # (strategies x versions) arrays of new and old splits
+        strategies = list(self.traffic_split_recommendation)
+        new_splits = np.array([[self.traffic_split_recommendation[x][y] for y in self.version_ids] for x in strategies], dtype = int)
+        old_splits = np.array([[old_split[x][y] for y in self.version_ids] for x in strategies], dtype = int)
+
+        # cap increase of candidates and add it to baseline
+        # splits are integral, so capping at the floor of max_increment is equivalent and keeps them integral
+        baseline_index = self.version_ids.index(self.detailed_baseline_version.id)
+        excess = np.maximum(0, new_splits - old_splits - math.floor(self.eip.traffic_control.max_increment))
+        excess[:, baseline_index] = 0
+        new_splits -= excess
+        new_splits[:, baseline_index] += excess.sum(axis = 1)
+
+        for x, split in zip(strategies, new_splits.tolist()):
+            self.traffic_split_recommendation[x] = dict(zip(self.version_ids, split))
+
+        trace.debug("Old split: %s", old_split)
+
+        trace.debug("Current split after: %s", self.traffic_split_recommendation)
         
 
     def assemble_assessment_and_recommendations(self):
@@ -541,7 +782,7 @@ class Experiment():
         else:
             min_posterior_probability_for_winner = AdvancedParameters.min_posterior_probability_for_winner
 
-        logger.debug(f"Minumum posterior probability: {min_posterior_probability_for_winner}")
+        trace.debug("Minumum posterior probability: %s", min_posterior_probability_for_winner)
 
         if probability_of_winning_for_best_version > min_posterior_probability_for_winner:
             wvf = True
@@ -552,9 +793,8 @@ class Experiment():
             probability_of_winning_for_best_version=probability_of_winning_for_best_version
         )
 
-        logger.debug("Winner assessment")
-        logger.debug(self.win_probababilities)
-        logger.debug(f"{(wvf, current_best_version, probability_of_winning_for_best_version)}")
+        trace.debug("Winner assessment: %s", self.win_probababilities)
+        trace.debug("Winning version found: %s Current best version: %s Probability of winning: %s", wvf, current_best_version, probability_of_winning_for_best_version)
 
         # get final assessment and response
         it8ar = Iter8AssessmentAndRecommendation(** {
@@ -564,11 +804,16 @@ class Experiment():
             "traffic_split_recommendation": self.traffic_split_recommendation,
             "winner_assessment": wa,
             "status": [],
+            "sampling": {
+                "sample_size": self.sample_size,
+                "standard_error": self.standard_error
+            },
             "last_state": {
                 "aggregated_counter_metrics": self.aggregated_counter_metrics,
                 "aggregated_ratio_metrics": self.get_aggregated_ratio_metrics(),
                 "ratio_max_mins": self.ratio_max_mins,
-                "traffic_split_recommendation": self.traffic_split_recommendation
+                "traffic_split_recommendation": self.traffic_split_recommendation,
+                "exp3_log_weights": self.exp3_log_weights
             }
         })
         return it8ar
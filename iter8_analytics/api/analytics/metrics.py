@@ -2,14 +2,17 @@
 """
 
 # core python dependencies
+import asyncio
 from datetime import datetime, timedelta, timezone
 from uuid import UUID
 from typing import Dict, Iterable, Any, Union
 import logging
-import requests
-from requests.auth import HTTPBasicAuth
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from string import Template
+from functools import lru_cache
 import math
+import re
 from pprint import pformat
 
 # external module dependencies
@@ -20,8 +23,12 @@ from fastapi import HTTPException
 from iter8_analytics.api.analytics.types import *
 import iter8_analytics.constants as constants
 from iter8_analytics.config import env_config
+from iter8_analytics.api.analytics.metricsbackend import get_metrics_backend
+from iter8_analytics.api.analytics.querycache import get_query_result_cache, get_single_flight
+from iter8_analytics.api.analytics.tracing import get_trace_logger, propagate_trace
 
 logger = logging.getLogger('iter8_analytics')
+trace = get_trace_logger()
 
 def new_ratio_max_min(metric_id_to_list_of_values: Dict[iter8id, Iterable[float]]):
     """Return min and max for each ratio metric
@@ -35,13 +42,11 @@ def new_ratio_max_min(metric_id_to_list_of_values: Dict[iter8id, Iterable[float]
     max_min_lists = {
         metric_id: [None, None] for metric_id in metric_id_to_list_of_values
     }
-    logger.debug("mert metricid")
-    logger.debug(metric_id_to_list_of_values)
     for metric_id in metric_id_to_list_of_values:
         try:
             max_min_lists[metric_id][0], max_min_lists[metric_id][1] = min(metric_id_to_list_of_values[metric_id]), max(metric_id_to_list_of_values[metric_id])
         except:
-            logger.debug("Empty list of values found for metric %s", metric_id)
+            trace.debug("Empty list of values found for metric %s", metric_id)
     
         max_min_lists[metric_id] = RatioMaxMin(
                 minimum = max_min_lists[metric_id][0],
@@ -52,47 +57,142 @@ def new_ratio_max_min(metric_id_to_list_of_values: Dict[iter8id, Iterable[float]
     
     return max_min_lists
 
-def get_counter_metrics(
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+def get_query_executor():
+    """Return the process-wide thread pool used to send queries to the metrics backend.
+
+    The pool is created lazily, and its size bounds the number of queries which are in flight at any point in time. The bound is configurable through the max_concurrent_queries field in the metricsBackend section of the config file. Further queries wait in the queue of the pool, however many iterations are in flight; the latency budget of an iteration's queries starts only once they leave this queue.
+
+    Returns:
+        executor (ThreadPoolExecutor): thread pool for backend queries
+    """
+    global _query_executor
+    if _query_executor is None:
+        with _query_executor_lock:
+            if _query_executor is None:
+                _query_executor = ThreadPoolExecutor(
+                    max_workers = env_config[constants.METRICS_BACKEND_CONFIG_MAX_CONCURRENT_QUERIES],
+                    thread_name_prefix = "iter8-metrics-query")
+    return _query_executor
+
+def run_query(metric_query):
+    """Run a single prometheus metric query. Meant to be executed within the query executor.
+
+    Args:
+        metric_query (PrometheusMetricQuery): metric query object
+
+    Returns:
+        a tuple (Tuple[datetime, Dict[str, DataPoint]]): time at which the query was made, along with the post processed query result
+    """
+    current_time = datetime.now(timezone.utc)
+    return current_time, metric_query.query_from_spec(current_time)
+
+def submit_counter_metric_queries(
     counter_metric_specs: Dict[iter8id, CounterMetricSpec], 
     versions: Iterable[Version], 
-    start_time) -> Dict[iter8id,  Dict[iter8id, CounterDataPoint]]:
-    """Query prometheus and get counter metric data for given set of counter metrics and versions.
+    start_time,
+    deadline = None) -> Dict[iter8id, Future]:
+    """Submit prometheus queries for the given set of counter metrics and versions to the query executor. All queries are sent concurrently.
 
     Args:
         counter_metric_specs (Dict[iter8id, CounterMetricSpec]): dictionary whose values are the counter metric specs and whose keys are counter metric ids.
         versions (Iterable[Version]): A iterable of version objects.
         start_time (datetime): start time which dictates the duration parameter used in the query.
+        deadline (QueryDeadline): deadline shared by the queries, which starts when the first of them starts running; each query gets the configured budget if this is None
 
     Returns:
-        Dict[iter8id,  Dict[iter8id, CounterDataPoint]]: dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are metric ids and values which are current counter data point values. For e.g.:
-        {
-            "version1": {
-                "metric1": CounterDataPoint(...),
-                "metric2": CounterDataPoint(...)
-            }, 
-            "version2": {
-                "metric1": CounterDataPoint(...),
-                "metric2": CounterDataPoint(...)
-            }
-        }      
+        Dict[iter8id, Future]: dictionary whose keys are counter metric ids and whose values are futures resolving to the output of run_query(...)
     """
-    cmd = {version.id: {} for version in versions} #  initialize cmd
-    # populate cmd
+    executor = get_query_executor()
+    futures = {}
+    futures_by_template = {} # counter metrics with identical templates share a single query
+    for counter_metric_spec in counter_metric_specs.values():
+        if counter_metric_spec.query_template not in futures_by_template:
+            futures_by_template[counter_metric_spec.query_template] = None
+    if env_config[constants.METRICS_BACKEND_CONFIG_BATCH_COUNTER_QUERIES]:
+        futures_by_template = submit_batched_counter_metric_queries(list(futures_by_template), versions, start_time, deadline)
+    else:
+        for query_template in futures_by_template:
+            query_spec = CounterQuerySpec(
+                version_label_keys = versions[0].version_labels.keys(),
+                query_template = query_template,
+                start_time = start_time
+            )
+            futures_by_template[query_template] = executor.submit(propagate_trace(run_query), PrometheusCounterMetricQuery(query_spec, versions, deadline))
     for counter_metric_spec in counter_metric_specs.values():
-        query_spec = CounterQuerySpec(
+        futures[counter_metric_spec.id] = futures_by_template[counter_metric_spec.query_template]
+    return futures
+
+def submit_batched_counter_metric_queries(
+    query_templates: Iterable[str], 
+    versions: Iterable[Version], 
+    start_time,
+    deadline = None) -> Dict[str, Future]:
+    """Submit counter metric query templates to the query executor, combining up to max_counter_queries_per_batch templates within a single prometheus query.
+
+    Args:
+        query_templates (Iterable[str]): distinct counter query templates
+        versions (Iterable[Version]): A iterable of version objects.
+        start_time (datetime): start time which dictates the duration parameter used in the query.
+        deadline (QueryDeadline): deadline shared by the queries, which starts when the first of them starts running; each query gets the configured budget if this is None
+
+    Returns:
+        Dict[str, Future]: dictionary whose keys are query templates and whose values are futures resolving to a tuple (time of query, post processed query result for the template)
+    """
+    executor = get_query_executor()
+    batch_size = max(1, env_config[constants.METRICS_BACKEND_CONFIG_MAX_COUNTER_QUERIES_PER_BATCH])
+    futures = {}
+    for start in range(0, len(query_templates), batch_size):
+        batch = query_templates[start: start + batch_size]
+        query_spec = BatchedCounterQuerySpec(
             version_label_keys = versions[0].version_labels.keys(),
-            query_template = counter_metric_spec.query_template,
+            query_templates = {str(index): query_template for index, query_template in enumerate(batch)},
             start_time = start_time
         )
-        pcmq = PrometheusCounterMetricQuery(query_spec, versions)
-        current_time = datetime.now(timezone.utc)
-        cmd_from_prom = pcmq.query_from_spec(current_time)
+        batch_future = executor.submit(propagate_trace(run_query), PrometheusBatchedCounterMetricQuery(query_spec, versions, deadline))
+        template_futures = {str(index): Future() for index in range(len(batch))}
+
+        def demultiplex(done_future, template_futures = template_futures):
+            """Resolve the per-template futures once the batched query is done"""
+            try:
+                current_time, results = done_future.result()
+                template_results = {index: (current_time, results[index]) for index in template_futures}
+            except Exception as e:
+                for template_future in template_futures.values():
+                    template_future.set_exception(e)
+                return
+            for index, template_future in template_futures.items():
+                template_future.set_result(template_results[index])
+
+        batch_future.add_done_callback(demultiplex)
+        for index, query_template in enumerate(batch):
+            futures[query_template] = template_futures[str(index)]
+    return futures
+
+def collect_counter_metrics(
+    counter_metric_futures: Dict[iter8id, Future], 
+    versions: Iterable[Version]) -> Dict[iter8id,  Dict[iter8id, CounterDataPoint]]:
+    """Wait for counter metric queries submitted by submit_counter_metric_queries(...) and assemble their results.
+
+    Args:
+        counter_metric_futures (Dict[iter8id, Future]): dictionary whose keys are counter metric ids and whose values are futures for their queries.
+        versions (Iterable[Version]): A iterable of version objects.
+
+    Returns:
+        Dict[iter8id,  Dict[iter8id, CounterDataPoint]]: dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are metric ids and values which are current counter data point values.
+    """
+    cmd = {version.id: {} for version in versions} #  initialize cmd
+    # populate cmd
+    for metric_id, future in counter_metric_futures.items():
+        current_time, cmd_from_prom = future.result()
         status = StatusEnum.zeroed_counter if cmd_from_prom else StatusEnum.no_versions_in_prom_response
         for version in versions:
             if version.id in cmd_from_prom:
-                cmd[version.id][counter_metric_spec.id] = cmd_from_prom[version.id]
+                cmd[version.id][metric_id] = cmd_from_prom[version.id]
             else:
-                cmd[version.id][counter_metric_spec.id] = CounterDataPoint(
+                cmd[version.id][metric_id] = CounterDataPoint(
                     value = 0,
                     timestamp = current_time,
                     status = status
@@ -102,37 +202,74 @@ def get_counter_metrics(
         
     return cmd
 
-def get_ratio_metrics(
-    ratio_metric_specs: Dict[iter8id, RatioMetricSpec], 
+async def wait_for_queries(*futures: Dict[Any, Future]):
+    """Wait for queries submitted to the query executor without blocking the event loop. Only the query executor's threads wait on the metrics backend, so any number of coroutines can wait on their queries concurrently.
+
+    Args:
+        futures (Dict[Any, Future]): dictionaries whose values are futures for submitted queries, such as those returned by submit_counter_metric_queries(...)
+    """
+    pending = {future for query_futures in futures for future in query_futures.values()}
+    if pending:
+        await asyncio.wait([asyncio.wrap_future(future) for future in pending])
+
+def get_counter_metrics(
     counter_metric_specs: Dict[iter8id, CounterMetricSpec], 
-    counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]], 
-    versions: Iterable[Version],
-    start_time: datetime) -> Dict[iter8id,  Dict[iter8id, RatioDataPoint]]:
-    """Query prometheus and get ratio metric data for given set of ratio metrics and versions.
+    versions: Iterable[Version], 
+    start_time) -> Dict[iter8id,  Dict[iter8id, CounterDataPoint]]:
+    """Query prometheus and get counter metric data for given set of counter metrics and versions.
 
     Args:
-        ratio_metric_specs (Dict[iter8id, RatioMetricSpec]): dictionary whose values are the ratio metric specs and whose keys are ratio metric ids
         counter_metric_specs (Dict[iter8id, CounterMetricSpec]): dictionary whose values are the counter metric specs and whose keys are counter metric ids.
-        counter_metrics (Dict[iter8id,  Dict[iter8id, CounterDataPoint]]): dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are  metric ids and values which are current counter data point values. Typically, the object returned by get_counter_metrics(...) method will be used as the value of this argument.
         versions (Iterable[Version]): A iterable of version objects.
         start_time (datetime): start time which dictates the duration parameter used in the query.
 
     Returns:
-        Dict[iter8id,  Dict[iter8id, RatioDataPoint]]: dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are metric ids and values which are current ratio data point values. For e.g.:
+        Dict[iter8id,  Dict[iter8id, CounterDataPoint]]: dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are metric ids and values which are current counter data point values. For e.g.:
         {
             "version1": {
-                "metric1": RatioDataPoint(...),
-                "metric2": RatioDataPoint(...)
+                "metric1": CounterDataPoint(...),
+                "metric2": CounterDataPoint(...)
             }, 
             "version2": {
-                "metric1": RatioDataPoint(...),
-                "metric2": RatioDataPoint(...)
+                "metric1": CounterDataPoint(...),
+                "metric2": CounterDataPoint(...)
             }
         }      
     """
-    rmd = {version.id: {} for version in versions} #  initialize rmd
+    return collect_counter_metrics(
+        submit_counter_metric_queries(counter_metric_specs, versions, start_time), 
+        versions)
 
-    # populate rmd
+async def get_counter_metrics_async(
+    counter_metric_specs: Dict[iter8id, CounterMetricSpec], 
+    versions: Iterable[Version], 
+    start_time) -> Dict[iter8id,  Dict[iter8id, CounterDataPoint]]:
+    """Query prometheus and get counter metric data for given set of counter metrics and versions, without blocking the event loop. Arguments and result are the same as those of get_counter_metrics(...).
+    """
+    counter_metric_futures = submit_counter_metric_queries(counter_metric_specs, versions, start_time)
+    await wait_for_queries(counter_metric_futures)
+    return collect_counter_metrics(counter_metric_futures, versions)
+
+def submit_ratio_metric_queries(
+    ratio_metric_specs: Dict[iter8id, RatioMetricSpec], 
+    counter_metric_specs: Dict[iter8id, CounterMetricSpec], 
+    versions: Iterable[Version],
+    start_time: datetime,
+    deadline = None) -> Dict[iter8id, Future]:
+    """Submit prometheus queries for the given set of ratio metrics and versions to the query executor. All queries are sent concurrently.
+
+    Args:
+        ratio_metric_specs (Dict[iter8id, RatioMetricSpec]): dictionary whose values are the ratio metric specs and whose keys are ratio metric ids
+        counter_metric_specs (Dict[iter8id, CounterMetricSpec]): dictionary whose values are the counter metric specs and whose keys are counter metric ids.
+        versions (Iterable[Version]): A iterable of version objects.
+        start_time (datetime): start time which dictates the duration parameter used in the query.
+        deadline (QueryDeadline): deadline shared by the queries, which starts when the first of them starts running; each query gets the configured budget if this is None
+
+    Returns:
+        Dict[iter8id, Future]: dictionary whose keys are ratio metric ids and whose values are futures resolving to the output of run_query(...)
+    """
+    executor = get_query_executor()
+    futures = {}
     for ratio_metric_spec in ratio_metric_specs.values():
         query_spec = RatioQuerySpec(
             version_label_keys = versions[0].version_labels.keys(),
@@ -140,14 +277,105 @@ def get_ratio_metrics(
             denominator_template = counter_metric_specs[ratio_metric_spec.denominator].query_template,
             start_time = start_time
         )
-        prmq = PrometheusRatioMetricQuery(query_spec, versions)
-        current_time = datetime.now(timezone.utc)
-        rmd_from_prom = prmq.query_from_spec(current_time)
+        futures[ratio_metric_spec.id] = executor.submit(propagate_trace(run_query), PrometheusRatioMetricQuery(query_spec, versions, deadline))
+    return futures
+
+def get_server_side_ratio_metric_specs(
+    ratio_metric_specs: Dict[iter8id, RatioMetricSpec], 
+    counter_metric_specs: Dict[iter8id, CounterMetricSpec]) -> Dict[iter8id, RatioMetricSpec]:
+    """Get the ratio metrics which need to be queried from prometheus. Ratio metrics whose numerator and denominator are among the counter metrics being queried are derived locally from counter metric values, unless ratios_from_counters is turned off in the metricsBackend section of the config file.
+
+    Args:
+        ratio_metric_specs (Dict[iter8id, RatioMetricSpec]): dictionary whose values are the ratio metric specs and whose keys are ratio metric ids
+        counter_metric_specs (Dict[iter8id, CounterMetricSpec]): dictionary whose values are the specs of counter metrics being queried and whose keys are counter metric ids.
+
+    Returns:
+        Dict[iter8id, RatioMetricSpec]: subset of ratio_metric_specs which cannot be derived from counter metrics
+    """
+    if not env_config[constants.METRICS_BACKEND_CONFIG_RATIOS_FROM_COUNTERS]:
+        return ratio_metric_specs
+    return {
+        metric_id: rms for metric_id, rms in ratio_metric_specs.items() if not (rms.numerator in counter_metric_specs and rms.denominator in counter_metric_specs)
+    }
+
+def ratio_data_point(result_float: float, ts: datetime) -> RatioDataPoint:
+    """Convert a float ratio value to RatioDataPoint
+
+    Args:
+        result_float (float): ratio value
+        ts (datetime): time stamp at which the value was queried
+
+    Returns:
+        ratio_data_point (RatioDataPoint): Ratio data point
+    """
+    return RatioDataPoint(
+        value = None,
+        timestamp = ts,
+        status = StatusEnum.nan_value
+    ) if math.isnan(result_float) or math.isinf(result_float) else RatioDataPoint(
+        value = result_float,
+        timestamp = ts
+    )
+
+def derive_ratio_metric(
+    ratio_metric_spec: RatioMetricSpec,
+    new_counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]], 
+    versions: Iterable[Version]) -> Dict[iter8id, RatioDataPoint]:
+    """Derive ratio metric data from counter metric data, the same way prometheus evaluates (numerator) / (denominator).
+
+    Args:
+        ratio_metric_spec (RatioMetricSpec): ratio metric spec
+        new_counter_metrics (Dict[iter8id,  Dict[iter8id, CounterDataPoint]]): dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are metric ids and values which are current counter data point values. Typically, the object returned by get_counter_metrics(...) method will be used as the value of this argument.
+        versions (Iterable[Version]): A iterable of version objects.
+
+    Returns:
+        Dict[iter8id, RatioDataPoint]: dictionary mapping version ids to ratio data points. Like a post processed prometheus result, versions for which either the numerator or the denominator is absent in the prometheus response are absent here.
+    """
+    rmd = {}
+    for version in versions:
+        num = new_counter_metrics[version.id][ratio_metric_spec.numerator]
+        den = new_counter_metrics[version.id][ratio_metric_spec.denominator]
+        if num.status == StatusEnum.all_ok and den.status == StatusEnum.all_ok:
+            if den.value == 0:
+                result_float = math.nan if num.value == 0 else math.inf
+            else:
+                result_float = num.value / den.value
+            rmd[version.id] = ratio_data_point(result_float, max(num.timestamp, den.timestamp))
+    return rmd
+
+def collect_ratio_metrics(
+    ratio_metric_specs: Dict[iter8id, RatioMetricSpec], 
+    ratio_metric_futures: Dict[iter8id, Future], 
+    counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]], 
+    versions: Iterable[Version],
+    new_counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]] = None) -> Dict[iter8id,  Dict[iter8id, RatioDataPoint]]:
+    """Wait for ratio metric queries submitted by submit_ratio_metric_queries(...) and assemble their results. Ratio metrics without a submitted query are derived from new_counter_metrics.
+
+    Args:
+        ratio_metric_specs (Dict[iter8id, RatioMetricSpec]): dictionary whose values are the ratio metric specs and whose keys are ratio metric ids
+        ratio_metric_futures (Dict[iter8id, Future]): dictionary whose keys are ratio metric ids and whose values are futures for their queries.
+        counter_metrics (Dict[iter8id,  Dict[iter8id, CounterDataPoint]]): dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are  metric ids and values which are current counter data point values.
+        versions (Iterable[Version]): A iterable of version objects.
+        new_counter_metrics (Dict[iter8id,  Dict[iter8id, CounterDataPoint]]): counter metric data from this iteration, as returned by collect_counter_metrics(...). Needed only for ratio metrics without a submitted query.
+
+    Returns:
+        Dict[iter8id,  Dict[iter8id, RatioDataPoint]]: dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are metric ids and values which are current ratio data point values.
+    """
+    rmd = {version.id: {} for version in versions} #  initialize rmd
+
+    # populate rmd
+    for ratio_metric_spec in ratio_metric_specs.values():
+        if ratio_metric_spec.id in ratio_metric_futures:
+            current_time, rmd_from_prom = ratio_metric_futures[ratio_metric_spec.id].result()
+        else:
+            rmd_from_prom = derive_ratio_metric(ratio_metric_spec, new_counter_metrics, versions)
 
         for version in versions:
             if version.id in rmd_from_prom:
                 rmd[version.id][ratio_metric_spec.id] = rmd_from_prom[version.id]
             else:
+                if ratio_metric_spec.id not in ratio_metric_futures:
+                    current_time = new_counter_metrics[version.id][ratio_metric_spec.denominator].timestamp
                 if version.id in counter_metrics and counter_metrics[version.id][ratio_metric_spec.denominator].value:
                     rmd[version.id][ratio_metric_spec.id] = RatioDataPoint(
                         value = 0,
@@ -165,34 +393,179 @@ def get_ratio_metrics(
 
     return rmd
 
+def get_ratio_metrics(
+    ratio_metric_specs: Dict[iter8id, RatioMetricSpec], 
+    counter_metric_specs: Dict[iter8id, CounterMetricSpec], 
+    counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]], 
+    versions: Iterable[Version],
+    start_time: datetime) -> Dict[iter8id,  Dict[iter8id, RatioDataPoint]]:
+    """Query prometheus and get ratio metric data for given set of ratio metrics and versions.
+
+    Args:
+        ratio_metric_specs (Dict[iter8id, RatioMetricSpec]): dictionary whose values are the ratio metric specs and whose keys are ratio metric ids
+        counter_metric_specs (Dict[iter8id, CounterMetricSpec]): dictionary whose values are the counter metric specs and whose keys are counter metric ids.
+        counter_metrics (Dict[iter8id,  Dict[iter8id, CounterDataPoint]]): dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are  metric ids and values which are current counter data point values. Typically, the object returned by get_counter_metrics(...) method will be used as the value of this argument.
+        versions (Iterable[Version]): A iterable of version objects.
+        start_time (datetime): start time which dictates the duration parameter used in the query.
+
+    Returns:
+        Dict[iter8id,  Dict[iter8id, RatioDataPoint]]: dictionary whose keys are version ids and whose values are dictionaries. The inner dictionary has keys which are metric ids and values which are current ratio data point values. For e.g.:
+        {
+            "version1": {
+                "metric1": RatioDataPoint(...),
+                "metric2": RatioDataPoint(...)
+            }, 
+            "version2": {
+                "metric1": RatioDataPoint(...),
+                "metric2": RatioDataPoint(...)
+            }
+        }      
+    """
+    return collect_ratio_metrics(
+        ratio_metric_specs,
+        submit_ratio_metric_queries(ratio_metric_specs, counter_metric_specs, versions, start_time),
+        counter_metrics,
+        versions)
+
+async def get_ratio_metrics_async(
+    ratio_metric_specs: Dict[iter8id, RatioMetricSpec], 
+    counter_metric_specs: Dict[iter8id, CounterMetricSpec], 
+    counter_metrics: Dict[iter8id,  Dict[iter8id, CounterDataPoint]], 
+    versions: Iterable[Version],
+    start_time: datetime) -> Dict[iter8id,  Dict[iter8id, RatioDataPoint]]:
+    """Query prometheus and get ratio metric data for given set of ratio metrics and versions, without blocking the event loop. Arguments and result are the same as those of get_ratio_metrics(...).
+    """
+    ratio_metric_futures = submit_ratio_metric_queries(ratio_metric_specs, counter_metric_specs, versions, start_time)
+    await wait_for_queries(ratio_metric_futures)
+    return collect_ratio_metrics(ratio_metric_specs, ratio_metric_futures, counter_metrics, versions)
+
+QUERY_TEMPLATE_VARIABLES = frozenset(["interval", "version_labels", "version_label_matchers"])
+
+class CompiledQueryTemplate():
+    """Query template compiled into alternating literal text and template variables, so that queries can be rendered without re-parsing the template. $version_labels is resolved at compile time.
+
+    Attributes:
+        parts (Tuple[Tuple[str, str]]): pairs of literal text and the name of the template variable following it
+        trailer (str): literal text following the last template variable
+    """
+    def __init__(self, query_template, version_label_keys):
+        """Compile a query template.
+
+        Args:
+            query_template (str): query template
+            version_label_keys (Tuple[str]): prometheus label names used for grouping
+
+        Raises:
+            HTTPException: if the template contains invalid placeholders or unknown template variables
+        """
+        parts = []
+        literal = []
+        position = 0
+        for match in Template.pattern.finditer(query_template):
+            literal.append(query_template[position: match.start()])
+            position = match.end()
+            name = match.group("named") or match.group("braced")
+            if match.group("escaped") is not None:
+                literal.append(Template.delimiter)
+            elif name == "version_labels":
+                literal.append(",".join(version_label_keys))
+            elif name in QUERY_TEMPLATE_VARIABLES:
+                parts.append(("".join(literal), name))
+                literal = []
+            else:
+                placeholder = query_template[match.start(): match.end()]
+                logger.error(f"Invalid placeholder {placeholder} in query template: {query_template}")
+                raise HTTPException(status_code = 422, detail = f"{StatusEnum.invalid_query_template.value}: invalid placeholder {placeholder} in {query_template}")
+        literal.append(query_template[position:])
+        self.parts = tuple(parts)
+        self.trailer = "".join(literal)
+
+    def render(self, query_args):
+        """Render query from compiled template.
+
+        Args:
+            query_args (Dict[str, str]): Dictionary of values of template variables
+
+        Returns:
+            query (str): The query string used for querying prom
+        """
+        return "".join([literal + query_args[name] for literal, name in self.parts]) + self.trailer
+
+@lru_cache(maxsize = 1024)
+def compile_query_template(query_template, version_label_keys):
+    """Get the compiled form of a query template. Compiled templates are cached for the lifetime of the process.
+
+    Args:
+        query_template (str): query template
+        version_label_keys (Tuple[str]): prometheus label names used for grouping
+
+    Returns:
+        compiled_template (CompiledQueryTemplate): compiled query template
+
+    Raises:
+        HTTPException: if the template contains invalid placeholders or unknown template variables
+    """
+    return CompiledQueryTemplate(query_template, version_label_keys)
+
+def escape_label_value(value):
+    """Escape a string for use as a label value within a PromQL label matcher.
+
+    Args:
+        value (str): label value
+
+    Returns:
+        escaped_value (str): escaped label value
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def get_version_label_matchers(version_label_keys, versions):
+    """Get PromQL label matchers which select the series of the given versions. These are available to query templates as $version_label_matchers, so that prometheus can skip series which do not belong to any version, e.g., "sum(increase(istio_requests_total{reporter='source',$version_label_matchers}[$interval])) by ($version_labels)".
+
+    Args:
+        version_label_keys (Iterable[str]): prometheus label names used for grouping
+        versions (Iterable[Version]): Iterable of Version objects
+
+    Returns:
+        matchers (str): comma separated label matchers; a superset of the series of the versions is selected when versions differ in more than one label
+    """
+    versions = list(versions)
+    matchers = []
+    for key in version_label_keys:
+        if not versions or any(key not in version.version_labels for version in versions):
+            continue
+        values = sorted(set(version.version_labels[key] for version in versions))
+        if len(values) == 1:
+            matchers.append(f'{key}="{escape_label_value(values[0])}"')
+        else:
+            regex = "|".join(re.escape(value) for value in values)
+            matchers.append(f'{key}=~"{escape_label_value(regex)}"')
+    return ",".join(matchers)
+
 class PrometheusMetricQuery():
     """Base class for querying prometheus.
 
     Attributes:
-        prometheus_url (str): Prom url for quering
         query_spec (QuerySpec): Query spec for prom query
         version_labels_to_id (Dict[Set[Tuple[str, str]], str]): Dictionary mapping version labels to their ids
+        deadline (QueryDeadline): deadline for the query, or None
     """
-    def __init__(self, query_spec, versions):
+    def __init__(self, query_spec, versions, deadline = None):
         """Initialize prometheus metric query object.
 
         Args:
             query_spec (QuerySpec): Prom query spec
             versions (Iterable[Version]): Iterable of Version objects.
+            deadline (QueryDeadline): deadline for the query, including retries, which starts when the query starts running; the query gets the configured budget if this is None
         """
-        prometheus_url = env_config[constants.METRICS_BACKEND_CONFIG_URL]
-        self.prometheus_url = prometheus_url + "/api/v1/query"
         self.query_spec = query_spec
-        self.authentication = {
-            constants.METRICS_BACKEND_CONFIG_AUTH_TYPE: constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE,
-        }
-        if constants.METRICS_BACKEND_CONFIG_AUTH in env_config:
-            self.authentication = env_config[constants.METRICS_BACKEND_CONFIG_AUTH]
+        self.deadline = deadline
         self.version_labels_to_id = {
             frozenset(version.version_labels.items()): version.id for version in versions
         }
         """the above frozenset maps from version labels to version ids
         """
+        self.version_label_keys = tuple(query_spec.version_label_keys)
+        self.version_label_matchers = get_version_label_matchers(self.version_label_keys, versions)
 
     def query_from_spec(self, current_time):
         """Query prometheus using query spec.
@@ -203,9 +576,16 @@ class PrometheusMetricQuery():
         Returns:
             query_result (Dict[str, Dict[str, DataPoint]]]): Post processed query result
         """
+        query_result_cache = get_query_result_cache()
+        if query_result_cache:
+            # align evaluation time so that identical queries from different experiments share cache entries
+            alignment = env_config[constants.METRICS_BACKEND_CONFIG_QUERY_TIME_ALIGNMENT]
+            if alignment > 0:
+                current_time = datetime.fromtimestamp(math.floor(current_time.timestamp() / alignment) * alignment, timezone.utc)
+
         interval = int((current_time - self.query_spec.start_time).total_seconds())
         if interval < 20.0: # less than twenty seconds has elapsed since start of the experiment
-            logger.debug("Less than 20 seconds have elapsed since the start of the experiment")
+            trace.debug("Less than 20 seconds have elapsed since the start of the experiment")
             return self.post_process({
                 "status": "success", 
                 "data": {
@@ -216,8 +596,8 @@ class PrometheusMetricQuery():
 
         kwargs = {
             "interval": f"{interval}s",
-            "version_labels": ",".join(self.query_spec.version_label_keys) # also hard coded
-        }
+            "version_label_matchers": self.version_label_matchers
+        } # $version_labels is resolved when templates are compiled
         query = self.get_query(kwargs)
         return self.query(query, current_time)
 
@@ -234,24 +614,30 @@ class PrometheusMetricQuery():
             Exception: HTTP connection errors related to prom requests.
         """
         params = {'query': query}
-        auth_type = self.authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_TYPE)
-        logger.debug(f"authentication type is: {auth_type}")
+        deadline = self.deadline.start() if self.deadline is not None else None
         try:
-            query_result = None
-            if auth_type == constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE:
-                query_result = requests.get(self.prometheus_url, params=params).json()
-            elif auth_type == constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC:
-                auth=HTTPBasicAuth(
-                    self.authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_USERNAME), 
-                    self.authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_PASSWORD)
-                )
-                verify = (not self.authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_INSECURE_SKIP_VERIFY))
-                query_result = requests.get(self.prometheus_url, params=params, auth=auth, verify=verify).json()
+            backend = get_metrics_backend()
+            query_result_cache = get_query_result_cache()
+            single_flight = get_single_flight()
+            if query_result_cache:
+                params['time'] = current_time.timestamp()
+            # series not belonging to any version are dropped while the response is parsed, so the result depends on versions
+            key = (query, backend.query_url, params.get('time'), frozenset(self.version_labels_to_id))
+
+            def query_backend():
+                # identical queries in flight are sent to prometheus only once
+                if single_flight:
+                    return single_flight.do(key, lambda: backend.query(params, self.keep_series, deadline))
+                return backend.query(params, self.keep_series, deadline)
+
+            if query_result_cache:
+                query_result = query_result_cache.get_or_query(
+                    key,
+                    query_backend,
+                    cacheable = lambda result: result.get("status") == "success")
             else:
-                logger.warning(f"Unsupported authentication type: {auth_type}; trying {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE}")
-                query_result = requests.get(self.prometheus_url, params=params).json()
-            logger.debug("query result -- raw")
-            logger.debug(query_result)
+                query_result = query_backend()
+            trace.debug("query result -- raw: %s", query_result)
         except Exception as e:
             logger.error("Error while attempting to connect to prometheus")
             raise HTTPException(status_code=422, detail="Error while attempting to connect to prometheus.")
@@ -285,14 +671,38 @@ class PrometheusMetricQuery():
         elif raw_query_result["data"]['resultType'] != 'vector':
             return HTTPException(status_code=422, detail="Query succeeded but returned with a non-vector result. Check your query template.")
         else: # query succeeded and we have some proper data to work with
-            results = raw_query_result["data"]["result"]
-            for result in results:
-                version_id = self.get_version_id(result['metric'])
-                if version_id:
-                    prom_result[version_id] = self.result_value_to_data_point(result['value'][1], ts)
+            prom_result = self.process_results(raw_query_result["data"]["result"], ts)
 
         return prom_result
 
+    def process_results(self, results, ts):
+        """Convert the series within a successful prom vector result into data points
+
+        Args:
+            results (Sequence[Dict]): series within the raw prometheus result
+            ts (datetime): time stamp at which prom query was made
+
+        Returns:
+            query_result (Dict[str, DataPoint]): dictionary mapping version ids to data points
+        """
+        prom_result = {}
+        for result in results:
+            version_id = self.get_version_id(result['metric'])
+            if version_id:
+                prom_result[version_id] = self.result_value_to_data_point(result['value'][1], ts)
+        return prom_result
+
+    def keep_series(self, series_labels):
+        """Check if a series within the prom result belongs to one of the versions. Other series are dropped while the prom response is parsed.
+
+        Args:
+            series_labels (Dict[str, str]): labels of the series
+
+        Returns:
+            keep (bool): True if the series belongs to a version
+        """
+        return self.get_version_id(series_labels) is not None
+
     def get_version_id(self, version_labels):
         """Get version id from version labels.
 
@@ -318,9 +728,8 @@ class PrometheusCounterMetricQuery(PrometheusMetricQuery):
             query (str): The query string used for querying prom
         """
 
-        query_template = Template(self.query_spec.query_template)
-        query = query_template.substitute(**query_args)
-        logger.debug(f"Query: {query}")
+        query = compile_query_template(self.query_spec.query_template, self.version_label_keys).render(query_args)
+        trace.debug("Query: %s", query)
         return query
 
     def result_value_to_data_point(self, result_value: str, ts: datetime) -> CounterDataPoint:
@@ -354,12 +763,10 @@ class PrometheusRatioMetricQuery(PrometheusMetricQuery):
         Returns:
             query (str): The query string used for querying prom
         """
-        num_query_template = Template(self.query_spec.numerator_template)
-        num_query = num_query_template.substitute(**query_args)
-        den_query_template = Template(self.query_spec.denominator_template)
-        den_query = den_query_template.substitute(**query_args)
+        num_query = compile_query_template(self.query_spec.numerator_template, self.version_label_keys).render(query_args)
+        den_query = compile_query_template(self.query_spec.denominator_template, self.version_label_keys).render(query_args)
         query = f"({num_query}) / ({den_query})"
-        logger.debug(f"Query: {query}")
+        trace.debug("Query: %s", query)
         return query
 
     def result_value_to_data_point(self, result_value: str, ts: datetime) -> RatioDataPoint:
@@ -373,12 +780,59 @@ class PrometheusRatioMetricQuery(PrometheusMetricQuery):
             ratio_data_point (RatioDataPoint): Ratio data point
         """
 
-        result_float = float(result_value)
-        return RatioDataPoint(
-            value = None,
-            timestamp = ts,
-            status = StatusEnum.nan_value
-        ) if math.isnan(result_float) or math.isinf(result_float) else RatioDataPoint(
-            value = result_float,
-            timestamp = ts
-        )
\ No newline at end of file
+        return ratio_data_point(float(result_value), ts)
+
+class PrometheusBatchedCounterMetricQuery(PrometheusCounterMetricQuery):
+    """Derived class for querying prometheus for several counter metrics within a single query. Each counter query is tagged with a synthetic label identifying its metric, and the tagged queries are combined using the 'or' operator. The vector result is demultiplexed into per-metric results during post processing.
+    """
+    def get_query(self, query_args):
+        """Extrapolate the combined query from batched counter query spec and query_args
+
+        Args:
+            query_args (Dict[str, str]): Dictionary of values of template variables in the query templates
+
+        Returns:
+            query (str): The query string used for querying prom
+        """
+        sub_queries = []
+        for metric_id, query_template in self.query_spec.query_templates.items():
+            sub_query = compile_query_template(query_template, self.version_label_keys).render(query_args)
+            tag = str(metric_id).replace('\\', '\\\\').replace('"', '\\"').replace('$', '$$')
+            sub_queries.append(f'label_replace({sub_query}, "{constants.ITER8_METRIC_LABEL}", "{tag}", "", "")')
+        query = " or ".join(sub_queries)
+        trace.debug("Query: %s", query)
+        return query
+
+    def keep_series(self, series_labels):
+        """Check if a series within the combined prom result belongs to one of the versions.
+
+        Args:
+            series_labels (Dict[str, str]): labels of the series, including the synthetic metric label
+
+        Returns:
+            keep (bool): True if the series belongs to a version
+        """
+        labels = dict(series_labels)
+        labels.pop(constants.ITER8_METRIC_LABEL, None)
+        return self.get_version_id(labels) is not None
+
+    def process_results(self, results, ts):
+        """Demultiplex the series within a successful prom vector result into per-metric data points
+
+        Args:
+            results (Sequence[Dict]): series within the raw prometheus result
+            ts (datetime): time stamp at which prom query was made
+
+        Returns:
+            query_result (Dict[str, Dict[str, CounterDataPoint]]): dictionary whose keys are metric ids and whose values are dictionaries mapping version ids to data points
+        """
+        metric_ids = {str(metric_id): metric_id for metric_id in self.query_spec.query_templates}
+        prom_result = {metric_id: {} for metric_id in self.query_spec.query_templates}
+        for result in results:
+            labels = dict(result['metric'])
+            metric_id = metric_ids.get(labels.pop(constants.ITER8_METRIC_LABEL, None), None)
+            if metric_id is not None:
+                version_id = self.get_version_id(labels)
+                if version_id:
+                    prom_result[metric_id][version_id] = self.result_value_to_data_point(result['value'][1], ts)
+        return prom_result
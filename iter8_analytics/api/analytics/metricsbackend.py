@@ -0,0 +1,557 @@
+"""Module containing the backends used for querying metrics: the long-lived HTTP client for the backend metrics server (prometheus), along with backends which record and replay prometheus responses for offline load testing.
+"""
+
+# core python dependencies
+import codecs
+import gzip
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# external module dependencies
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+# iter8 dependencies
+import iter8_analytics.constants as constants
+from iter8_analytics.config import env_config
+
+logger = logging.getLogger('iter8_analytics')
+
+RESULT_ARRAY_START = re.compile(r'"result"\s*:\s*\[')
+QUERY_DURATION = re.compile(r'\[\d+s\]')
+SERIES_RESULT_TYPE = re.compile(r'"resultType"\s*:\s*"(vector|matrix)"')
+RESPONSE_CHUNK_SIZE = 64 * 1024
+LATENCY_WINDOW = 256 # number of recent query latencies from which the hedging delay is computed
+MIN_LATENCY_SAMPLES = 20 # number of query latencies needed before requests are hedged
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.HTTPError, requests.exceptions.ChunkedEncodingError)
+
+def parse_query_response(chunks, keep_series = None):
+    """Parse a prometheus query response incrementally. Series within the result array are decoded one at a time, and those rejected by keep_series are dropped right away, so that memory does not grow with the number of series which prometheus returns.
+
+    Args:
+        chunks (Iterable[bytes]): UTF-8 encoded response body
+        keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series should be kept, given its labels; all series are kept if this is None
+
+    Returns:
+        query_result (Dict): raw prometheus result, with the kept series alone in its result array
+
+    Raises:
+        ValueError: if the response body is not valid JSON
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    head = None # response body up to and including the opening bracket of the result array
+    remaining_as_is = False # True once the rest of the response body needs no incremental parsing
+    kept = []
+
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        if remaining_as_is:
+            continue
+        if head is None:
+            match = RESULT_ARRAY_START.search(buffer)
+            if match is None:
+                continue
+            if not SERIES_RESULT_TYPE.search(buffer, 0, match.start()):
+                remaining_as_is = True # result is not a list of series; parse it as a whole
+                continue
+            head, buffer = buffer[:match.end()], buffer[match.end():]
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == "]": # end of result array
+                remaining_as_is = True
+                break
+            try:
+                series, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError: # series is incomplete; wait for the next chunk
+                break
+            if keep_series is None or keep_series(series.get("metric", {})):
+                kept.append(series)
+        buffer = buffer[pos:]
+
+    buffer += text_decoder.decode(b"", final = True)
+    if head is None: # no result array of series, e.g., an error response
+        return json.loads(buffer)
+    if not remaining_as_is:
+        raise ValueError("Incomplete result array in prometheus response")
+    query_result = json.loads(head + buffer)
+    query_result["data"]["result"] = kept
+    return query_result
+
+def filter_series(query_result, keep_series = None):
+    """Drop series from a parsed prometheus result.
+
+    Args:
+        query_result (Dict): raw prometheus result
+        keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series should be kept, given its labels; all series are kept if this is None
+
+    Returns:
+        query_result (Dict): raw prometheus result with the kept series alone in its result array
+    """
+    if keep_series is None or not isinstance(query_result.get("data", {}).get("result"), list) \
+        or query_result["data"].get("resultType") not in ("vector", "matrix"):
+        return query_result
+    filtered_result = dict(query_result)
+    filtered_result["data"] = dict(query_result["data"])
+    filtered_result["data"]["result"] = [
+        series for series in query_result["data"]["result"] if keep_series(series.get("metric", {}))
+    ]
+    return filtered_result
+
+class QueryDeadline():
+    """Latency budget shared by the queries of an experiment iteration. The budget starts when the first of these queries starts running, rather than when they are submitted, so that time spent waiting for a free thread of the query executor does not count against it. Under load, this queue grows with the number of iterations in flight, while iterations still time out only if prometheus itself is slow.
+
+    Attributes:
+        budget (float): seconds available to the queries, including retries
+        deadline (float): deadline in terms of time.monotonic(), or None if no query has started yet
+    """
+    def __init__(self, budget):
+        """Initialize query deadline.
+
+        Args:
+            budget (float): seconds available to the queries, including retries
+        """
+        self.budget = budget
+        self.deadline = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the budget, unless an earlier query has started it already. Called by each query when it starts running.
+
+        Returns:
+            deadline (float): deadline in terms of time.monotonic()
+        """
+        with self.lock:
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.budget
+            return self.deadline
+
+class MetricsBackend():
+    """Base class for metrics backends. A metrics backend answers prometheus queries.
+
+    Attributes:
+        query_url (str): URL identifying the backend; part of the keys of cached query results
+        budget (float): seconds available to a query when no deadline is given
+    """
+    def __init__(self, query_url, budget):
+        """Initialize metrics backend.
+
+        Args:
+            query_url (str): URL identifying the backend
+            budget (float): seconds available to a query when no deadline is given
+        """
+        self.query_url = query_url
+        self.budget = budget
+
+    def get_deadline(self):
+        """Get the deadline of a query which starts now.
+
+        Returns:
+            deadline (float): deadline in terms of time.monotonic()
+        """
+        return time.monotonic() + self.budget
+
+    def create_query_deadline(self):
+        """Create a deadline to be shared by queries which are about to be submitted. It starts when the first of them starts running.
+
+        Returns:
+            deadline (QueryDeadline): query deadline
+        """
+        return QueryDeadline(self.budget)
+
+    def query(self, params, keep_series = None, deadline = None):
+        """Query the backend.
+
+        Args:
+            params (Dict[str, str]): prometheus query parameters
+            keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series in the result should be kept, given its labels; all series are kept if this is None
+            deadline (float): deadline for the query in terms of time.monotonic(); defaults to the budget from now
+
+        Returns:
+            query_result (Dict): raw prometheus result
+        """
+        raise NotImplementedError
+
+class PrometheusClient(MetricsBackend):
+    """HTTP client for the prometheus query API. A single instance of this class is shared by all queries within the process, so that TCP connections (and TLS sessions) are reused across queries.
+
+    Queries are bounded by a deadline. Failed attempts are retried with jittered exponential backoff while the deadline permits, and alternate between the prometheus server and its replicas. When hedging is enabled, a duplicate request is sent to the next replica (or the same server, if there are no replicas) once a query takes longer than the configured percentile of recent query latencies, and the first response wins.
+
+    Attributes:
+        query_url (str): URL of the prometheus query API
+        query_urls (List[str]): URLs of the prometheus query API, followed by those of its replicas
+        session (requests.Session): session holding the pool of keep-alive connections
+        timeout (Tuple[float, float]): connect and read timeouts in seconds
+        budget (float): seconds available to a query, including retries, when no deadline is given
+        max_retries (int): maximum number of retries of a failed query
+        retry_backoff (float): base of the exponential backoff between retries in seconds
+        hedge_percentile (float): percentile of recent query latencies after which a query is hedged; hedging is disabled if this is zero
+        retries (int): number of retried queries
+        hedges (int): number of hedged requests
+    """
+    def __init__(self, config):
+        """Initialize prometheus client.
+
+        Args:
+            config (Dict): configuration dictionary; typically env_config
+        """
+        super().__init__(
+            config[constants.METRICS_BACKEND_CONFIG_URL] + "/api/v1/query",
+            config[constants.METRICS_BACKEND_CONFIG_QUERY_BUDGET])
+        self.query_urls = [self.query_url] + [
+            replica_url + "/api/v1/query" for replica_url in config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS]
+        ]
+        self.max_retries = config[constants.METRICS_BACKEND_CONFIG_MAX_QUERY_RETRIES]
+        self.retry_backoff = config[constants.METRICS_BACKEND_CONFIG_RETRY_BACKOFF]
+        self.hedge_percentile = config[constants.METRICS_BACKEND_CONFIG_HEDGE_PERCENTILE]
+        self.latencies = deque(maxlen = LATENCY_WINDOW)
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.hedges = 0
+        self.timeout = (
+            config[constants.METRICS_BACKEND_CONFIG_CONNECT_TIMEOUT],
+            config[constants.METRICS_BACKEND_CONFIG_READ_TIMEOUT]
+        )
+
+        pool_size = config[constants.METRICS_BACKEND_CONFIG_CONNECTION_POOL_SIZE]
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip"})
+        # hedged requests run alongside their primary request, so they need their own threads
+        self.hedge_executor = ThreadPoolExecutor(
+            max_workers = 2 * pool_size,
+            thread_name_prefix = "iter8-metrics-hedge") if self.hedge_percentile > 0 else None
+
+        authentication = config.get(constants.METRICS_BACKEND_CONFIG_AUTH, {})
+        auth_type = authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_TYPE, constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE)
+        logger.debug(f"authentication type is: {auth_type}")
+        if auth_type == constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC:
+            self.session.auth = HTTPBasicAuth(
+                authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_USERNAME),
+                authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_PASSWORD)
+            )
+        elif auth_type == constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_TOKEN:
+            token = authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_TOKEN)
+            self.session.headers.update({"Authorization": f"Bearer {token}"})
+        elif auth_type != constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE:
+            logger.warning(f"Unsupported authentication type: {auth_type}; trying {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE}")
+
+        # server verification applies to all authentication types
+        if authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_INSECURE_SKIP_VERIFY):
+            self.session.verify = False
+        elif authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_CA_FILE):
+            self.session.verify = authentication.get(constants.METRICS_BACKEND_CONFIG_AUTH_CA_FILE)
+
+    def query(self, params, keep_series = None, deadline = None):
+        """Query prometheus. The response is streamed and parsed incrementally.
+
+        Args:
+            params (Dict[str, str]): query parameters
+            keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series in the result should be kept, given its labels; all series are kept if this is None
+            deadline (float): deadline for the query, including retries, in terms of time.monotonic(); defaults to the configured budget from now
+
+        Returns:
+            query_result (Dict): raw prometheus result
+
+        Raises:
+            Exception: HTTP connection errors and timeouts related to prom requests, once retries are exhausted or the deadline is reached.
+        """
+        if deadline is None:
+            deadline = self.get_deadline()
+        attempt = 0
+        while True:
+            try:
+                return self.hedged_query(params, keep_series, deadline, attempt)
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                backoff = random.uniform(0, self.retry_backoff * 2 ** attempt) # full jitter
+                if attempt > self.max_retries or time.monotonic() + backoff >= deadline:
+                    raise
+                logger.warning(f"Retrying prometheus query in {backoff:.3f} seconds after error: {e}")
+                with self.lock:
+                    self.retries += 1
+                time.sleep(backoff)
+
+    def hedged_query(self, params, keep_series, deadline, attempt):
+        """Query prometheus, hedging the request if it is slow.
+
+        Args:
+            params (Dict[str, str]): query parameters
+            keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series in the result should be kept
+            deadline (float): deadline for the query in terms of time.monotonic()
+            attempt (int): number of previous attempts for this query; selects the server to be queried
+
+        Returns:
+            query_result (Dict): raw prometheus result of the first successful request
+        """
+        url = self.query_urls[attempt % len(self.query_urls)]
+        hedge_delay = self.get_hedge_delay()
+        if hedge_delay is None:
+            return self.query_once(url, params, keep_series, deadline)
+
+        primary = self.hedge_executor.submit(self.query_once, url, params, keep_series, deadline)
+        done, _ = wait([primary], timeout = max(0.0, min(hedge_delay, deadline - time.monotonic())))
+        if done:
+            return primary.result()
+
+        hedge_url = self.query_urls[(attempt + 1) % len(self.query_urls)]
+        logger.debug(f"Hedging prometheus query slower than {hedge_delay:.3f} seconds against {hedge_url}")
+        with self.lock:
+            self.hedges += 1
+        pending = {primary, self.hedge_executor.submit(self.query_once, hedge_url, params, keep_series, deadline)}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout = max(0.0, deadline - time.monotonic()), return_when = FIRST_COMPLETED)
+            if not done:
+                raise requests.Timeout("Query budget exhausted while waiting for prometheus")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def query_once(self, url, params, keep_series, deadline):
+        """Send a single request to prometheus.
+
+        Args:
+            url (str): URL of the prometheus query API
+            params (Dict[str, str]): query parameters
+            keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series in the result should be kept
+            deadline (float): deadline for the request in terms of time.monotonic()
+
+        Returns:
+            query_result (Dict): raw prometheus result
+
+        Raises:
+            requests.Timeout: if the deadline has passed
+            requests.HTTPError: if prometheus is unavailable or overloaded
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout("Query budget exhausted before querying prometheus")
+        timeout = (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+        start = time.monotonic()
+        response = self.session.get(url, params = params, timeout = timeout, stream = True)
+        try:
+            if response.status_code >= 500 or response.status_code == 429:
+                response.raise_for_status()
+            query_result = parse_query_response(response.iter_content(chunk_size = RESPONSE_CHUNK_SIZE), keep_series)
+        finally:
+            response.close()
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        return query_result
+
+    def get_hedge_delay(self):
+        """Get the delay after which a request is hedged.
+
+        Returns:
+            delay (float): configured percentile of recent query latencies in seconds, or None if hedging is disabled or too few latencies have been observed
+        """
+        if self.hedge_percentile <= 0:
+            return None
+        with self.lock:
+            if len(self.latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, max(0, math.ceil(self.hedge_percentile / 100.0 * len(latencies)) - 1))
+        return latencies[index]
+
+    def stats(self):
+        """Get client statistics.
+
+        Returns:
+            a dictionary (Dict[str, int]): number of retried queries and hedged requests
+        """
+        with self.lock:
+            return {
+                "retries": self.retries,
+                "hedges": self.hedges
+            }
+
+_prometheus_client = None
+_prometheus_client_lock = threading.Lock()
+
+def get_prometheus_client():
+    """Return the process-wide prometheus client. The client is created from env_config on first use.
+
+    Returns:
+        client (PrometheusClient): prometheus client
+    """
+    global _prometheus_client
+    if _prometheus_client is None:
+        with _prometheus_client_lock:
+            if _prometheus_client is None:
+                _prometheus_client = PrometheusClient(env_config)
+    return _prometheus_client
+
+def normalize_query(query):
+    """Normalize a prometheus query so that recorded queries match replayed queries whose durations differ.
+
+    Args:
+        query (str): prometheus query
+
+    Returns:
+        normalized_query (str): query with durations of range vectors replaced by $interval
+    """
+    return QUERY_DURATION.sub("[$interval]", query)
+
+class RecordingMetricsBackend(MetricsBackend):
+    """Metrics backend which forwards queries to another backend, and records every query along with its response. Recordings are gzipped JSON lines, each containing the query, its evaluation time and the unfiltered prometheus response.
+
+    Attributes:
+        backend (MetricsBackend): backend to which queries are forwarded
+        record_file (str): path of the recording
+    """
+    def __init__(self, backend, record_file):
+        """Initialize recording metrics backend.
+
+        Args:
+            backend (MetricsBackend): backend to which queries are forwarded
+            record_file (str): path of the recording; recordings are appended to an existing file
+        """
+        super().__init__(backend.query_url, backend.budget)
+        self.backend = backend
+        self.record_file = record_file
+        self.file = gzip.open(record_file, "at", encoding = "utf-8")
+        self.lock = threading.Lock()
+
+    def get_deadline(self):
+        """Get the deadline of a query which starts now, as defined by the backend to which queries are forwarded.
+
+        Returns:
+            deadline (float): deadline in terms of time.monotonic()
+        """
+        return self.backend.get_deadline()
+
+    def create_query_deadline(self):
+        """Create a deadline to be shared by queries which are about to be submitted, as defined by the backend to which queries are forwarded.
+
+        Returns:
+            deadline (QueryDeadline): query deadline
+        """
+        return self.backend.create_query_deadline()
+
+    def query(self, params, keep_series = None, deadline = None):
+        """Query the backend and record the query along with its response.
+
+        Args:
+            params (Dict[str, str]): prometheus query parameters
+            keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series in the result should be kept; the recording contains all series
+            deadline (float): deadline for the query in terms of time.monotonic()
+
+        Returns:
+            query_result (Dict): raw prometheus result
+        """
+        query_result = self.backend.query(params, None, deadline)
+        line = json.dumps({
+            "query": params["query"],
+            "time": params.get("time"),
+            "response": query_result
+        }, separators = (",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+        return filter_series(query_result, keep_series)
+
+class ReplayMetricsBackend(MetricsBackend):
+    """Metrics backend which serves responses from a recording made by RecordingMetricsBackend, optionally after an injected latency. Queries are matched after normalizing durations, and successive queries with the same key are served the recorded responses for that key in order, cycling when they run out.
+
+    Attributes:
+        replay_file (str): path of the recording
+        latency (float): seconds by which each response is delayed
+        responses (Dict[str, List[Dict]]): recorded responses, keyed by normalized query
+    """
+    def __init__(self, replay_file, latency = 0.0, budget = constants.METRICS_BACKEND_CONFIG_DEFAULT_QUERY_BUDGET):
+        """Initialize replay metrics backend.
+
+        Args:
+            replay_file (str): path of the recording
+            latency (float): seconds by which each response is delayed
+            budget (float): seconds available to a query when no deadline is given
+        """
+        super().__init__(f"replay://{replay_file}", budget)
+        self.replay_file = replay_file
+        self.latency = latency
+        self.responses = {}
+        with gzip.open(replay_file, "rt", encoding = "utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses.setdefault(normalize_query(record["query"]), []).append(record["response"])
+        self.positions = {key: 0 for key in self.responses}
+        self.lock = threading.Lock()
+        logger.info(f"Replaying {sum(len(r) for r in self.responses.values())} responses for {len(self.responses)} queries from {replay_file}")
+
+    def query(self, params, keep_series = None, deadline = None):
+        """Serve the recorded response for a query.
+
+        Args:
+            params (Dict[str, str]): prometheus query parameters
+            keep_series (Callable[[Dict[str, str]], bool]): function which decides if a series in the result should be kept, given its labels; all series are kept if this is None
+            deadline (float): deadline for the query in terms of time.monotonic()
+
+        Returns:
+            query_result (Dict): recorded prometheus result; an empty vector if the query was not recorded
+
+        Raises:
+            requests.Timeout: if the injected latency exceeds the deadline
+        """
+        if deadline is None:
+            deadline = self.get_deadline()
+        if self.latency > 0:
+            remaining = deadline - time.monotonic()
+            time.sleep(max(0.0, min(self.latency, remaining)))
+            if self.latency > remaining:
+                raise requests.Timeout("Query budget exhausted while replaying prometheus response")
+
+        key = normalize_query(params["query"])
+        with self.lock:
+            recorded = self.responses.get(key)
+            if recorded:
+                query_result = recorded[self.positions[key] % len(recorded)]
+                self.positions[key] += 1
+        if not recorded:
+            logger.warning(f"No recorded response for query: {params['query']}")
+            query_result = {"status": "success", "data": {"resultType": "vector", "result": []}}
+        return filter_series(query_result, keep_series)
+
+_metrics_backend = None
+_metrics_backend_lock = threading.Lock()
+
+def get_metrics_backend():
+    """Return the process-wide metrics backend. This is the prometheus client, unless the metricsBackend section of the config file specifies a replay_file to serve recorded responses from, or a record_file to record prometheus responses into.
+
+    Returns:
+        backend (MetricsBackend): metrics backend
+    """
+    global _metrics_backend
+    if _metrics_backend is None:
+        with _metrics_backend_lock:
+            if _metrics_backend is None:
+                if env_config[constants.METRICS_BACKEND_CONFIG_REPLAY_FILE]:
+                    _metrics_backend = ReplayMetricsBackend(
+                        env_config[constants.METRICS_BACKEND_CONFIG_REPLAY_FILE],
+                        env_config[constants.METRICS_BACKEND_CONFIG_REPLAY_LATENCY] / 1000.0,
+                        env_config[constants.METRICS_BACKEND_CONFIG_QUERY_BUDGET])
+                elif env_config[constants.METRICS_BACKEND_CONFIG_RECORD_FILE]:
+                    _metrics_backend = RecordingMetricsBackend(
+                        get_prometheus_client(), env_config[constants.METRICS_BACKEND_CONFIG_RECORD_FILE])
+                else:
+                    _metrics_backend = get_prometheus_client()
+    return _metrics_backend
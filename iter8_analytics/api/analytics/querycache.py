@@ -0,0 +1,233 @@
+"""Module containing in-process sharing of raw prometheus query results across experiments: a result cache, and coalescing of identical in-flight queries.
+"""
+
+# core python dependencies
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# iter8 dependencies
+import iter8_analytics.constants as constants
+from iter8_analytics.config import env_config
+
+logger = logging.getLogger('iter8_analytics')
+
+class QueryResultCache():
+    """Size-bounded LRU cache of raw query results with a time-to-live. Keys include the evaluation time of queries, so an entry is never refreshed in place: queries made in a later time window have keys of their own.
+
+    Attributes:
+        max_size (int): maximum number of entries
+        ttl (float): seconds for which an entry is fresh
+        hits (int): number of lookups served by a fresh entry
+        misses (int): number of lookups which needed a query
+        evictions (int): number of entries evicted to respect max_size
+    """
+    def __init__(self, max_size, ttl):
+        """Initialize query result cache.
+
+        Args:
+            max_size (int): maximum number of entries
+            ttl (float): seconds for which an entry is fresh
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (value, time at which value was stored)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_query(self, key, query, cacheable = lambda value: True):
+        """Get the value cached for key, or obtain it by calling query.
+
+        Args:
+            key (Hashable): cache key
+            query (Callable[[], Any]): function which obtains the value when it is not cached
+            cacheable (Callable[[Any], bool]): function which decides if a value obtained by query can be cached
+
+        Returns:
+            value (Any): cached or freshly obtained value
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if now - stored_at < self.ttl:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return value
+            self.misses += 1
+
+        value = query()
+        if cacheable(value):
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """Store a value in the cache, evicting least recently used entries if needed.
+
+        Args:
+            key (Hashable): cache key
+            value (Any): value to be cached
+        """
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+    def stats(self):
+        """Get cache statistics.
+
+        Returns:
+            a dictionary (Dict[str, int]): hit, miss, eviction counts, and current size of the cache
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.entries)
+            }
+
+_query_result_cache = None
+_query_result_cache_lock = threading.Lock()
+
+def get_query_result_cache():
+    """Return the process-wide query result cache. The cache is configured through the query_cache_* fields in the metricsBackend section of the config file, and is disabled when query_cache_size is zero.
+
+    Returns:
+        cache (QueryResultCache): query result cache, or None if caching is disabled
+    """
+    global _query_result_cache
+    if env_config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE] <= 0:
+        return None
+    if _query_result_cache is None:
+        with _query_result_cache_lock:
+            if _query_result_cache is None:
+                _query_result_cache = QueryResultCache(
+                    max_size = env_config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE],
+                    ttl = env_config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_TTL])
+    return _query_result_cache
+
+class SingleFlight():
+    """Coalesces identical in-flight calls. The first caller for a key executes the call, and concurrent callers with the same key wait for its result instead of repeating the call. Works for threads (do) as well as coroutines (do_async), which can share in-flight calls with each other.
+
+    Attributes:
+        calls (int): number of calls actually executed
+        coalesced (int): number of callers which waited for a call made by another caller
+    """
+    def __init__(self):
+        """Initialize single flight object.
+        """
+        self.in_flight = {} # key -> Future of the call in flight
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """Join the call in flight for key, or become its leader.
+
+        Args:
+            key (Hashable): call key
+
+        Returns:
+            a tuple (Tuple[Future, bool]): future of the call, and a boolean which is True if the caller must execute the call
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self.in_flight[key] = future
+            self.calls += 1
+            return future, True
+
+    def finish(self, key, future, value = None, exception = None):
+        """Publish the outcome of a call to all waiters. Calls made after this point are executed afresh.
+
+        Args:
+            key (Hashable): call key
+            future (Future): future of the call
+            value (Any): result of the call
+            exception (Exception): exception raised by the call, if any
+        """
+        with self.lock:
+            self.in_flight.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(value)
+
+    def do(self, key, call):
+        """Execute call, unless an identical call is in flight, in which case wait for its result.
+
+        Args:
+            key (Hashable): call key
+            call (Callable[[], Any]): function to be called
+
+        Returns:
+            value (Any): result of the call
+        """
+        future, leader = self.join(key)
+        if leader:
+            try:
+                value = call()
+            except Exception as e:
+                self.finish(key, future, exception = e)
+                raise
+            self.finish(key, future, value = value)
+            return value
+        return future.result()
+
+    async def do_async(self, key, call):
+        """Await call, unless an identical call is in flight, in which case await its result.
+
+        Args:
+            key (Hashable): call key
+            call (Callable[[], Awaitable[Any]]): coroutine function to be called
+
+        Returns:
+            value (Any): result of the call
+        """
+        future, leader = self.join(key)
+        if leader:
+            try:
+                value = await call()
+            except Exception as e:
+                self.finish(key, future, exception = e)
+                raise
+            self.finish(key, future, value = value)
+            return value
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        """Get single flight statistics.
+
+        Returns:
+            a dictionary (Dict[str, int]): number of executed calls, coalesced waiters, and calls currently in flight
+        """
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self.in_flight)
+            }
+
+_single_flight = SingleFlight()
+
+def get_single_flight():
+    """Return the process-wide single flight object used to coalesce identical prometheus queries.
+
+    Returns:
+        single_flight (SingleFlight): single flight object, or None if coalescing is turned off through coalesce_queries in the metricsBackend section of the config file
+    """
+    if not env_config[constants.METRICS_BACKEND_CONFIG_COALESCE_QUERIES]:
+        return None
+    return _single_flight
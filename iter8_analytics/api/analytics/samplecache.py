@@ -0,0 +1,103 @@
+"""Module containing an in-process cache of posterior samples, shared across experiments. Versions whose beliefs are unchanged between iterations reuse their samples instead of drawing them afresh.
+"""
+
+# core python dependencies
+import logging
+import threading
+from collections import OrderedDict
+
+# iter8 dependencies
+import iter8_analytics.constants as constants
+from iter8_analytics.config import env_config
+
+logger = logging.getLogger('iter8_analytics')
+
+class SampleCache():
+    """Size-bounded LRU cache of posterior samples. Keys identify the metric and version to which a belief belongs, the belief type and parameters, the position and size of a chunk of samples, the lower bound applied to samples, and the random seed. Cached samples are read-only arrays.
+
+    Attributes:
+        max_size (int): maximum number of entries
+        hits (int): number of lookups served by an entry
+        misses (int): number of lookups which needed fresh samples
+        evictions (int): number of entries evicted to respect max_size
+    """
+    def __init__(self, max_size):
+        """Initialize sample cache.
+
+        Args:
+            max_size (int): maximum number of entries
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict() # key -> sample
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Get the sample cached for key.
+
+        Args:
+            key (Hashable): cache key
+
+        Returns:
+            sample (np.ndarray): cached sample, or None if there is none
+        """
+        with self.lock:
+            sample = self.entries.get(key)
+            if sample is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return sample
+
+    def put(self, key, sample):
+        """Store a copy of a sample in the cache, evicting least recently used entries if needed.
+
+        Args:
+            key (Hashable): cache key
+            sample (np.ndarray): sample to be cached
+        """
+        sample = sample.copy()
+        sample.flags.writeable = False
+        with self.lock:
+            self.entries[key] = sample
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+    def stats(self):
+        """Get cache statistics.
+
+        Returns:
+            a dictionary (Dict[str, float]): hit, miss and eviction counts, hit rate, and current size of the cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+                "size": len(self.entries)
+            }
+
+_sample_cache = None
+_sample_cache_lock = threading.Lock()
+
+def get_sample_cache():
+    """Return the process-wide posterior sample cache. The cache is configured through the sample_cache_size field of the config file, and is disabled when it is zero.
+
+    Returns:
+        cache (SampleCache): sample cache, or None if caching is disabled
+    """
+    global _sample_cache
+    if env_config[constants.SAMPLE_CACHE_SIZE] <= 0:
+        return None
+    if _sample_cache is None:
+        with _sample_cache_lock:
+            if _sample_cache is None:
+                _sample_cache = SampleCache(max_size = env_config[constants.SAMPLE_CACHE_SIZE])
+    return _sample_cache
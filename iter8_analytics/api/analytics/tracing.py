@@ -0,0 +1,178 @@
+"""Module containing hot path logging for experiment iterations. Debug traces are emitted only for iterations selected for tracing, and their messages are formatted lazily, so iterations which are not traced pay close to nothing for them. Iterations of experiments listed in the debug_experiments field of the config file are always traced. Other iterations are traced one in every debug_sampling_rate iterations. Nothing is traced unless the iter8_analytics logger is enabled for debug.
+"""
+
+# core python dependencies
+import contextvars
+import itertools
+import json
+import logging
+import operator
+import sys
+
+# iter8 dependencies
+import iter8_analytics.constants as constants
+from iter8_analytics.config import env_config
+
+logger = logging.getLogger('iter8_analytics')
+
+# stack level which attributes trace records to the caller of TraceLogger.debug
+_caller = {"stacklevel": 2} if sys.version_info >= (3, 8) else {}
+
+class Trace():
+    """Trace of an experiment iteration.
+
+    Attributes:
+        fields (Dict[str, Any]): structured fields attached to every record of this trace
+    """
+    def __init__(self, experiment_id, iteration):
+        """Initialize trace.
+
+        Args:
+            experiment_id (str): id of the experiment
+            iteration (int): sequence number of this iteration within the process
+        """
+        self.fields = {"experiment": experiment_id, "iteration": iteration}
+
+_current_trace = contextvars.ContextVar('iter8_trace', default = None)
+_iterations = itertools.count()
+
+def start_trace(experiment_id):
+    """Decide if the current experiment iteration is traced, and make this decision current.
+
+    Args:
+        experiment_id (str): id of the experiment
+
+    Returns:
+        token (contextvars.Token): token which is passed to end_trace at the end of the iteration
+    """
+    iteration = next(_iterations)
+    trace = None
+    if logger.isEnabledFor(logging.DEBUG):
+        sampling_rate = env_config[constants.DEBUG_SAMPLING_RATE]
+        if experiment_id in env_config[constants.DEBUG_EXPERIMENTS] or (sampling_rate > 0 and iteration % sampling_rate == 0):
+            trace = Trace(experiment_id, iteration)
+    return _current_trace.set(trace)
+
+def end_trace(token):
+    """End the trace started with token.
+
+    Args:
+        token (contextvars.Token): token returned by start_trace
+    """
+    _current_trace.reset(token)
+
+def is_tracing():
+    """Check if the current experiment iteration is traced.
+
+    Returns:
+        a boolean (bool): True if debug traces are emitted
+    """
+    return _current_trace.get() is not None
+
+def propagate_trace(function):
+    """Carry the current trace into a function which will be run in another thread, such as a thread pool worker.
+
+    Args:
+        function (Callable): function to be run
+
+    Returns:
+        function (Callable): function running within the current trace
+    """
+    trace = _current_trace.get()
+    def run_in_trace(*args, **kwargs):
+        token = _current_trace.set(trace)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+    return run_in_trace
+
+class Lazy():
+    """Log message argument which is computed only if the message is formatted. It is computed at most once, however many handlers format the message. Lazy arguments support %s, %r and numeric placeholders such as %d, %x and %.3f.
+    """
+    _unset = object()
+
+    def __init__(self, function, *args):
+        """Initialize lazy argument.
+
+        Args:
+            function (Callable): function computing the argument
+            args: arguments to function
+        """
+        self.function = function
+        self.args = args
+        self.value = Lazy._unset
+
+    def get(self):
+        """Compute the argument, unless it has been computed already.
+
+        Returns:
+            value (Any): value of the argument
+        """
+        if self.value is Lazy._unset:
+            self.value = self.function(*self.args)
+        return self.value
+
+    def __str__(self):
+        return str(self.get())
+
+    def __repr__(self):
+        return repr(self.get())
+
+    def __int__(self):
+        return int(self.get())
+
+    def __index__(self):
+        return operator.index(self.get())
+
+    def __float__(self):
+        return float(self.get())
+
+class TraceLogger():
+    """Logger for hot paths. Debug messages are %-style format strings with arguments, which are formatted only if the current iteration is traced.
+    """
+    def __init__(self, logger):
+        """Initialize trace logger.
+
+        Args:
+            logger (logging.Logger): logger which emits trace records
+        """
+        self.logger = logger
+
+    def debug(self, msg, *args, **fields):
+        """Log a debug message in the current trace.
+
+        Args:
+            msg (str): %-style format string
+            args: arguments of msg
+            fields: structured fields attached to the record along with the fields of the trace
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        self.logger.debug(msg, *args, extra = {"trace": dict(trace.fields, **fields)}, **_caller)
+
+def get_trace_logger():
+    """Return the trace logger of iter8 analytics.
+
+    Returns:
+        trace (TraceLogger): trace logger
+    """
+    return TraceLogger(logger)
+
+class JsonFormatter(logging.Formatter):
+    """Formatter which emits each record as a JSON object on a single line. Fields of traces are included in the object.
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, "trace", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default = str)
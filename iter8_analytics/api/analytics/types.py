@@ -76,6 +76,10 @@ class TrafficSplitStrategy(str, Enum):
     top_2_lts = "top_2_lts" # top 2 Logistic Thompson Sampling -- from hotcloud
     exp3 = "exp3"
 
+class SamplingMethodEnum(str, Enum):
+    monte_carlo = "monte_carlo" # independent random draws
+    quasi_monte_carlo = "quasi_monte_carlo" # scrambled Sobol points transformed by inverse CDFs
+
 class TrafficControl(BaseModel): # parameters pertaining to traffic control
     max_increment: float = Field(
         2.0, description="Maximum possible increment in a candidate's traffic during the initial phase of the experiment", ge=0.0, le=100.0)
@@ -83,6 +87,12 @@ class TrafficControl(BaseModel): # parameters pertaining to traffic control
     amplification: float = Field(10, description="Tunable parameter to enable logistic formulation with hard or soft constraints", ge=0.0)
     gamma: float = Field(0.07, description="Tunable parameter to enable exp3 for quick responses", ge=0.0)
     posterior: float = Field(0.95, description="Minimum posterior probability for winner", ge=0.0,le=1.1)
+    sample_size: int = Field(10000, description="Number of posterior samples used for assessments and traffic split recommendations. In adaptive sampling mode, this is the number of samples drawn initially and the minimum size of each further chunk of samples", ge=1, le=1000000)
+    adaptive_sampling: bool = Field(False, description="Draw further chunks of posterior samples until the Monte Carlo standard error of win probabilities and probabilities of satisfying thresholds falls below target_standard_error, or max_sample_size is reached")
+    target_standard_error: float = Field(0.005, description="Target Monte Carlo standard error in adaptive sampling mode", gt=0.0, le=1.0)
+    max_sample_size: int = Field(160000, description="Maximum number of posterior samples in adaptive sampling mode", ge=1, le=1000000)
+    sampling_method: SamplingMethodEnum = Field(SamplingMethodEnum.monte_carlo, description = "Method used to draw posterior samples of ratio metrics. Quasi Monte Carlo reaches a given accuracy with far fewer samples; with it, sample_size is rounded up to a power of 2, so that the default sample size of 10000 becomes 16384. Consider a smaller sample_size such as 1024 or 4096 along with quasi Monte Carlo")
+    all_strategies: bool = Field(False, description = "Create traffic split recommendations for all strategies. By default, only the recommendation for the selected strategy is created")
 
 class StatusEnum(str, Enum):
     all_ok = "all_ok"
@@ -137,12 +147,14 @@ class LastState(BaseModel): # last state recorded by analytics service in its pr
     ratio_max_mins: Dict[iter8id, RatioMaxMin] = Field(None, description = "Dictionary mapping from ratio metric id to its max min values")
     traffic_split_recommendation: Dict[TrafficSplitStrategy, Dict[iter8id, int]] = Field(None, description = "Traffic split recommendation on a per algorithm basis. Each recommendation contains the percentage of traffic on a per-version basis in the inner dict")
     # this is a dictionary which maps version ids to percentage of traffic allocated to them. The percentages need to add up to 100
+    exp3_log_weights: Dict[iter8id, float] = Field(None, description = "Dictionary mapping from version id to the logarithm of its exp3 weight")
 
 # parameters for current iteration of experiment
 class ExperimentIterationParameters(BaseModel):
     start_time: datetime = Field(...,
                                  description = "Start time of the experiment")
     iteration_number: int = Field(None, description = "Iteration number. This is mandatory for controller interactions. Optional for human-in-the-loop interactions", ge = 0)
+    random_seed: int = Field(None, description = "Seed for random number generation in this iteration. Combined with iteration_number if present. Iterations with the same seed, iteration number and metric values produce identical results. If omitted, fresh entropy is used", ge = 0)
     service_name: str = Field(..., description = "Name of the service in this experiment")
     baseline: Version = Field(..., description="The baseline version")
     candidates: Sequence[Version] = Field(...,
@@ -171,6 +183,14 @@ class CounterQuerySpec(QuerySpec):
     class Config:
         arbitrary_types_allowed = True
 
+class BatchedCounterQuerySpec(QuerySpec):
+    """Base class for prometheus query spec combining several counter queries
+    """
+    query_templates: Dict[str, Any] # keys are used to tag and demultiplex results
+
+    class Config:
+        arbitrary_types_allowed = True
+
 class RatioQuerySpec(QuerySpec):
     """Base class for prometheus ratio query spec
     """
@@ -186,7 +206,7 @@ class Interval(BaseModel):
     upper: float = Field(..., description="Upper endpoint of the interval")
 
 class RatioStatistics(BaseModel):
-    improvement_over_baseline: Interval = Field(None, description = "Credible interval for percentage improvement over baseline. Defined only for non-baseline versions. This is currently computed based on Bayesian estimation")
+    improvement_over_baseline: Interval = Field(None, description = "Credible interval for percentage improvement over baseline. Defined only for non-baseline versions, and only if the posterior of the baseline is bounded away from zero. This is currently computed based on Bayesian estimation")
     probability_of_beating_baseline: float = Field(None, le = 1.0, ge = 0.0, description = "Probability of beating baseline with respect to this metric. Defined only for non-baseline versions. This is currently computed based on Bayesian estimation")
     probability_of_being_best_version: float = Field(None, le = 1.0, ge = 0.0, description = "Probability of being the best version with respect to this metric. This is currently computed based on Bayesian estimation")
     credible_interval: Interval = Field(..., description = "Credible interval for the value of this metric. This is currently computed based on Bayesian estimation")
@@ -227,6 +247,10 @@ class WinnerAssessment(BaseModel):
    ## coming soon
     # safe_to_rollforward: bool = Field(False, description = "True if it is now safe to terminate the experiment early and rollforward to the winner")
 
+class SamplingSummary(BaseModel):
+    sample_size: int = Field(..., description = "Number of posterior samples used in this iteration")
+    standard_error: float = Field(..., description = "Largest Monte Carlo standard error among win probabilities and probabilities of satisfying thresholds estimated from posterior samples")
+
 class Iter8AssessmentAndRecommendation(BaseModel):
     timestamp: datetime = Field(...,
                                  description="Timestamp at which the current assessment and recommendation is created")
@@ -253,6 +277,7 @@ class Iter8AssessmentAndRecommendation(BaseModel):
         StatusEnum.uninitialized_value: "Uninitialized value"
         }, 
         description="Human-friendly interpretations of the status codes returned by the analytics service") # the index of an interpretation corresponds to the corresponding status enum
+    sampling: SamplingSummary = Field(None, description = "Posterior sampling details for this iteration")
     last_state: Dict[str, Any] = Field(
         None, description="Last recorded state from analytics service")
 
@@ -262,3 +287,4 @@ class AdvancedParameters:
     posterior_probability_for_credible_intervals = 0.95
     min_posterior_probability_for_winner = 0.95 # no winner until iter8 is 99% confident
     variance_boost_factor = 1.0 # a higher value of this factor encourages greater exploration
+    min_baseline_lower_bound_ratio = 0.1 # improvement over baseline is defined only if the lower end of the baseline's credible interval is at least this fraction of its median
@@ -4,43 +4,84 @@ Module containing low-level math utilities used by iter8
 
 # core python dependencies
 import math
-from random import random
 
-# round a sequence of weights into a sequence of integer weights so that they sum up to Math.floor(total)
-# further, rounded values equal the original values in expectation
-# assumption: all inputs are non-negative
-def gen_round(weights, total):
-    """Given float weights, round them to int weights so that they sum up to a given value
+# external module dependencies
+import numpy as np
+
+def get_seed_sequence(random_seed = None, iteration_number = None):
+    """Get the seed sequence for random number generation in an experiment iteration
 
     Args:
-        weights (Sequence[float]): A sequence of float weights
-        total (float): Returned values will sum up to Math.floor(total)
+        random_seed (int): seed; if None, fresh entropy is used
+        iteration_number (int): iteration number, combined with the seed so that iterations draw distinct streams
 
-    Yields:
-        int: The next weight
+    Returns:
+        seed_sequence (numpy.random.SeedSequence): seed sequence
     """
-    # initialize the generator. We will always work with math.floor(total)
-    total = math.floor(total)
+    if random_seed is None:
+        return np.random.SeedSequence()
+    if iteration_number is None:
+        return np.random.SeedSequence(random_seed)
+    return np.random.SeedSequence([random_seed, iteration_number])
+
+def get_min_ranks(utilities):
+    """Rank versions in each sample by decreasing utility, using a single sort of the utilities. Ties are ranked as pandas ranks them with method = 'min', i.e., the rank of a value is the number of strictly greater values in its sample. Ranks are zero-based, and nan values are given the rank num_versions.
 
-    #  randomized rounding of float 'a' to its ceiling or floor
-    def fix(a): return math.ceil(a) if random() < a - math.floor(a) else math.floor(a)
+    Args:
+        utilities (np.ndarray): (samples x versions) array of utilities
 
-    def normalize(weights):
-        """Maintain the invariate that weights sum up to 'total'
+    Returns:
+        ranks (np.ndarray): (samples x versions) integer array of ranks
+    """
+    num_versions = utilities.shape[1]
+    valid = ~np.isnan(utilities)
+    values = np.where(valid, utilities, -np.inf)
+    order = np.argsort(-values, axis = 1, kind = 'stable')
+    sorted_values = np.take_along_axis(values, order, axis = 1)
+    # each value is ranked at the first position of its run of ties in the sorted sample
+    positions = np.broadcast_to(np.arange(num_versions), sorted_values.shape)
+    run_starts = np.ones(sorted_values.shape, dtype = bool)
+    run_starts[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    sorted_ranks = np.maximum.accumulate(np.where(run_starts, positions, 0), axis = 1)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, sorted_ranks, axis = 1)
+    ranks[~valid] = num_versions
+    return ranks
 
-        Args:
-            weights (Sequence[float]): A sequence of float weights
+def get_rank_counts(ranks):
+    """Count how often each version attains each rank.
 
-        Returns:
-            a sequence (Sequence[int]): A sequence of ints summing up to total
-        """
-        if sum(weights) == 0:
-            weights = [1 for x in weights]  # weights summing up now to a value > 0
-        weightSum = sum(weights)
-        return [x*total / weightSum for x in weights]
+    Args:
+        ranks (np.ndarray): (samples x versions) integer array of ranks, as returned by get_min_ranks
 
-    # yield rounded values iteratively and update weights and total after yielding
-    while len(weights):
-        fixed = fix(normalize(weights)[0])
-        yield fixed
-        weights, total = weights[1:], total - fixed
+    Returns:
+        counts (np.ndarray): (versions x versions) integer array, whose entry [r, v] is the number of samples in which version v has rank r. The number of samples in which version v is among the top k is counts[:k, v].sum().
+    """
+    num_versions = ranks.shape[1]
+    counts = np.bincount((ranks * num_versions + np.arange(num_versions)).ravel(), minlength = (num_versions + 1) * num_versions)
+    return counts.reshape(num_versions + 1, num_versions)[:num_versions]
+
+def round_weights(weights, total, rng = None):
+    """Given float weights, round them to int weights so that they sum up to math.floor(total). Weights are rounded systematically: a single uniform offset is added to the cumulative sums of the weights, which are then floored. Each rounded weight is the floor or ceiling of its scaled weight, and equals it in expectation. All weights are assumed to be non-negative.
+
+    Args:
+        weights (Sequence[float]): A sequence of float weights
+        total (float): Returned values will sum up to math.floor(total)
+        rng (numpy.random.Generator): random number generator used for rounding
+
+    Returns:
+        weights (np.ndarray): An array of int weights
+    """
+    total = math.floor(total)
+    weights = np.asarray(weights, dtype = float)
+    if len(weights) == 0:
+        return np.zeros(0, dtype = int)
+    if weights.sum() == 0:
+        weights = np.ones_like(weights) # weights summing up now to a value > 0
+    if rng is None:
+        rng = np.random.default_rng()
+    cumulative = np.cumsum(weights) * (total / weights.sum())
+    cumulative[-1] = total # guard against floating point error in the sum
+    rounded = np.floor(cumulative + rng.random())
+    rounded[-1] = total
+    return np.diff(rounded, prepend = 0.0).astype(int)
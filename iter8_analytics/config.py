@@ -70,12 +70,12 @@ def read_config_file():
         if constants.METRICS_BACKEND_CONFIG_TYPE in metricsBackend:
             if not (metricsBackend[constants.METRICS_BACKEND_CONFIG_TYPE] in [constants.METRICS_BACKEND_CONFIG_TYPE_PROMETHEUS]):
                 logging.getLogger(__name__).error(f"Only {constants.METRICS_BACKEND_CONFIG_TYPE_PROMETHEUS} is supported. Ignoring {constants.METRICS_BACKEND_CONFIG_METRICS_BACKEND} configuration.")
-        # if auth.type is specified, verify tht it is in the supported set {none, basic}
+        # if auth.type is specified, verify tht it is in the supported set {none, basic, token}
         if constants.METRICS_BACKEND_CONFIG_AUTH in metricsBackend:
             auth = metricsBackend[constants.METRICS_BACKEND_CONFIG_AUTH]
             if constants.METRICS_BACKEND_CONFIG_AUTH_TYPE in auth:
-                if not (auth[constants.METRICS_BACKEND_CONFIG_AUTH_TYPE]in [constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE, constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC]):
-                    logging.getLogger(__name__).error(f"Only {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC} (or {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE}) authentication supported. Trying {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE}")
+                if not (auth[constants.METRICS_BACKEND_CONFIG_AUTH_TYPE]in [constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE, constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC, constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_TOKEN]):
+                    logging.getLogger(__name__).error(f"Only {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC} or {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_TOKEN} (or {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE}) authentication supported. Trying {constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE}")
                     configYaml[constants.METRICS_BACKEND_CONFIG_METRICS_BACKEND][constants.METRICS_BACKEND_CONFIG_AUTH][constants.METRICS_BACKEND_CONFIG_AUTH_TYPE] = constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE
     return configYaml
 
@@ -93,6 +93,23 @@ def get_env_config():
     # override with environment variable
     config[constants.LOG_LEVEL] = os.getenv(constants.ITER8_ANALYTICS_LOG_LEVEL_ENV, config[constants.LOG_LEVEL])
 
+    # log format
+    # default value
+    config[constants.LOG_FORMAT] = constants.LOG_FORMAT_DEFAULT_FORMAT
+    # override with value in configFile
+    if constants.LOG_FORMAT in configMap:
+        config[constants.LOG_FORMAT] = str(configMap[constants.LOG_FORMAT])
+
+    # debug traces of experiment iterations
+    # default value
+    config[constants.DEBUG_SAMPLING_RATE] = constants.DEBUG_DEFAULT_SAMPLING_RATE
+    config[constants.DEBUG_EXPERIMENTS] = []
+    # override with value in configFile
+    if constants.DEBUG_SAMPLING_RATE in configMap:
+        config[constants.DEBUG_SAMPLING_RATE] = max(0, int(configMap[constants.DEBUG_SAMPLING_RATE]))
+    if constants.DEBUG_EXPERIMENTS in configMap:
+        config[constants.DEBUG_EXPERIMENTS] = list(configMap[constants.DEBUG_EXPERIMENTS])
+
     # port 
     # default value
     config[constants.ANALYTICS_SERVICE_PORT] = constants.ANALYTICS_SERVICE_DEFAULT_PORT
@@ -106,6 +123,22 @@ def get_env_config():
     # log result
     logging.getLogger(__name__).info(f"The iter8 analytics server will listen on port {config[constants.ANALYTICS_SERVICE_PORT]}")
 
+    # posterior sample cache
+    # default value
+    config[constants.SAMPLE_CACHE_SIZE] = constants.SAMPLE_CACHE_DEFAULT_SIZE
+    # override with value in configFile
+    if constants.SAMPLE_CACHE_SIZE in configMap:
+        config[constants.SAMPLE_CACHE_SIZE] = int(configMap[constants.SAMPLE_CACHE_SIZE])
+    logging.getLogger(__name__).info(f"Posterior sample cache size is: {config[constants.SAMPLE_CACHE_SIZE]}")
+
+    # threads used for posterior sampling and criteria masks
+    # default value
+    config[constants.SAMPLING_THREADS] = constants.SAMPLING_DEFAULT_THREADS
+    # override with value in configFile
+    if constants.SAMPLING_THREADS in configMap:
+        config[constants.SAMPLING_THREADS] = max(1, int(configMap[constants.SAMPLING_THREADS]))
+    logging.getLogger(__name__).info(f"Posterior sampling threads: {config[constants.SAMPLING_THREADS]}")
+
     # metrics backend
     # default value
     config[constants.METRICS_BACKEND_CONFIG_URL] = constants.METRICS_BACKEND_CONFIG_DEFAULT_URL
@@ -114,6 +147,25 @@ def get_env_config():
         constants.METRICS_BACKEND_CONFIG_AUTH_TYPE: constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE
     }
     logging.getLogger(__name__).info(f"Set default auth as: {config[constants.METRICS_BACKEND_CONFIG_AUTH]}")
+    config[constants.METRICS_BACKEND_CONFIG_MAX_CONCURRENT_QUERIES] = constants.METRICS_BACKEND_CONFIG_DEFAULT_MAX_CONCURRENT_QUERIES
+    config[constants.METRICS_BACKEND_CONFIG_CONNECTION_POOL_SIZE] = constants.METRICS_BACKEND_CONFIG_DEFAULT_CONNECTION_POOL_SIZE
+    config[constants.METRICS_BACKEND_CONFIG_CONNECT_TIMEOUT] = constants.METRICS_BACKEND_CONFIG_DEFAULT_CONNECT_TIMEOUT
+    config[constants.METRICS_BACKEND_CONFIG_READ_TIMEOUT] = constants.METRICS_BACKEND_CONFIG_DEFAULT_READ_TIMEOUT
+    config[constants.METRICS_BACKEND_CONFIG_RATIOS_FROM_COUNTERS] = constants.METRICS_BACKEND_CONFIG_DEFAULT_RATIOS_FROM_COUNTERS
+    config[constants.METRICS_BACKEND_CONFIG_BATCH_COUNTER_QUERIES] = constants.METRICS_BACKEND_CONFIG_DEFAULT_BATCH_COUNTER_QUERIES
+    config[constants.METRICS_BACKEND_CONFIG_MAX_COUNTER_QUERIES_PER_BATCH] = constants.METRICS_BACKEND_CONFIG_DEFAULT_MAX_COUNTER_QUERIES_PER_BATCH
+    config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE] = constants.METRICS_BACKEND_CONFIG_DEFAULT_QUERY_CACHE_SIZE
+    config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_TTL] = constants.METRICS_BACKEND_CONFIG_DEFAULT_QUERY_CACHE_TTL
+    config[constants.METRICS_BACKEND_CONFIG_QUERY_TIME_ALIGNMENT] = constants.METRICS_BACKEND_CONFIG_DEFAULT_QUERY_TIME_ALIGNMENT
+    config[constants.METRICS_BACKEND_CONFIG_COALESCE_QUERIES] = constants.METRICS_BACKEND_CONFIG_DEFAULT_COALESCE_QUERIES
+    config[constants.METRICS_BACKEND_CONFIG_QUERY_BUDGET] = constants.METRICS_BACKEND_CONFIG_DEFAULT_QUERY_BUDGET
+    config[constants.METRICS_BACKEND_CONFIG_MAX_QUERY_RETRIES] = constants.METRICS_BACKEND_CONFIG_DEFAULT_MAX_QUERY_RETRIES
+    config[constants.METRICS_BACKEND_CONFIG_RETRY_BACKOFF] = constants.METRICS_BACKEND_CONFIG_DEFAULT_RETRY_BACKOFF
+    config[constants.METRICS_BACKEND_CONFIG_HEDGE_PERCENTILE] = constants.METRICS_BACKEND_CONFIG_DEFAULT_HEDGE_PERCENTILE
+    config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS] = []
+    config[constants.METRICS_BACKEND_CONFIG_RECORD_FILE] = None
+    config[constants.METRICS_BACKEND_CONFIG_REPLAY_FILE] = None
+    config[constants.METRICS_BACKEND_CONFIG_REPLAY_LATENCY] = constants.METRICS_BACKEND_CONFIG_DEFAULT_REPLAY_LATENCY
     # override with value in configFile
     if constants.METRICS_BACKEND_CONFIG_METRICS_BACKEND in configMap:
         backend = configMap[constants.METRICS_BACKEND_CONFIG_METRICS_BACKEND]
@@ -123,6 +175,47 @@ def get_env_config():
         if constants.METRICS_BACKEND_CONFIG_AUTH in backend:
             config[constants.METRICS_BACKEND_CONFIG_AUTH].update(backend[constants.METRICS_BACKEND_CONFIG_AUTH])
             logging.getLogger(__name__).info(f"Merged auth from config as: {config[constants.METRICS_BACKEND_CONFIG_AUTH]}")
+        if constants.METRICS_BACKEND_CONFIG_MAX_CONCURRENT_QUERIES in backend:
+            config[constants.METRICS_BACKEND_CONFIG_MAX_CONCURRENT_QUERIES] = int(backend[constants.METRICS_BACKEND_CONFIG_MAX_CONCURRENT_QUERIES])
+        if constants.METRICS_BACKEND_CONFIG_CONNECTION_POOL_SIZE in backend:
+            config[constants.METRICS_BACKEND_CONFIG_CONNECTION_POOL_SIZE] = int(backend[constants.METRICS_BACKEND_CONFIG_CONNECTION_POOL_SIZE])
+        if constants.METRICS_BACKEND_CONFIG_CONNECT_TIMEOUT in backend:
+            config[constants.METRICS_BACKEND_CONFIG_CONNECT_TIMEOUT] = float(backend[constants.METRICS_BACKEND_CONFIG_CONNECT_TIMEOUT])
+        if constants.METRICS_BACKEND_CONFIG_READ_TIMEOUT in backend:
+            config[constants.METRICS_BACKEND_CONFIG_READ_TIMEOUT] = float(backend[constants.METRICS_BACKEND_CONFIG_READ_TIMEOUT])
+        if constants.METRICS_BACKEND_CONFIG_RATIOS_FROM_COUNTERS in backend:
+            config[constants.METRICS_BACKEND_CONFIG_RATIOS_FROM_COUNTERS] = bool(backend[constants.METRICS_BACKEND_CONFIG_RATIOS_FROM_COUNTERS])
+        if constants.METRICS_BACKEND_CONFIG_BATCH_COUNTER_QUERIES in backend:
+            config[constants.METRICS_BACKEND_CONFIG_BATCH_COUNTER_QUERIES] = bool(backend[constants.METRICS_BACKEND_CONFIG_BATCH_COUNTER_QUERIES])
+        if constants.METRICS_BACKEND_CONFIG_MAX_COUNTER_QUERIES_PER_BATCH in backend:
+            config[constants.METRICS_BACKEND_CONFIG_MAX_COUNTER_QUERIES_PER_BATCH] = int(backend[constants.METRICS_BACKEND_CONFIG_MAX_COUNTER_QUERIES_PER_BATCH])
+        if constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE in backend:
+            config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE] = int(backend[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE])
+        if constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_TTL in backend:
+            config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_TTL] = float(backend[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_TTL])
+        if constants.METRICS_BACKEND_CONFIG_QUERY_TIME_ALIGNMENT in backend:
+            config[constants.METRICS_BACKEND_CONFIG_QUERY_TIME_ALIGNMENT] = int(backend[constants.METRICS_BACKEND_CONFIG_QUERY_TIME_ALIGNMENT])
+        if constants.METRICS_BACKEND_CONFIG_COALESCE_QUERIES in backend:
+            config[constants.METRICS_BACKEND_CONFIG_COALESCE_QUERIES] = bool(backend[constants.METRICS_BACKEND_CONFIG_COALESCE_QUERIES])
+        if constants.METRICS_BACKEND_CONFIG_QUERY_BUDGET in backend:
+            config[constants.METRICS_BACKEND_CONFIG_QUERY_BUDGET] = float(backend[constants.METRICS_BACKEND_CONFIG_QUERY_BUDGET])
+        if constants.METRICS_BACKEND_CONFIG_MAX_QUERY_RETRIES in backend:
+            config[constants.METRICS_BACKEND_CONFIG_MAX_QUERY_RETRIES] = int(backend[constants.METRICS_BACKEND_CONFIG_MAX_QUERY_RETRIES])
+        if constants.METRICS_BACKEND_CONFIG_RETRY_BACKOFF in backend:
+            config[constants.METRICS_BACKEND_CONFIG_RETRY_BACKOFF] = float(backend[constants.METRICS_BACKEND_CONFIG_RETRY_BACKOFF])
+        if constants.METRICS_BACKEND_CONFIG_HEDGE_PERCENTILE in backend:
+            config[constants.METRICS_BACKEND_CONFIG_HEDGE_PERCENTILE] = float(backend[constants.METRICS_BACKEND_CONFIG_HEDGE_PERCENTILE])
+        if constants.METRICS_BACKEND_CONFIG_REPLICA_URLS in backend:
+            config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS] = list(backend[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS] or [])
+        if constants.METRICS_BACKEND_CONFIG_RECORD_FILE in backend:
+            config[constants.METRICS_BACKEND_CONFIG_RECORD_FILE] = backend[constants.METRICS_BACKEND_CONFIG_RECORD_FILE]
+            logging.getLogger(__name__).info(f"Prometheus queries and responses will be recorded in {config[constants.METRICS_BACKEND_CONFIG_RECORD_FILE]}")
+        if constants.METRICS_BACKEND_CONFIG_REPLAY_FILE in backend:
+            config[constants.METRICS_BACKEND_CONFIG_REPLAY_FILE] = backend[constants.METRICS_BACKEND_CONFIG_REPLAY_FILE]
+            logging.getLogger(__name__).info(f"Prometheus responses will be replayed from {config[constants.METRICS_BACKEND_CONFIG_REPLAY_FILE]}")
+        if constants.METRICS_BACKEND_CONFIG_REPLAY_LATENCY in backend:
+            config[constants.METRICS_BACKEND_CONFIG_REPLAY_LATENCY] = float(backend[constants.METRICS_BACKEND_CONFIG_REPLAY_LATENCY])
+    logging.getLogger(__name__).info(f"At most {config[constants.METRICS_BACKEND_CONFIG_MAX_CONCURRENT_QUERIES]} concurrent queries will be sent to the backend metrics server")
     # override with value in environment variable (in which case no )
     if os.getenv(constants.METRICS_BACKEND_URL_ENV):
         config[constants.METRICS_BACKEND_CONFIG_URL] = os.getenv(constants.METRICS_BACKEND_URL_ENV)
@@ -134,8 +227,16 @@ def get_env_config():
     except ValidationError as e:
         logging.getLogger('iter8_analytics').critical(f'Prometheus URL {config[constants.METRICS_BACKEND_CONFIG_URL]} is invalid', e)
         sys.exit(1)
+    for replica_url in config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS]:
+        try:
+            val(replica_url)
+        except ValidationError as e:
+            logging.getLogger('iter8_analytics').critical(f'Prometheus replica URL {replica_url} is invalid', e)
+            sys.exit(1)
     # log result
     logging.getLogger(__name__).info(f"The backend metrics server is {config[constants.METRICS_BACKEND_CONFIG_URL]}")
+    if config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS]:
+        logging.getLogger(__name__).info(f"Replicas of the backend metrics server are {config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS]}")
 
     # debug mode
     # default is False
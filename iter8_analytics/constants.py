@@ -8,18 +8,31 @@ ITER8_ANALYTICS_LOG_LEVEL_ENV = 'ITER8_ANALYTICS_LOG_LEVEL' # used by fastapi
 ITER8_DATA_CAPTURE_MODE_ENV = 'ITER8_DATA_CAPTURE_MODE'
 
 ITER8_REQUEST_COUNT = 'iter8_request_count' # special metric indicating num requests to a version
+ITER8_METRIC_LABEL = '__iter8_metric' # synthetic label used to demultiplex batched counter queries
 
 METRICS_BACKEND_DEFAULT_CONFIGFILE = 'config.yaml'
 METRICS_BACKEND_CONFIGFILE_ENV = 'METRICS_BACKEND_CONFIGFILE'
 
 LOG_LEVEL = 'logLevel'
-LOG_LEVEL_DEFAULT_LEVEL = 'debug'
+LOG_LEVEL_DEFAULT_LEVEL = 'info'
+LOG_FORMAT = 'log_format'
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMAT_JSON = 'json'
+LOG_FORMAT_DEFAULT_FORMAT = LOG_FORMAT_TEXT
+DEBUG_SAMPLING_RATE = 'debug_sampling_rate'
+DEBUG_DEFAULT_SAMPLING_RATE = 1 # at debug level, every iteration is traced by default
+DEBUG_EXPERIMENTS = 'debug_experiments'
 
 ANALYTICS_SERVICE_PORT = 'ANALYTICS_SERVICE_PORT'
 ANALYTICS_SERVICE_DEFAULT_PORT = 8080
 ANALYTICS_SERVICE_CONFIGFILE_PORT = 'port'
 ANALYTICS_SERVICE_PORT_ENV = 'ITER8_ANALYTICS_SERVER_PORT'
 
+SAMPLE_CACHE_SIZE = 'sample_cache_size'
+SAMPLE_CACHE_DEFAULT_SIZE = 0 # caching is disabled by default
+SAMPLING_THREADS = 'sampling_threads'
+SAMPLING_DEFAULT_THREADS = 1 # sampling is serial by default
+
 METRICS_BACKEND_CONFIGFILE_URL = 'url'
 METRICS_BACKEND_CONFIGFILE_AUTH = 'auth'
 METRICS_BACKEND_URL_ENV = 'ITER8_ANALYTICS_METRICS_BACKEND_URL'
@@ -33,8 +46,44 @@ METRICS_BACKEND_CONFIG_AUTH = 'auth'
 METRICS_BACKEND_CONFIG_AUTH_TYPE = 'type'
 METRICS_BACKEND_CONFIG_AUTH_TYPE_NONE = 'none'
 METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC = 'basic'
+METRICS_BACKEND_CONFIG_AUTH_TYPE_TOKEN = 'token'
 METRICS_BACKEND_CONFIG_AUTH_USERNAME = 'username'
 METRICS_BACKEND_CONFIG_AUTH_PASSWORD = 'password'
 METRICS_BACKEND_CONFIG_AUTH_CA_FILE = 'ca_file'
 METRICS_BACKEND_CONFIG_AUTH_TOKEN = 'token'
-METRICS_BACKEND_CONFIG_AUTH_INSECURE_SKIP_VERIFY = 'insecure_skip_verify'
\ No newline at end of file
+METRICS_BACKEND_CONFIG_AUTH_INSECURE_SKIP_VERIFY = 'insecure_skip_verify'
+METRICS_BACKEND_CONFIG_MAX_CONCURRENT_QUERIES = 'max_concurrent_queries'
+METRICS_BACKEND_CONFIG_DEFAULT_MAX_CONCURRENT_QUERIES = 8
+METRICS_BACKEND_CONFIG_CONNECTION_POOL_SIZE = 'connection_pool_size'
+METRICS_BACKEND_CONFIG_DEFAULT_CONNECTION_POOL_SIZE = 10
+METRICS_BACKEND_CONFIG_CONNECT_TIMEOUT = 'connect_timeout_seconds'
+METRICS_BACKEND_CONFIG_DEFAULT_CONNECT_TIMEOUT = 5.0
+METRICS_BACKEND_CONFIG_READ_TIMEOUT = 'read_timeout_seconds'
+METRICS_BACKEND_CONFIG_DEFAULT_READ_TIMEOUT = 30.0
+METRICS_BACKEND_CONFIG_RATIOS_FROM_COUNTERS = 'ratios_from_counters'
+METRICS_BACKEND_CONFIG_DEFAULT_RATIOS_FROM_COUNTERS = True
+METRICS_BACKEND_CONFIG_BATCH_COUNTER_QUERIES = 'batch_counter_queries'
+METRICS_BACKEND_CONFIG_DEFAULT_BATCH_COUNTER_QUERIES = False
+METRICS_BACKEND_CONFIG_MAX_COUNTER_QUERIES_PER_BATCH = 'max_counter_queries_per_batch'
+METRICS_BACKEND_CONFIG_DEFAULT_MAX_COUNTER_QUERIES_PER_BATCH = 10
+METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE = 'query_cache_size'
+METRICS_BACKEND_CONFIG_DEFAULT_QUERY_CACHE_SIZE = 0 # caching is disabled by default
+METRICS_BACKEND_CONFIG_QUERY_CACHE_TTL = 'query_cache_ttl_seconds'
+METRICS_BACKEND_CONFIG_DEFAULT_QUERY_CACHE_TTL = 30.0
+METRICS_BACKEND_CONFIG_QUERY_TIME_ALIGNMENT = 'query_time_alignment_seconds'
+METRICS_BACKEND_CONFIG_DEFAULT_QUERY_TIME_ALIGNMENT = 10
+METRICS_BACKEND_CONFIG_COALESCE_QUERIES = 'coalesce_queries'
+METRICS_BACKEND_CONFIG_DEFAULT_COALESCE_QUERIES = True
+METRICS_BACKEND_CONFIG_QUERY_BUDGET = 'query_budget_seconds'
+METRICS_BACKEND_CONFIG_DEFAULT_QUERY_BUDGET = 60.0
+METRICS_BACKEND_CONFIG_MAX_QUERY_RETRIES = 'max_query_retries'
+METRICS_BACKEND_CONFIG_DEFAULT_MAX_QUERY_RETRIES = 2
+METRICS_BACKEND_CONFIG_RETRY_BACKOFF = 'retry_backoff_seconds'
+METRICS_BACKEND_CONFIG_DEFAULT_RETRY_BACKOFF = 0.1
+METRICS_BACKEND_CONFIG_HEDGE_PERCENTILE = 'hedge_percentile'
+METRICS_BACKEND_CONFIG_DEFAULT_HEDGE_PERCENTILE = 0.0
+METRICS_BACKEND_CONFIG_REPLICA_URLS = 'replica_urls'
+METRICS_BACKEND_CONFIG_RECORD_FILE = 'record_file'
+METRICS_BACKEND_CONFIG_REPLAY_FILE = 'replay_file'
+METRICS_BACKEND_CONFIG_REPLAY_LATENCY = 'replay_latency_ms'
+METRICS_BACKEND_CONFIG_DEFAULT_REPLAY_LATENCY = 0.0
\ No newline at end of file
@@ -16,6 +16,7 @@ from django.core.exceptions import ValidationError
 from iter8_analytics.api.analytics.types import ExperimentIterationParameters, Iter8AssessmentAndRecommendation
 #from iter8_analytics.api.analytics.experiment import Experiment
 import iter8_analytics.api.analytics.experiment as experiment
+from iter8_analytics.api.analytics.tracing import JsonFormatter
 from iter8_analytics.api.analytics.endpoints.examples import eip_example
 import iter8_analytics.constants as constants
 import iter8_analytics.config as config
@@ -24,13 +25,13 @@ import iter8_analytics.config as config
 app = FastAPI()
 
 @app.post("/assessment", response_model=Iter8AssessmentAndRecommendation)
-def provide_assessment_for_this_experiment_iteration(eip: ExperimentIterationParameters = Body(..., example=eip_example)):
+async def provide_assessment_for_this_experiment_iteration(eip: ExperimentIterationParameters = Body(..., example=eip_example)):
     """
     POST iter8 experiment iteration data and obtain assessment of how the versions are performing and recommendations on how to split traffic based on multiple strategies.
     \f
     :body eip: ExperimentIterationParameters
     """
-    run_result = experiment.Experiment(eip).run()
+    run_result = await experiment.Experiment(eip).run_async()
 
     logger = logging.getLogger('iter8_analytics')
     return run_result
@@ -42,11 +43,12 @@ def provide_iter8_analytics_health():
     return {"status": "Ok"}
 
 
-def config_logger(log_level = "debug"):
+def config_logger(log_level = "info", log_format = "text"):
     """Configures the global logger
 
     Args:
         log_level (str): log level ('debug', 'info', ...)
+        log_format (str): log format ('text' or 'json')
     """
     logger = logging.getLogger('iter8_analytics')
     handler = logging.StreamHandler()
@@ -67,13 +69,16 @@ def config_logger(log_level = "debug"):
         logger.setLevel(logging.DEBUG)
         handler.setLevel(logging.DEBUG)
 
-    formatter = logging.Formatter(
-        fmt='%(asctime)s - %(name)s - %(levelname)s'
-            ' - %(filename)s:%(lineno)d - %(message)s')
+    if str.lower(log_format) == constants.LOG_FORMAT_JSON:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            fmt='%(asctime)s - %(name)s - %(levelname)s'
+                ' - %(filename)s:%(lineno)d - %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
     logging.getLogger('iter8_analytics').debug("Configured logger")
 
 if __name__ == '__main__':
-    config_logger(config.env_config[constants.LOG_LEVEL])
+    config_logger(config.env_config[constants.LOG_LEVEL], config.env_config[constants.LOG_FORMAT])
     uvicorn.run('fastapi_app:app', host='0.0.0.0', port=int(config.env_config[constants.ANALYTICS_SERVICE_PORT]), log_level=config.env_config[constants.LOG_LEVEL])
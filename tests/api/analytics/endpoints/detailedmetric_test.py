@@ -83,4 +83,53 @@ class TestDetailedMetrics:
 
         rm.update_belief()
 
-
+    def test_batched_belief_sampling(self):
+        beliefs = [
+            [GaussianBelief(mean = 5.0, variance = 0.25), BetaBelief(alpha = 2.0, beta = 8.0)],
+            [ConstantBelief(value = 3.0), Belief(status = StatusEnum.uninitialized_belief)],
+            [GaussianBelief(mean = -1.0, variance = 1.0), BetaBelief(alpha = 0.1, beta = 0.1)]
+        ]
+        samples = sample_beliefs(beliefs, sample_size = 1000)
+        assert samples.shape == (3, 2, 1000)
+        assert samples.flags["C_CONTIGUOUS"]
+
+        # samples of beliefs are views into the batched buffer
+        assert beliefs[0][0].sample_posterior() is beliefs[0][0].sample
+        assert np.shares_memory(beliefs[0][0].sample, samples)
+        assert abs(np.mean(beliefs[0][0].sample) - 5.0) < 0.1
+        assert abs(np.mean(beliefs[0][1].sample) - 0.2) < 0.05
+        assert np.all(beliefs[1][0].sample == 3.0)
+        assert beliefs[1][1].sample is None and np.all(np.isnan(samples[1, 1]))
+        # samples are clipped at zero
+        assert np.min(beliefs[2][0].sample_posterior()) >= 0.0
+
+    def test_closed_form_statistics(self):
+        beliefs = [GaussianBelief(mean = 0.5, variance = 0.25), BetaBelief(alpha = 2.0, beta = 8.0), ConstantBelief(value = 3.0)]
+        sample_beliefs([beliefs], sample_size = 100000)
+        for b in beliefs:
+            sample = b.sample_posterior()
+            for value in [-0.1, 0.0, 0.2, 0.5, 3.0]:
+                assert abs(b.probability_at_most(value) - np.mean(sample <= value)) < 0.01
+                assert abs(b.probability_at_least(value) - np.mean(sample >= value)) < 0.01
+            for q in [0.025, 0.5, 0.975]:
+                assert abs(b.quantile(q) - np.percentile(sample, q * 100.0)) < 0.02
+
+    def test_quasi_monte_carlo_sampling(self):
+        beliefs = [
+            [GaussianBelief(mean = 5.0, variance = 0.25), BetaBelief(alpha = 2.0, beta = 8.0)],
+            [ConstantBelief(value = 3.0), Belief(status = StatusEnum.uninitialized_belief)]
+        ]
+        rng = np.random.default_rng(7)
+        engine = create_qmc_engine(beliefs, rng)
+        assert engine.d == 2
+        samples = sample_beliefs(beliefs, sample_size = 1024, rng = rng, qmc_engine = engine)
+        # low discrepancy points estimate moments far more accurately than 1024 independent draws
+        assert abs(np.mean(samples[0, 0]) - 5.0) < 0.002
+        assert abs(np.mean(samples[0, 1]) - 0.2) < 0.001
+        assert np.all(samples[1, 0] == 3.0)
+        assert np.all(np.isnan(samples[1, 1]))
+
+        # further chunks continue the sequence
+        samples = sample_beliefs(beliefs, sample_size = 1024, rng = rng, qmc_engine = engine, previous_samples = samples)
+        assert samples.shape == (2, 2, 2048)
+        assert abs(np.mean(samples[0, 0]) - 5.0) < 0.001
@@ -1,12 +1,17 @@
 """Tests for module iter8_analytics.api.analytics.endpoints.metrics_test"""
 # standard python stuff
 import logging
-from datetime import datetime,timezone
+from datetime import datetime, timedelta, timezone
 import json
 from pprint import pformat
 import time
+import asyncio
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 # python libraries
+import numpy as np
+import requests
 import requests_mock
 from fastapi import HTTPException
 
@@ -16,6 +21,11 @@ from iter8_analytics.api.analytics.types import *
 import iter8_analytics.constants as constants
 import iter8_analytics.config as config
 from iter8_analytics.api.analytics.experiment import Experiment
+from iter8_analytics.api.analytics.detailedmetric import BetaBelief
+import iter8_analytics.api.analytics.experiment as experiment_module
+import iter8_analytics.api.analytics.metrics as metrics
+import iter8_analytics.api.analytics.metricsbackend as metricsbackend
+from iter8_analytics.api.analytics.metricsbackend import MetricsBackend
 from iter8_analytics.api.analytics.endpoints.examples import *
 
 env_config = config.get_env_config()
@@ -122,6 +132,21 @@ class TestExperiment:
         except HTTPException as he:
             pass
 
+    def test_invalid_query_template(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            eg = copy.deepcopy(eip_example)
+            eg["metric_specs"]["counter_metrics"][0]["query_template"] = "sum(increase(istio_requests_total[$duration])) by ($version_labels)"
+            eip = ExperimentIterationParameters(** eg)
+            try:
+                exp = Experiment(eip)
+                assert False
+            except HTTPException as he:
+                assert he.status_code == 422
+                assert he.detail.startswith(StatusEnum.invalid_query_template.value)
+            assert m.call_count == 0
+
     def test_get_ratio_max_min(self):
         with requests_mock.mock(real_http=True) as m:
             m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
@@ -163,6 +188,39 @@ class TestExperiment:
 
             # logger.info(f"mert:{time.time()}")
 
+    def test_sample_size(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+            eg = copy.deepcopy(eip_with_assessment)
+            # relative threshold close to the ratio of mean latencies of productpage-v3 and the baseline makes its threshold assessment uncertain
+            eg["criteria"][0]["threshold"] = {
+                "threshold_type": "relative",
+                "value": 0.86
+            }
+            eg["traffic_control"]["sample_size"] = 2000
+            exp = Experiment(ExperimentIterationParameters(** eg))
+            res = exp.run()
+            assert res.sampling.sample_size == 2000
+            assert exp.ratio_metric_samples.shape[2] == 2000
+            assert exp.utilities.shape[0] == 2000
+            assert 0.005 < res.sampling.standard_error < 0.02
+
+            # adaptive sampling doubles the sample until the target error or the maximum sample size is reached
+            eg["traffic_control"]["adaptive_sampling"] = True
+            eg["traffic_control"]["target_standard_error"] = 0.005
+            exp = Experiment(ExperimentIterationParameters(** eg))
+            res = exp.run()
+            assert res.sampling.sample_size in [8000, 16000, 32000]
+            assert res.sampling.standard_error <= 0.005
+            assert exp.utilities.shape[0] == res.sampling.sample_size
+
+            eg["traffic_control"]["max_sample_size"] = 5000
+            exp = Experiment(ExperimentIterationParameters(** eg))
+            res = exp.run()
+            assert res.sampling.sample_size == 5000
+            assert res.sampling.standard_error > 0.005
+
 
 class TestDetailedVersion:
     def test_detailed_version(self):
@@ -278,3 +336,229 @@ class TestAssessmentsAndLastState:
                 assert False # the test shouldn't reach this line
             except HTTPException as e:
                 pass
+
+    def test_ratio_metric_comparisons(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+            eip = ExperimentIterationParameters(** eip_with_assessment)
+            exp = Experiment(eip)
+            res = exp.run()
+
+            # comparisons match those computed one version at a time
+            latencies = {version_id: exp.detailed_versions[version_id].metrics["ratio_metrics"]["iter8_mean_latency"].belief.sample for version_id in exp.version_ids}
+            baseline_latency = latencies[exp.detailed_baseline_version.id]
+            best = np.argmin(np.array([latencies[version_id] for version_id in exp.version_ids]), axis = 0)
+            for index, version_id in enumerate(exp.version_ids):
+                comparisons = exp.get_ratio_metric_comparisons("iter8_mean_latency", version_id)
+                assert comparisons["probability_of_being_best_version"] == np.mean(best == index)
+                if version_id == exp.detailed_baseline_version.id:
+                    assert comparisons["probability_of_beating_baseline"] is None
+                    assert comparisons["improvement_over_baseline"] is None
+                else:
+                    assert comparisons["probability_of_beating_baseline"] == np.mean(latencies[version_id] < baseline_latency)
+                    improvement = (baseline_latency - latencies[version_id]) / baseline_latency * 100.0
+                    assert abs(comparisons["improvement_over_baseline"].lower - np.percentile(improvement, 2.5)) < 1.0e-9
+
+            for c in res.candidate_assessments:
+                if c.id == 'productpage-v3':
+                    assert c.criterion_assessments[0].statistics.ratio_statistics.probability_of_beating_baseline == 1.0
+
+    def test_improvement_over_baseline_near_zero(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            for seed in range(4):
+                eg = copy.deepcopy(eip_with_relative_assessments)
+                eg["random_seed"] = seed
+                exp = Experiment(ExperimentIterationParameters(** eg))
+                exp.run()
+                # the baseline error rate has no errors, so its posterior has most of its mass near zero
+                error_rate = exp.detailed_versions[exp.detailed_baseline_version.id].metrics["ratio_metrics"]["iter8_error_rate"].belief
+                assert isinstance(error_rate, BetaBelief)
+                assert error_rate.alpha < 1.0
+                for version_id in exp.version_ids:
+                    assert exp.get_ratio_metric_comparisons("iter8_error_rate", version_id)["improvement_over_baseline"] is None
+                # baselines bounded away from zero still get improvements
+                for version_id in exp.version_ids:
+                    if version_id != exp.detailed_baseline_version.id and exp.get_ratio_metric_comparisons("iter8_mean_latency", version_id)["probability_of_beating_baseline"] is not None:
+                        assert exp.get_ratio_metric_comparisons("iter8_mean_latency", version_id)["improvement_over_baseline"] is not None
+
+    def test_seeded_iterations(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+            eg = copy.deepcopy(eip_with_assessment)
+            eg["criteria"][0]["threshold"] = {
+                "threshold_type": "relative",
+                "value": 0.86
+            }
+            eg["random_seed"] = 42
+            eg["iteration_number"] = 3
+
+            def run(eg):
+                exp = Experiment(ExperimentIterationParameters(** eg))
+                res = exp.run()
+                return exp, res
+
+            exp1, res1 = run(eg)
+            exp2, res2 = run(eg)
+            # iterations with the same seed and iteration number are replayed exactly
+            assert np.array_equal(exp1.ratio_metric_samples, exp2.ratio_metric_samples)
+            assert res1.traffic_split_recommendation == res2.traffic_split_recommendation
+            assert res1.candidate_assessments == res2.candidate_assessments
+
+            eg["iteration_number"] = 4
+            exp3, res3 = run(eg)
+            assert not np.array_equal(exp1.ratio_metric_samples, exp3.ratio_metric_samples)
+
+            # child streams are independent of each other, and reproducible
+            rngs = exp1.spawn_rngs(2)
+            assert rngs[0].random() != rngs[1].random()
+            assert Experiment(ExperimentIterationParameters(** eg)).spawn_rngs(1)[0].random() == exp3.spawn_rngs(1)[0].random()
+
+    def test_quasi_monte_carlo_sampling(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+            eg = copy.deepcopy(eip_with_assessment)
+            eg["traffic_control"]["sampling_method"] = "quasi_monte_carlo"
+            eg["traffic_control"]["sample_size"] = 1024
+            exp = Experiment(ExperimentIterationParameters(** eg))
+            res = exp.run()
+            assert exp.qmc_engine is not None
+            assert res.sampling.sample_size == 1024
+            for c in res.candidate_assessments:
+                if c.id == 'productpage-v3':
+                    assert c.win_probability == 1.0
+
+            # other sample sizes are rounded up to a power of 2, which keeps the balance properties of Sobol points
+            del eg["traffic_control"]["sample_size"]
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", UserWarning)
+                res = Experiment(ExperimentIterationParameters(** eg)).run()
+            assert res.sampling.sample_size == 16384
+
+    def test_parallel_sampling(self):
+        original_threads = config.env_config[constants.SAMPLING_THREADS]
+        config.env_config[constants.SAMPLING_THREADS] = 4
+        experiment_module._sampling_executor = None
+        try:
+            with requests_mock.mock(real_http=True) as m:
+                m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+                eg = copy.deepcopy(eip_with_assessment)
+                eg["random_seed"] = 42
+                eg["traffic_control"]["sample_size"] = 20000
+
+                exp1 = Experiment(ExperimentIterationParameters(** eg))
+                res1 = exp1.run()
+                exp2 = Experiment(ExperimentIterationParameters(** eg))
+                res2 = exp2.run()
+                # results do not depend on the scheduling of threads
+                assert np.array_equal(exp1.ratio_metric_samples, exp2.ratio_metric_samples, equal_nan = True)
+                assert np.array_equal(exp1.criteria_mask, exp2.criteria_mask)
+                assert res1.traffic_split_recommendation == res2.traffic_split_recommendation
+
+                # partitions are drawn from independent streams
+                samples = exp1.ratio_metric_samples[0, 0]
+                assert not np.array_equal(samples[:5000], samples[5000:10000])
+                for c in res1.candidate_assessments:
+                    if c.id == 'productpage-v3':
+                        assert c.win_probability == 1.0
+        finally:
+            config.env_config[constants.SAMPLING_THREADS] = original_threads
+            experiment_module._sampling_executor = None
+
+    def test_selected_traffic_split_strategy(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+            eg = copy.deepcopy(eip_with_assessment)
+            exp = Experiment(ExperimentIterationParameters(** eg))
+            res = exp.run()
+            # only the selected strategy is computed, and lts masks are skipped
+            assert list(res.traffic_split_recommendation) == [TrafficSplitStrategy.progressive]
+            assert exp.criteria_mask_lts is None
+            assert sum(res.traffic_split_recommendation[TrafficSplitStrategy.progressive].values()) == 100
+
+            eg["traffic_control"]["strategy"] = TrafficSplitStrategy.top_2_lts
+            eg["last_state"] = res.last_state
+            res = Experiment(ExperimentIterationParameters(** eg)).run()
+            assert list(res.traffic_split_recommendation) == [TrafficSplitStrategy.top_2_lts]
+
+            eg["traffic_control"]["all_strategies"] = True
+            res = Experiment(ExperimentIterationParameters(** eg)).run()
+            assert list(res.traffic_split_recommendation) == list(TrafficSplitStrategy)
+
+    def test_exp3_log_weights(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            # no reward metric, so pseudo rewards are used
+            eg = copy.deepcopy(eip_example)
+            eg["traffic_control"] = {"strategy": TrafficSplitStrategy.exp3, "sample_size": 1000}
+            res = Experiment(ExperimentIterationParameters(** eg)).run()
+            log_weights = res.last_state["exp3_log_weights"]
+            assert max(log_weights.values()) == 0.0
+            assert sum(res.traffic_split_recommendation[TrafficSplitStrategy.exp3].values()) == 100
+
+            # weights neither overflow nor collapse, however far apart they drift
+            eg["last_state"] = res.last_state
+            eg["last_state"]["exp3_log_weights"] = {version_id: -1.0e6 * i for i, version_id in enumerate(log_weights)}
+            res = Experiment(ExperimentIterationParameters(** eg)).run()
+            assert all(np.isfinite(list(res.last_state["exp3_log_weights"].values())))
+            assert sum(res.traffic_split_recommendation[TrafficSplitStrategy.exp3].values()) == 100
+
+    def test_run_async(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+            eg = copy.deepcopy(eip_with_assessment)
+            eg["random_seed"] = 42
+            eg["traffic_control"]["sample_size"] = 1000
+            res = Experiment(ExperimentIterationParameters(** eg)).run()
+
+            # concurrent iterations wait on their queries in one event loop, and match the synchronous iteration
+            async def run_concurrently(n):
+                return await asyncio.gather(*[Experiment(ExperimentIterationParameters(** eg)).run_async() for _ in range(n)])
+            for async_res in asyncio.run(run_concurrently(8)):
+                assert async_res.traffic_split_recommendation == res.traffic_split_recommendation
+                assert async_res.candidate_assessments == res.candidate_assessments
+
+    def test_run_async_under_load(self):
+        class SlowMetricsBackend(MetricsBackend):
+            """Backend which answers every query with no data after a fixed latency, and times out queries which outlast their deadline"""
+            def __init__(self, latency, budget):
+                super().__init__("slow://", budget)
+                self.latency = latency
+
+            def query(self, params, keep_series = None, deadline = None):
+                if deadline is None:
+                    deadline = self.get_deadline()
+                time.sleep(self.latency)
+                if time.monotonic() > deadline:
+                    raise requests.Timeout("Query budget exhausted")
+                return {"status": "success", "data": {"resultType": "vector", "result": []}}
+
+        original_backend, original_executor = metricsbackend._metrics_backend, metrics._query_executor
+        # the queue of the query executor holds several times the query budget worth of queries
+        metricsbackend._metrics_backend = SlowMetricsBackend(latency = 0.02, budget = 0.5)
+        metrics._query_executor = ThreadPoolExecutor(max_workers = 2)
+        try:
+            def get_eip(i):
+                eg = copy.deepcopy(eip_with_assessment)
+                eg["traffic_control"]["sample_size"] = 1000
+                # distinct start times make distinct queries, which are not coalesced
+                eg["start_time"] = (datetime.now(timezone.utc) - timedelta(hours = 1, seconds = i)).isoformat()
+                return ExperimentIterationParameters(** eg)
+
+            async def run_concurrently(n):
+                return await asyncio.gather(*[Experiment(get_eip(i)).run_async() for i in range(n)])
+            start = time.monotonic()
+            results = asyncio.run(run_concurrently(32))
+            assert time.monotonic() - start > metricsbackend._metrics_backend.budget
+            assert len(results) == 32
+        finally:
+            metrics._query_executor.shutdown()
+            metricsbackend._metrics_backend, metrics._query_executor = original_backend, original_executor
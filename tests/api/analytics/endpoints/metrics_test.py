@@ -3,6 +3,8 @@
 import logging
 import requests_mock
 import json
+import threading
+import asyncio
 
 # iter8 stuff
 from iter8_analytics import fastapi_app
@@ -136,6 +138,14 @@ class TestMetrics:
                 for metric in cm[version]:
                     assert cm[version][metric].value is not None
 
+            # the async variant waits on the same queries without blocking the event loop
+            async_cm = asyncio.run(get_counter_metrics_async(
+                counter_metric_specs, 
+                versions, 
+                datetime.now(timezone.utc) - timedelta(hours = 1)
+            ))
+            assert {version: {metric: dp.value for metric, dp in async_cm[version].items()} for version in async_cm} == {version: {metric: dp.value for metric, dp in cm[version].items()} for version in cm}
+
     def test_get_ratio_metrics(self):
         counter_metric_specs = {
             "iter8_request_count":  CounterMetricSpec(** {
@@ -337,4 +347,284 @@ class TestMetrics:
         assert len(nrmm) == 3
         assert nrmm["metric1"] == RatioMaxMin(minimum = 0.1, maximum = 0.3)
         assert nrmm["metric2"] == RatioMaxMin(minimum = 0.2, maximum = 0.2)
-        assert nrmm["metric3"] == RatioMaxMin()
\ No newline at end of file
+        assert nrmm["metric3"] == RatioMaxMin()
+
+    def test_concurrent_counter_metric_queries(self):
+        counter_metric_specs = {
+            f"counter_{i}": CounterMetricSpec(** {
+                "id": f"counter_{i}",
+                "query_template": f"sum(increase(counter_{i}[$interval])) by ($version_labels)"
+            }) for i in range(4)
+        }
+
+        versions = [Version(
+            id="reviews-v1",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v1"
+            }), Version(
+            id="reviews-v2",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v2"
+            })
+        ]
+
+        sample_response = json.load(open("tests/data/prometheus_sample_response.json"))
+        query_threads = set()
+
+        def record_thread(request, context):
+            query_threads.add(threading.current_thread().name)
+            return sample_response
+
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=record_thread)
+
+            cm = get_counter_metrics(
+                counter_metric_specs, 
+                versions, 
+                datetime.now(timezone.utc) - timedelta(hours = 1)
+            )
+
+            # queries are sent from the bounded query executor, not the calling thread
+            assert query_threads
+            assert all(name.startswith("iter8-metrics-query") for name in query_threads)
+            assert len(cm) == 2
+            for version in cm:
+                assert len(cm[version]) == 4
+                for metric in cm[version]:
+                    assert cm[version][metric].value is not None
+
+    def test_ratio_metrics_derived_from_counter_metrics(self):
+        counter_metric_specs = {
+            "iter8_request_count":  CounterMetricSpec(** {
+                "id": "iter8_request_count",
+                "query_template": "sum(increase(istio_requests_total{reporter='source'}[$interval])) by ($version_labels)"
+            }),
+            "iter8_total_latency": CounterMetricSpec(** {
+                "id": "iter8_total_latency",
+                "query_template": "sum(increase(istio_request_duration_milliseconds_sum{reporter='source'}[$interval])) by ($version_labels)"
+            }),
+            "conversion_count": CounterMetricSpec(** {
+                "id": "conversion_count",
+                "query_template": "sum(increase(newsletter_signups[$interval])) by ($version_labels)"
+            })
+        }
+
+        ratio_metric_specs = {
+            "iter8_mean_latency": RatioMetricSpec(** {
+                "id": "iter8_mean_latency",
+                "numerator": "iter8_total_latency",
+                "denominator": "iter8_request_count",
+                "preferred_direction": "lower"
+            }),
+            "conversion_rate":  RatioMetricSpec(** {
+                "id": "conversion_rate",
+                "numerator": "conversion_count",
+                "denominator": "iter8_request_count",
+                "preferred_direction": "higher"
+            })
+        }
+
+        versions = [Version(
+            id="reviews-v1",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v1"
+            }), Version(
+            id="reviews-v4",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v4"
+            })
+        ]
+
+        assert get_server_side_ratio_metric_specs(ratio_metric_specs, counter_metric_specs) == {}
+        assert len(get_server_side_ratio_metric_specs(ratio_metric_specs, {})) == 2
+
+        def match_newsletter_query(req):
+            return "newsletter_signups" in req.path_url
+
+        def match_non_newsletter_query(req):
+            return "newsletter_signups" not in req.path_url
+
+        with requests_mock.mock(real_http=True) as m:
+            m.register_uri('GET', metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")), additional_matcher = match_non_newsletter_query)
+            m.register_uri('GET', metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")), additional_matcher = match_newsletter_query)
+
+            start_time = datetime.now(timezone.utc) - timedelta(hours = 1)
+            cm = get_counter_metrics(counter_metric_specs, versions, start_time)
+            assert m.call_count == 3
+
+            rm = collect_ratio_metrics(ratio_metric_specs, {}, cm, versions, cm)
+            assert m.call_count == 3 # no additional queries for ratio metrics
+
+            # both counters come from the same sample response
+            assert rm["reviews-v1"]["iter8_mean_latency"].value == 1.0
+            # numerator is absent for a version with a non-zero denominator
+            assert rm["reviews-v1"]["conversion_rate"].value == 0.0
+            assert rm["reviews-v1"]["conversion_rate"].status == StatusEnum.zeroed_ratio
+            # version is absent in prometheus response
+            assert rm["reviews-v4"]["iter8_mean_latency"].value is None
+            assert rm["reviews-v4"]["iter8_mean_latency"].status == StatusEnum.absent_version_in_prom_response
+
+    def test_identical_counter_templates_are_queried_once(self):
+        counter_metric_specs = {
+            "iter8_request_count":  CounterMetricSpec(** {
+                "id": "iter8_request_count",
+                "query_template": "sum(increase(istio_requests_total{reporter='source'}[$interval])) by ($version_labels)"
+            }),
+            "request_count_copy":  CounterMetricSpec(** {
+                "id": "request_count_copy",
+                "query_template": "sum(increase(istio_requests_total{reporter='source'}[$interval])) by ($version_labels)"
+            })
+        }
+
+        versions = [Version(
+            id="reviews-v1",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v1"
+            })
+        ]
+
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            cm = get_counter_metrics(counter_metric_specs, versions, datetime.now(timezone.utc) - timedelta(hours = 1))
+            assert m.call_count == 1
+            assert cm["reviews-v1"]["iter8_request_count"].value == cm["reviews-v1"]["request_count_copy"].value
+
+    def test_batched_counter_metric_queries(self):
+        counter_metric_specs = {
+            "iter8_request_count":  CounterMetricSpec(** {
+                "id": "iter8_request_count",
+                "query_template": "sum(increase(istio_requests_total{reporter='source'}[$interval])) by ($version_labels)"
+            }),
+            "iter8_total_latency": CounterMetricSpec(** {
+                "id": "iter8_total_latency",
+                "query_template": "sum(increase(istio_request_duration_milliseconds_sum{reporter='source'}[$interval])) by ($version_labels)"
+            }),
+            "conversion_count": CounterMetricSpec(** {
+                "id": "conversion_count",
+                "query_template": "sum(increase(newsletter_signups[$interval])) by ($version_labels)"
+            })
+        }
+
+        versions = [Version(
+            id="reviews-v1",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v1"
+            }), Version(
+            id="reviews-v2",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v2"
+            })
+        ]
+
+        def series(tag, workload, value):
+            return {
+                "metric": {
+                    constants.ITER8_METRIC_LABEL: tag,
+                    "destination_service_namespace": "default",
+                    "destination_workload": workload
+                },
+                "value": [1556823494.744, value]
+            }
+
+        # tags are positions of the templates within the batch
+        batched_response = {
+            "status": "success",
+            "data": {
+                "resultType": "vector",
+                "result": [
+                    series("0", "reviews-v1", "100"),
+                    series("0", "reviews-v2", "200"),
+                    series("1", "reviews-v1", "1500.5"),
+                    series("1", "reviews-v2", "3000.5"),
+                    series("1", "unknown", "3")
+                ]
+            }
+        }
+
+        batch_config = {
+            constants.METRICS_BACKEND_CONFIG_BATCH_COUNTER_QUERIES: True,
+            constants.METRICS_BACKEND_CONFIG_MAX_COUNTER_QUERIES_PER_BATCH: 10
+        }
+        original_config = {key: config.env_config[key] for key in batch_config}
+        config.env_config.update(batch_config)
+        try:
+            with requests_mock.mock(real_http=True) as m:
+                m.get(metrics_endpoint, json=batched_response)
+
+                cm = get_counter_metrics(
+                    counter_metric_specs, 
+                    versions, 
+                    datetime.now(timezone.utc) - timedelta(hours = 1)
+                )
+
+                assert m.call_count == 1
+                query = m.last_request.qs["query"][0]
+                assert query.count("label_replace") == 3
+                assert constants.ITER8_METRIC_LABEL in query
+        finally:
+            config.env_config.update(original_config)
+
+        assert cm["reviews-v1"]["iter8_request_count"].value == 100
+        assert cm["reviews-v2"]["iter8_request_count"].value == 200
+        assert cm["reviews-v1"]["iter8_total_latency"].value == 1500.5
+        assert cm["reviews-v2"]["iter8_total_latency"].value == 3000.5
+        assert cm["reviews-v1"]["conversion_count"].value == 0
+        assert cm["reviews-v1"]["conversion_count"].status == StatusEnum.no_versions_in_prom_response
+
+    def test_version_label_matchers(self):
+        counter_metric_specs = {
+            "iter8_request_count":  CounterMetricSpec(** {
+                "id": "iter8_request_count",
+                "query_template": "sum(increase(istio_requests_total{reporter='source',$version_label_matchers}[$interval])) by ($version_labels)"
+            })
+        }
+
+        versions = [Version(
+            id="reviews-v1",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v1"
+            }), Version(
+            id="reviews-v2",
+            version_labels={
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v2"
+            })
+        ]
+
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            cm = get_counter_metrics(counter_metric_specs, versions, datetime.now(timezone.utc) - timedelta(hours = 1))
+            query = m.last_request.qs["query"][0]
+            assert 'destination_service_namespace="default"' in query
+            assert 'destination_workload=~"reviews\\\\-v1|reviews\\\\-v2"' in query
+            assert set(cm.keys()) == {"reviews-v1", "reviews-v2"}
+
+    def test_compiled_query_templates(self):
+        query_template = "sum(increase(istio_requests_total{reporter='source',$version_label_matchers}[${interval}])) by ($version_labels) * $$1"
+        version_label_keys = ("destination_service_namespace", "destination_workload")
+        compiled = compile_query_template(query_template, version_label_keys)
+        assert compiled is compile_query_template(query_template, version_label_keys)
+
+        query_args = {
+            "interval": "3600s",
+            "version_label_matchers": 'destination_workload="reviews-v1"'
+        }
+        assert compiled.render(query_args) == Template(query_template).substitute(
+            version_labels = ",".join(version_label_keys), **query_args)
+
+        for invalid_template in ["sum(requests[$duration])", "sum(requests[$interval]) $"]:
+            try:
+                compile_query_template(invalid_template, version_label_keys)
+                assert False
+            except HTTPException as he:
+                assert he.status_code == 422
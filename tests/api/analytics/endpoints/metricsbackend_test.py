@@ -0,0 +1,206 @@
+"""Tests for module iter8_analytics.api.analytics.metricsbackend"""
+# standard python stuff
+import logging
+import requests_mock
+import json
+import copy
+import gzip
+import pytest
+import time
+import requests
+from datetime import datetime, timedelta, timezone
+
+# iter8 stuff
+from iter8_analytics import fastapi_app
+import iter8_analytics.constants as constants
+import iter8_analytics.config as config
+import iter8_analytics.api.analytics.metricsbackend as metricsbackend
+from iter8_analytics.api.analytics.metricsbackend import *
+from iter8_analytics.api.analytics.types import CounterMetricSpec, Version
+from iter8_analytics.api.analytics.metrics import get_counter_metrics
+
+env_config = config.get_env_config()
+fastapi_app.config_logger(env_config[constants.LOG_LEVEL])
+logger = logging.getLogger('iter8_analytics')
+
+metrics_backend_url = env_config[constants.METRICS_BACKEND_CONFIG_URL]
+metrics_endpoint = f'{metrics_backend_url}/api/v1/query'
+
+class TestPrometheusClient:
+    def test_client_is_shared(self):
+        assert get_prometheus_client() is get_prometheus_client()
+
+    def test_no_auth(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            client = PrometheusClient(env_config)
+            res = client.query({'query': 'up'})
+            assert res["status"] == "success"
+            assert m.last_request.qs["query"] == ["up"]
+            assert m.last_request.headers["Accept-Encoding"] == "gzip"
+            assert "Authorization" not in m.last_request.headers
+
+    def test_basic_auth(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            basic_config = copy.deepcopy(env_config)
+            basic_config[constants.METRICS_BACKEND_CONFIG_AUTH] = {
+                constants.METRICS_BACKEND_CONFIG_AUTH_TYPE: constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_BASIC,
+                constants.METRICS_BACKEND_CONFIG_AUTH_USERNAME: "user",
+                constants.METRICS_BACKEND_CONFIG_AUTH_PASSWORD: "secret",
+                constants.METRICS_BACKEND_CONFIG_AUTH_INSECURE_SKIP_VERIFY: True
+            }
+            client = PrometheusClient(basic_config)
+            assert client.session.verify is False
+            client.query({'query': 'up'})
+            assert m.last_request.headers["Authorization"].startswith("Basic ")
+
+    def test_token_auth(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            token_config = copy.deepcopy(env_config)
+            token_config[constants.METRICS_BACKEND_CONFIG_AUTH] = {
+                constants.METRICS_BACKEND_CONFIG_AUTH_TYPE: constants.METRICS_BACKEND_CONFIG_AUTH_TYPE_TOKEN,
+                constants.METRICS_BACKEND_CONFIG_AUTH_TOKEN: "abc123",
+                constants.METRICS_BACKEND_CONFIG_AUTH_CA_FILE: "/etc/prometheus/ca.crt"
+            }
+            client = PrometheusClient(token_config)
+            assert client.session.verify == "/etc/prometheus/ca.crt"
+            client.query({'query': 'up'})
+            assert m.last_request.headers["Authorization"] == "Bearer abc123"
+
+    def test_retries(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, [
+                {'status_code': 503},
+                {'json': json.load(open("tests/data/prometheus_sample_response.json"))}
+            ])
+
+            retry_config = copy.deepcopy(env_config)
+            retry_config[constants.METRICS_BACKEND_CONFIG_RETRY_BACKOFF] = 0.001
+            client = PrometheusClient(retry_config)
+            assert client.query({'query': 'up'})["status"] == "success"
+            assert m.call_count == 2
+            assert client.stats()["retries"] == 1
+
+    def test_retries_against_replicas(self):
+        replica_url = "http://prometheus-replica:9090"
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, exc = requests.ConnectionError)
+            m.get(f"{replica_url}/api/v1/query", json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            replica_config = copy.deepcopy(env_config)
+            replica_config[constants.METRICS_BACKEND_CONFIG_RETRY_BACKOFF] = 0.001
+            replica_config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS] = [replica_url]
+            client = PrometheusClient(replica_config)
+            assert client.query({'query': 'up'})["status"] == "success"
+            assert m.last_request.url.startswith(replica_url)
+
+    def test_deadline(self):
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            client = PrometheusClient(env_config)
+            with pytest.raises(requests.Timeout):
+                client.query({'query': 'up'}, deadline = time.monotonic() - 1.0)
+            assert m.call_count == 0
+
+    def test_hedged_requests(self):
+        replica_url = "http://prometheus-replica:9090"
+        hedge_config = copy.deepcopy(env_config)
+        hedge_config[constants.METRICS_BACKEND_CONFIG_HEDGE_PERCENTILE] = 90.0
+        hedge_config[constants.METRICS_BACKEND_CONFIG_REPLICA_URLS] = [replica_url]
+        client = PrometheusClient(hedge_config)
+        assert client.get_hedge_delay() is None # too few latencies observed
+        client.latencies.extend([0.01] * 30)
+        assert client.get_hedge_delay() == 0.01
+
+        def query_once(url, params, keep_series, deadline):
+            if url == client.query_url:
+                time.sleep(1.0) # slow primary
+            return {"status": "success", "url": url}
+        client.query_once = query_once
+
+        start = time.monotonic()
+        assert client.query({'query': 'up'})["url"] == f"{replica_url}/api/v1/query"
+        assert time.monotonic() - start < 0.5
+        assert client.stats()["hedges"] == 1
+
+class TestParseQueryResponse:
+    def chunked(self, body, size):
+        data = json.dumps(body).encode("utf-8")
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_series_are_filtered_while_parsing(self):
+        body = json.load(open("tests/data/prometheus_sample_response.json"))
+        keep = lambda labels: labels.get("destination_workload", "").startswith("reviews")
+        expected = [series for series in body["data"]["result"] if keep(series["metric"])]
+        for size in [1, 7, 64, 100000]:
+            res = parse_query_response(self.chunked(body, size), keep)
+            assert res["status"] == "success"
+            assert res["data"]["resultType"] == "vector"
+            assert res["data"]["result"] == expected
+        assert parse_query_response(self.chunked(body, 5)) == body
+
+    def test_non_series_responses(self):
+        error = {"status": "error", "errorType": "bad_data", "error": "parse error"}
+        assert parse_query_response(self.chunked(error, 3), lambda labels: False) == error
+        scalar = {"status": "success", "data": {"resultType": "scalar", "result": [1556823494.744, "1"]}}
+        assert parse_query_response(self.chunked(scalar, 3), lambda labels: False) == scalar
+        with pytest.raises(ValueError):
+            parse_query_response(self.chunked(json.load(open("tests/data/prometheus_sample_response.json")), 9)[:-20])
+
+class TestRecordReplay:
+    def test_record_and_replay(self, tmp_path):
+        record_file = str(tmp_path / "recording.jsonl.gz")
+        query = "sum(increase(istio_requests_total{reporter='source'}[3600s])) by (destination_workload)"
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+            recorder = RecordingMetricsBackend(PrometheusClient(env_config), record_file)
+            keep = lambda labels: labels.get("destination_workload") == "reviews-v1"
+            res = recorder.query({'query': query}, keep)
+            assert [series["metric"]["destination_workload"] for series in res["data"]["result"]] == ["reviews-v1"]
+            recorder.file.close()
+
+        replay = ReplayMetricsBackend(record_file)
+        # recordings hold all series, and queries match regardless of their durations
+        res = replay.query({'query': query.replace("[3600s]", "[3620s]")})
+        assert res == json.load(open("tests/data/prometheus_sample_response.json"))
+        assert replay.query({'query': "up"})["data"]["result"] == []
+
+        slow_replay = ReplayMetricsBackend(record_file, latency = 0.05)
+        with pytest.raises(requests.Timeout):
+            slow_replay.query({'query': query}, deadline = time.monotonic() + 0.01)
+
+    def test_metrics_from_replay(self, tmp_path):
+        record_file = str(tmp_path / "recording.jsonl.gz")
+        with gzip.open(record_file, "wt", encoding = "utf-8") as f:
+            f.write(json.dumps({
+                "query": "sum(increase(istio_requests_total{reporter='source'}[86400s])) by (destination_service_namespace,destination_workload)",
+                "time": None,
+                "response": json.load(open("tests/data/prometheus_sample_response.json"))
+            }) + "\n")
+
+        counter_metric_specs = {
+            "iter8_request_count": CounterMetricSpec(** {
+                "id": "iter8_request_count",
+                "query_template": "sum(increase(istio_requests_total{reporter='source'}[$interval])) by ($version_labels)"
+            })
+        }
+        versions = [Version(
+            id = "reviews-v1",
+            version_labels = {
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v1"
+            })
+        ]
+        metricsbackend._metrics_backend = ReplayMetricsBackend(record_file)
+        try:
+            cm = get_counter_metrics(counter_metric_specs, versions, datetime.now(timezone.utc) - timedelta(hours = 1))
+            assert cm["reviews-v1"]["iter8_request_count"].value == 21.763975155279503
+        finally:
+            metricsbackend._metrics_backend = None
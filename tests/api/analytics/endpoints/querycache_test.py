@@ -0,0 +1,152 @@
+"""Tests for module iter8_analytics.api.analytics.querycache"""
+# standard python stuff
+import logging
+import requests_mock
+import json
+import time
+import threading
+import asyncio
+
+# iter8 stuff
+from iter8_analytics import fastapi_app
+from iter8_analytics.api.analytics.types import *
+import iter8_analytics.constants as constants
+import iter8_analytics.config as config
+import iter8_analytics.api.analytics.querycache as querycache
+from iter8_analytics.api.analytics.querycache import QueryResultCache, SingleFlight
+from iter8_analytics.api.analytics.metrics import *
+
+env_config = config.get_env_config()
+fastapi_app.config_logger(env_config[constants.LOG_LEVEL])
+logger = logging.getLogger('iter8_analytics')
+
+metrics_backend_url = env_config[constants.METRICS_BACKEND_CONFIG_URL]
+metrics_endpoint = f'{metrics_backend_url}/api/v1/query'
+
+class TestQueryResultCache:
+    def test_hits_and_misses(self):
+        cache = QueryResultCache(max_size = 10, ttl = 60.0)
+        calls = []
+        def query():
+            calls.append(1)
+            return {"status": "success"}
+
+        assert cache.get_or_query("a", query) == {"status": "success"}
+        assert cache.get_or_query("a", query) == {"status": "success"}
+        assert len(calls) == 1
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+
+    def test_ttl_and_non_cacheable_values(self):
+        cache = QueryResultCache(max_size = 10, ttl = 0.0)
+        assert cache.get_or_query("a", lambda: 1) == 1
+        assert cache.get_or_query("a", lambda: 2) == 2 # expired
+
+        cache = QueryResultCache(max_size = 10, ttl = 60.0)
+        cache.get_or_query("b", lambda: {"status": "error"}, cacheable = lambda r: r["status"] == "success")
+        assert cache.stats()["size"] == 0
+
+    def test_lru_eviction(self):
+        cache = QueryResultCache(max_size = 2, ttl = 60.0)
+        cache.get_or_query("a", lambda: 1)
+        cache.get_or_query("b", lambda: 2)
+        cache.get_or_query("a", lambda: 10) # a is now most recently used
+        cache.get_or_query("c", lambda: 3) # evicts b
+        assert cache.get_or_query("a", lambda: 10) == 1
+        assert cache.get_or_query("b", lambda: 20) == 20
+        assert cache.stats()["evictions"] == 2
+
+    def test_shared_prometheus_queries(self):
+        versions = [Version(
+            id = "reviews-v1",
+            version_labels = {
+                "destination_service_namespace": "default",
+                "destination_workload": "reviews-v1"
+            })
+        ]
+
+        def query_spec():
+            return CounterQuerySpec(
+                version_label_keys = versions[0].version_labels.keys(),
+                query_template = "sum(increase(istio_requests_total{reporter='source'}[$interval])) by ($version_labels)",
+                start_time = datetime(2020, 1, 1, tzinfo = timezone.utc)
+            )
+
+        original_size = config.env_config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE]
+        config.env_config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE] = 10
+        querycache._query_result_cache = None
+        try:
+            with requests_mock.mock(real_http=True) as m:
+                m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_sample_response.json")))
+
+                current_time = datetime(2020, 1, 2, 0, 0, 3, tzinfo = timezone.utc)
+                res1 = PrometheusCounterMetricQuery(query_spec(), versions).query_from_spec(current_time)
+                res2 = PrometheusCounterMetricQuery(query_spec(), versions).query_from_spec(current_time + timedelta(seconds = 1))
+
+                assert m.call_count == 1
+                # evaluation time is aligned
+                assert float(m.last_request.qs["time"][0]) == datetime(2020, 1, 2, tzinfo = timezone.utc).timestamp()
+                assert res1 == res2
+                assert querycache.get_query_result_cache().stats()["hits"] == 1
+
+                # queries in the next time window are not served from the cache
+                PrometheusCounterMetricQuery(query_spec(), versions).query_from_spec(current_time + timedelta(seconds = 10))
+                assert m.call_count == 2
+                assert float(m.last_request.qs["time"][0]) == datetime(2020, 1, 2, 0, 0, 10, tzinfo = timezone.utc).timestamp()
+        finally:
+            config.env_config[constants.METRICS_BACKEND_CONFIG_QUERY_CACHE_SIZE] = original_size
+            querycache._query_result_cache = None
+
+class TestSingleFlight:
+    def test_coalesced_threads(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"status": "success"}
+
+        results = []
+        leader = threading.Thread(target = lambda: results.append(single_flight.do("q", slow_call)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target = lambda: results.append(single_flight.do("q", slow_call))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while single_flight.stats()["coalesced"] < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        assert len(calls) == 1
+        assert results == [{"status": "success"}] * 4
+        assert single_flight.stats() == {"calls": 1, "coalesced": 3, "in_flight": 0}
+
+        # calls after completion are executed afresh
+        single_flight.do("q", lambda: 2)
+        assert single_flight.stats()["calls"] == 2
+
+    def test_coalesced_coroutines_and_exceptions(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def failing_call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            raise ValueError("prometheus unavailable")
+
+        async def run():
+            return await asyncio.gather(
+                *[single_flight.do_async("q", failing_call) for _ in range(3)],
+                return_exceptions = True)
+
+        results = asyncio.run(run())
+        assert len(calls) == 1
+        assert all(isinstance(r, ValueError) for r in results)
+        assert single_flight.stats()["coalesced"] == 2
@@ -0,0 +1,102 @@
+"""Tests for module iter8_analytics.api.analytics.samplecache"""
+# standard python stuff
+import logging
+import requests_mock
+import json
+
+# python libraries
+import numpy as np
+
+# iter8 stuff
+from iter8_analytics import fastapi_app
+from iter8_analytics.api.analytics.types import *
+import iter8_analytics.constants as constants
+import iter8_analytics.config as config
+import iter8_analytics.api.analytics.samplecache as samplecache
+from iter8_analytics.api.analytics.samplecache import SampleCache
+from iter8_analytics.api.analytics.detailedmetric import *
+from iter8_analytics.api.analytics.experiment import Experiment
+from iter8_analytics.api.analytics.endpoints.examples import *
+
+env_config = config.get_env_config()
+fastapi_app.config_logger(env_config[constants.LOG_LEVEL])
+logger = logging.getLogger('iter8_analytics')
+
+metrics_backend_url = env_config[constants.METRICS_BACKEND_CONFIG_URL]
+metrics_endpoint = f'{metrics_backend_url}/api/v1/query'
+
+def get_beliefs():
+    return [
+        [GaussianBelief(mean = 5.0, variance = 0.25), BetaBelief(alpha = 2.0, beta = 8.0)],
+        [ConstantBelief(value = 3.0), Belief(status = StatusEnum.uninitialized_belief)]
+    ]
+
+class TestSampleCache:
+    def test_lru_eviction_and_stats(self):
+        cache = SampleCache(max_size = 2)
+        cache.put("a", np.zeros(3))
+        cache.put("b", np.ones(3))
+        assert cache.get("a") is not None # a is now most recently used
+        cache.put("c", np.ones(3)) # evicts b
+        assert cache.get("b") is None
+        assert not cache.get("c").flags.writeable
+        assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "evictions": 1, "size": 2}
+
+    def test_cached_belief_samples(self):
+        cache = SampleCache(max_size = 10)
+        samples1 = sample_beliefs(get_beliefs(), sample_size = 1000, cache = cache)
+        assert cache.stats()["misses"] == 2 # constant beliefs are not cached
+        beliefs = get_beliefs()
+        samples2 = sample_beliefs(beliefs, sample_size = 1000, cache = cache)
+        assert cache.stats()["hits"] == 2
+        assert np.array_equal(samples1, samples2, equal_nan = True)
+        # samples of beliefs remain writable views into the batched buffer
+        assert np.shares_memory(beliefs[0][0].sample, samples2)
+
+        # chunks appended in adaptive sampling are cached separately
+        sample_beliefs(beliefs, sample_size = 1000, cache = cache, previous_samples = samples2)
+        assert cache.stats()["misses"] == 4
+
+    def test_seeded_samples(self):
+        cache = SampleCache(max_size = 10)
+        samples1 = sample_beliefs(get_beliefs(), sample_size = 1000, cache = cache, seed = 11)
+        # fresh samples drawn with the same seed are identical to cached ones
+        samples2 = sample_beliefs(get_beliefs(), sample_size = 1000, cache = SampleCache(max_size = 10), seed = 11)
+        assert np.array_equal(samples1, samples2, equal_nan = True)
+        samples3 = sample_beliefs(get_beliefs(), sample_size = 1000, cache = cache, seed = 12)
+        assert not np.array_equal(samples1[0, 0], samples3[0, 0])
+
+    def test_identical_beliefs_sampled_independently(self):
+        def get_identical_beliefs():
+            return [[BetaBelief(alpha = 2.0, beta = 8.0), BetaBelief(alpha = 2.0, beta = 8.0)]]
+        ids = (["metric"], ["baseline", "candidate"])
+        for seed in [None, 11]:
+            cache = SampleCache(max_size = 10)
+            # the second call serves both samples from the cache
+            for _ in range(2):
+                samples = sample_beliefs(get_identical_beliefs(), sample_size = 10000, cache = cache, seed = seed, ids = ids)
+                assert not np.array_equal(samples[0, 0], samples[0, 1])
+                assert abs(np.mean(samples[0, 1] > samples[0, 0]) - 0.5) < 0.03
+            assert cache.stats()["hits"] == 2
+
+    def test_shared_across_experiments(self):
+        original_size = config.env_config[constants.SAMPLE_CACHE_SIZE]
+        config.env_config[constants.SAMPLE_CACHE_SIZE] = 100
+        samplecache._sample_cache = None
+        try:
+            with requests_mock.mock(real_http=True) as m:
+                m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+                exp1 = Experiment(ExperimentIterationParameters(** eip_with_assessment))
+                exp1.run()
+                stats = samplecache.get_sample_cache().stats()
+                assert stats["hits"] == 0 and stats["misses"] > 0
+
+                # beliefs are unchanged in the next iteration, so samples are reused
+                exp2 = Experiment(ExperimentIterationParameters(** eip_with_assessment))
+                exp2.run()
+                assert samplecache.get_sample_cache().stats()["hits"] == stats["misses"]
+                assert np.array_equal(exp1.ratio_metric_samples, exp2.ratio_metric_samples, equal_nan = True)
+        finally:
+            config.env_config[constants.SAMPLE_CACHE_SIZE] = original_size
+            samplecache._sample_cache = None
@@ -0,0 +1,134 @@
+"""Tests for module iter8_analytics.api.analytics.tracing"""
+# standard python stuff
+import logging
+import itertools
+import json
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import requests_mock
+
+# iter8 stuff
+from iter8_analytics import fastapi_app
+from iter8_analytics.api.analytics.types import *
+import iter8_analytics.constants as constants
+import iter8_analytics.config as config
+import iter8_analytics.api.analytics.tracing as tracing
+from iter8_analytics.api.analytics.tracing import *
+from iter8_analytics.api.analytics.experiment import Experiment
+from iter8_analytics.api.analytics.endpoints.examples import *
+
+env_config = config.get_env_config()
+fastapi_app.config_logger(env_config[constants.LOG_LEVEL])
+logger = logging.getLogger('iter8_analytics')
+
+metrics_backend_url = env_config[constants.METRICS_BACKEND_CONFIG_URL]
+metrics_endpoint = f'{metrics_backend_url}/api/v1/query'
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class TestTracing:
+    def setup_method(self):
+        self.original_level = logger.level
+        self.original_config = {key: config.env_config[key] for key in [constants.DEBUG_SAMPLING_RATE, constants.DEBUG_EXPERIMENTS]}
+        logger.setLevel(logging.DEBUG)
+        tracing._iterations = itertools.count()
+        self.handler = RecordingHandler()
+        logger.addHandler(self.handler)
+
+    def teardown_method(self):
+        logger.removeHandler(self.handler)
+        logger.setLevel(self.original_level)
+        config.env_config.update(self.original_config)
+
+    def traced_iterations(self, experiment_ids):
+        traced = []
+        for experiment_id in experiment_ids:
+            token = start_trace(experiment_id)
+            traced.append(is_tracing())
+            end_trace(token)
+        return traced
+
+    def test_sampled_traces(self):
+        config.env_config[constants.DEBUG_SAMPLING_RATE] = 3
+        config.env_config[constants.DEBUG_EXPERIMENTS] = ["reviews"]
+        assert self.traced_iterations(["a", "b", "c", "reviews", "d", "e", "f"]) == [True, False, False, True, False, False, True]
+
+        # only chosen experiments are traced if sampling is disabled
+        config.env_config[constants.DEBUG_SAMPLING_RATE] = 0
+        assert self.traced_iterations(["a", "reviews"]) == [False, True]
+
+        # nothing is traced above debug level
+        logger.setLevel(logging.INFO)
+        assert self.traced_iterations(["reviews"]) == [False]
+
+    def test_lazy_formatting(self):
+        calls = []
+        def expensive():
+            calls.append(1)
+            return "value"
+        trace = get_trace_logger()
+        config.env_config[constants.DEBUG_SAMPLING_RATE] = 0
+        config.env_config[constants.DEBUG_EXPERIMENTS] = ["reviews"]
+
+        trace.debug("untraced %s", Lazy(expensive))
+        assert not calls and not self.handler.records
+
+        token = start_trace("reviews")
+        trace.debug("traced %s", Lazy(expensive), step = "test")
+        end_trace(token)
+        assert calls == [1]
+        record = self.handler.records[0]
+        assert record.getMessage() == "traced value"
+        assert record.trace == {"experiment": "reviews", "iteration": 0, "step": "test"}
+        assert json.loads(JsonFormatter().format(record))["experiment"] == "reviews"
+
+    def test_lazy_placeholders(self):
+        calls = []
+        def expensive(value):
+            calls.append(1)
+            return value
+        trace = get_trace_logger()
+        config.env_config[constants.DEBUG_SAMPLING_RATE] = 0
+        config.env_config[constants.DEBUG_EXPERIMENTS] = ["reviews"]
+
+        token = start_trace("reviews")
+        size = Lazy(expensive, 255)
+        trace.debug("%d %x %.1f %r", size, size, size, Lazy(expensive, "v1"))
+        # an empty string is computed only once as well
+        empty = Lazy(expensive, "")
+        trace.debug("[%s]%s", empty, empty)
+        end_trace(token)
+        assert [record.getMessage() for record in self.handler.records] == ["255 ff 255.0 'v1'", "[]"]
+        assert calls == [1, 1, 1]
+
+    def test_propagate_trace(self):
+        config.env_config[constants.DEBUG_SAMPLING_RATE] = 1
+        token = start_trace("reviews")
+        with ThreadPoolExecutor(max_workers = 1) as executor:
+            assert not executor.submit(is_tracing).result()
+            assert executor.submit(propagate_trace(is_tracing)).result()
+        end_trace(token)
+
+    def test_traced_experiment(self):
+        config.env_config[constants.DEBUG_SAMPLING_RATE] = 0
+        with requests_mock.mock(real_http=True) as m:
+            m.get(metrics_endpoint, json=json.load(open("tests/data/prometheus_no_data_response.json")))
+
+            eg = copy.deepcopy(eip_with_assessment)
+            Experiment(ExperimentIterationParameters(** eg)).run()
+            assert not [record for record in self.handler.records if hasattr(record, "trace")]
+
+            config.env_config[constants.DEBUG_EXPERIMENTS] = [eg["service_name"]]
+            Experiment(ExperimentIterationParameters(** eg)).run()
+            traced = [record for record in self.handler.records if hasattr(record, "trace")]
+            assert traced
+            assert all(record.trace["experiment"] == eg["service_name"] for record in traced)
+            # records from sampling threads and query threads belong to the trace as well
+            assert any(record.filename == "detailedversion.py" for record in traced)
+            assert any(record.filename == "metrics.py" for record in traced)
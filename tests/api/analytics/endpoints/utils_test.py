@@ -0,0 +1,50 @@
+"""Tests for module iter8_analytics.api.analytics.utils"""
+# python libraries
+import math
+import numpy as np
+import pandas as pd
+
+# iter8 stuff
+from iter8_analytics.api.analytics.utils import get_min_ranks, get_rank_counts, round_weights
+
+class TestUtils:
+    def test_min_ranks(self):
+        utilities = np.array([
+            [1.0, 3.0, 2.0, 0.0],
+            [2.0, 2.0, 1.0, 2.0],
+            [np.nan, 1.0, 1.0, 0.0],
+            [0.0, 0.0, 0.0, 0.0],
+            [np.nan, np.nan, np.nan, np.nan]
+        ])
+        rank_df = pd.DataFrame(utilities).rank(axis = 1, method = 'min', ascending = False)
+        ranks = get_min_ranks(utilities)
+        assert np.array_equal(ranks + 1.0, rank_df.fillna(5.0).values)
+        rank_counts = get_rank_counts(ranks)
+        for k in range(1, 5):
+            assert np.array_equal(rank_counts[:k].sum(axis = 0), (rank_df <= k).sum().values)
+
+    def test_round_weights_sum_and_bounds(self):
+        rng = np.random.default_rng(0)
+        for num_weights, total in [(1, 100), (2, 100), (3, 99.6), (7, 100), (200, 100), (5, 0.4)]:
+            for _ in range(200):
+                weights = rng.random(num_weights) * rng.choice([1.0, 1.0e-6, 1.0e6])
+                weights[rng.random(num_weights) < 0.2] = 0.0
+                rounded = round_weights(weights, total, rng)
+                assert rounded.dtype.kind == 'i'
+                assert rounded.sum() == math.floor(total)
+                # each rounded weight is the floor or ceiling of its scaled weight
+                scaled = weights * math.floor(total) / weights.sum() if weights.sum() > 0 else np.full(num_weights, math.floor(total) / num_weights)
+                assert np.all((rounded == np.floor(scaled)) | (rounded == np.ceil(scaled)))
+        assert round_weights([0.0, 0.0], 100.7, rng).sum() == 100
+        assert len(round_weights([], 100, rng)) == 0
+
+    def test_round_weights_unbiased(self):
+        rng = np.random.default_rng(1)
+        for weights, total in [(rng.random(200), 100), ([1.0, 1.0, 1.0], 100), ([0.15, 0.7, 0.15], 7.9)]:
+            weights = np.asarray(weights)
+            scaled = weights * math.floor(total) / weights.sum()
+            draws = 20000
+            rounded = np.array([round_weights(weights, total, rng) for _ in range(draws)])
+            # the mean of the rounded weights converges to the scaled weights, within five standard errors of rounding noise
+            tolerance = 5.0 * np.sqrt((scaled - np.floor(scaled)) * (np.ceil(scaled) - scaled) / draws) + 1.0e-9
+            assert np.all(np.abs(rounded.mean(axis = 0) - scaled) <= tolerance)
@@ -0,0 +1,63 @@
+"""Benchmark comparing the accuracy and speed of monte carlo and quasi monte carlo posterior sampling.
+
+Run from the repository root with:
+    python -m tests.benchmark.sampling_benchmark
+"""
+# standard python stuff
+import time
+
+# python libraries
+import numpy as np
+from scipy import integrate, stats
+
+# iter8 stuff
+from iter8_analytics.api.analytics.detailedmetric import *
+
+REPETITIONS = 100
+
+def get_beliefs():
+    """Three versions with overlapping posteriors for a latency metric and an error rate metric"""
+    return [
+        [GaussianBelief(mean = 100.0, variance = 4.0), GaussianBelief(mean = 101.0, variance = 4.0), GaussianBelief(mean = 99.5, variance = 9.0)],
+        [BetaBelief(alpha = 20.0, beta = 980.0), BetaBelief(alpha = 25.0, beta = 975.0), BetaBelief(alpha = 18.0, beta = 982.0)]
+    ]
+
+def get_exact_win_probabilities(beliefs):
+    """Probability that each version has the lowest latency, by numerical integration"""
+    dists = [b.distribution for b in beliefs[0]]
+    def integrand(x, i):
+        return dists[i].pdf(x) * np.prod([dists[j].sf(x) for j in range(len(dists)) if j != i])
+    return np.array([integrate.quad(integrand, 50.0, 150.0, args = (i, ))[0] for i in range(len(dists))])
+
+def estimate(samples):
+    """Estimates of win probabilities for latency, and of the mean error rate of each version"""
+    best = np.argmin(samples[0], axis = 0)
+    win_probabilities = np.bincount(best, minlength = samples.shape[1]) / samples.shape[2]
+    return win_probabilities, np.mean(samples[1], axis = 1)
+
+def run(sample_size, quasi_monte_carlo):
+    beliefs = get_beliefs()
+    exact_win_probabilities = get_exact_win_probabilities(beliefs)
+    exact_means = np.array([b.distribution.mean() for b in beliefs[1]])
+    rng = np.random.default_rng(0)
+    win_errors, mean_errors = [], []
+    start = time.perf_counter()
+    for _ in range(REPETITIONS):
+        engine = create_qmc_engine(beliefs, rng) if quasi_monte_carlo else None
+        samples = sample_beliefs(beliefs, sample_size, rng = rng, qmc_engine = engine)
+        win_probabilities, means = estimate(samples)
+        win_errors.append(win_probabilities - exact_win_probabilities)
+        mean_errors.append(means - exact_means)
+    elapsed = (time.perf_counter() - start) / REPETITIONS
+    rmse = lambda errors: float(np.sqrt(np.mean(np.square(errors))))
+    return rmse(win_errors), rmse(mean_errors), elapsed
+
+if __name__ == '__main__':
+    print(f"{'method':<20}{'samples':>10}{'win prob rmse':>16}{'mean rmse':>14}{'ms / draw':>12}")
+    for method, quasi_monte_carlo, sample_size in [
+        ("monte carlo", False, 10000),
+        ("monte carlo", False, 1024),
+        ("quasi monte carlo", True, 1024),
+        ("quasi monte carlo", True, 4096)]:
+        win_rmse, mean_rmse, elapsed = run(sample_size, quasi_monte_carlo)
+        print(f"{method:<20}{sample_size:>10}{win_rmse:>16.5f}{mean_rmse:>14.2e}{elapsed * 1000:>12.2f}")